@@ -0,0 +1,231 @@
+"""
+DotsOCR 性能基准测试
+
+用法:
+    python benchmark.py docx --pages 900
+    python benchmark.py encoding --pages 10 --scale 2 --transports base64 stream file
+"""
+
+import argparse
+import base64
+import http.server
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).parent / "pdf_converter"))
+
+from dots_ocr_lib import (IMAGE_ENCODING_PRESETS, IMAGE_TRANSPORTS, MAX_PIXELS, PILimage_to_base64, fetch_image,
+                          inference_with_vllm, layoutjson2md, resolve_image_encoding)
+
+# ==============================================================================
+# Synthetic pages
+# ==============================================================================
+
+def make_sample_page(page_idx, paragraphs=12):
+    """生成一页典型的 OCR 结果：页面原图与 layout cells（标题、段落、图片、公式、表格）"""
+    page_image = Image.new('RGB', (1240, 1754), (255, 255, 255))
+    # 图片区域使用渐变叠加轻微噪声模拟照片内容
+    gradient = Image.linear_gradient('L').resize((800, 500))
+    noise = Image.effect_noise((800, 500), 8 + page_idx % 8)
+    photo = Image.merge('RGB', [gradient, Image.blend(gradient, noise, 0.3), gradient.rotate(180)])
+    page_image.paste(photo, (100, 900))
+
+    cells = [{'bbox': [100, 80, 1100, 140], 'category': 'Section-header', 'text': f"## Section {page_idx + 1}"}]
+    for i in range(paragraphs):
+        top = 160 + i * 60
+        cells.append({'bbox': [100, top, 1100, top + 50], 'category': 'Text',
+                      'text': f"Paragraph {i} of page {page_idx + 1} with some **bold** and *italic* text. " * 3})
+    cells.append({'bbox': [100, 900, 900, 1400], 'category': 'Picture'})
+    cells.append({'bbox': [100, 1420, 1100, 1480], 'category': 'Formula', 'text': "$$E = mc^2 + \\sum_{i=0}^{n} x_i$$"})
+    cells.append({'bbox': [100, 1500, 1100, 1700], 'category': 'Table',
+                  'text': "<table><tr><th>Name</th><th>Value</th><th>Unit</th></tr>"
+                          + "".join(f"<tr><td>item {r}</td><td>{r * 1.5}</td><td>kg</td></tr>" for r in range(6))
+                          + "</table>"})
+    # 文字区域画上文本，使页面的压缩特性接近真实扫描件
+    draw = ImageDraw.Draw(page_image)
+    for cell in cells:
+        if cell['category'] in ('Section-header', 'Text', 'Formula'):
+            draw.text((cell['bbox'][0], cell['bbox'][1]), cell['text'][:160], fill=(20, 20, 20))
+    return page_image, cells
+
+def write_sample_pages(work_dir, base_name, total_pages):
+    """按 pdf_converter 的落盘格式写入逐页结果（page_XXXX.jpg、cells JSON、图片裁剪、Markdown）"""
+    import server
+
+    for page_idx in range(total_pages):
+        page_image, cells = make_sample_page(page_idx)
+        page_image.save(work_dir / f"page_{page_idx:04d}.jpg")
+        server.save_picture_crops(page_image, cells, work_dir, base_name, page_idx)
+        with open(work_dir / f"{base_name}_page_{page_idx}.json", 'w', encoding='utf-8') as f:
+            json.dump(cells, f, ensure_ascii=False)
+        with open(work_dir / f"{base_name}_page_{page_idx}.md", 'w', encoding='utf-8') as f:
+            f.write(layoutjson2md(page_image, cells))
+
+# ==============================================================================
+# Mock inference server
+# ==============================================================================
+
+class MockOCRServer:
+    """OpenAI 兼容的本地模拟推理服务：解码请求中的图片（data URL 或 file:// 路径）后返回固定的 layout 结果"""
+
+    def __init__(self, latency=0.0, cells=None, decode=True):
+        # decode=False 时只读取并丢弃请求体，用于测量客户端内存（模拟服务与客户端在同一进程）
+        self.latency, self.decode = latency, decode
+        self.content = json.dumps(cells if cells is not None else make_sample_page(0)[1], ensure_ascii=False)
+        self.requests = 0
+        self.bytes_received = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                server.requests += 1
+                server.bytes_received += length
+                if server.decode:
+                    payload = json.loads(self.rfile.read(length))
+                    for part in payload['messages'][0]['content']:
+                        if part['type'] == 'image_url':
+                            Image.open(server.resolve_image(part['image_url']['url'])).load()
+                else:
+                    while length > 0:
+                        length -= len(self.rfile.read(min(length, 65536)))
+                time.sleep(server.latency)
+                reply = json.dumps({
+                    'id': 'mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': 'dots-ocr',
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': server.content}, 'finish_reason': 'stop'}],
+                    'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.httpd.server_address[1]
+
+    @staticmethod
+    def resolve_image(url):
+        if url.startswith('file://'):
+            return url2pathname(urlparse(url).path)
+        return io.BytesIO(base64.b64decode(url.split(',', 1)[1]))
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# ==============================================================================
+# Benchmarks
+# ==============================================================================
+
+def bench_docx(args):
+    """DOCX 生成速度（页/秒），对比 Markdown/cells 两种生成方式以及单进程/多进程分卷生成"""
+    import server
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_docx_"))
+    base_name = "bench"
+    try:
+        write_sample_pages(work_dir, base_name, args.pages)
+        print(f"DOCX benchmark: {args.pages} pages, split every {args.split_every} pages")
+
+        for builder in ('markdown', 'cells'):
+            for processes in sorted({1, args.processes or server.DOCX_WORKERS}):
+                out_path = work_dir / f"{base_name}_{builder}_{processes}.docx"
+                start = time.time()
+                files = server.markdown_to_docx(work_dir, base_name, args.pages, str(out_path),
+                                                split_every=args.split_every, processes=processes, builder=builder)
+                elapsed = time.time() - start
+                size = sum(os.path.getsize(f) for f in files)
+                print(f"  builder={builder:<9} processes={processes:<3} files={len(files):<3} "
+                      f"time={elapsed:7.2f}s  speed={args.pages / elapsed:8.1f} pages/s  size={size / 1e6:6.1f} MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def bench_encoding(args):
+    """推理请求图片编码/传输方式对比：编码耗时、请求体大小、客户端峰值内存、对模拟服务的端到端延迟"""
+    policies = args.policies or list(IMAGE_ENCODING_PRESETS)
+    transports = args.transports or ['base64']
+    images = []
+    for page_idx in range(args.pages):
+        page_image, _ = make_sample_page(page_idx)
+        if args.scale != 1:
+            page_image = page_image.resize((int(page_image.width * args.scale), int(page_image.height * args.scale)))
+        images.append(fetch_image(page_image, max_pixels=MAX_PIXELS))
+    print(f"Encoding benchmark: {args.pages} pages of {images[0].width}x{images[0].height} "
+          f"({images[0].width * images[0].height / 1e6:.1f} MP)")
+
+    media_dir = tempfile.mkdtemp(prefix="bench_media_")
+    try:
+        with MockOCRServer(latency=args.latency) as server, MockOCRServer(decode=False) as sink:
+            # 预热（首次请求包含 OpenAI 客户端的初始化开销）
+            inference_with_vllm(images[0], "benchmark", '127.0.0.1', sink.port)
+            for policy in policies:
+                encoding = resolve_image_encoding(policy)
+                encode_time = 0
+                for image in images:
+                    start = time.time()
+                    PILimage_to_base64(image, **encoding)
+                    encode_time += time.time() - start
+                for transport in transports:
+                    # 单个请求的客户端峰值内存（Python 分配，不含 PIL 图像本身）
+                    tracemalloc.start()
+                    inference_with_vllm(images[0], "benchmark", '127.0.0.1', sink.port, image_encoding=encoding,
+                                        image_transport=transport, media_dir=media_dir)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+
+                    received = server.bytes_received
+                    start = time.time()
+                    for image in images:
+                        inference_with_vllm(image, "benchmark", '127.0.0.1', server.port, image_encoding=encoding,
+                                            image_transport=transport, media_dir=media_dir)
+                    e2e_time = time.time() - start
+                    n = len(images)
+                    print(f"  {policy:<14} {transport:<7} encode={encode_time / n * 1000:7.1f} ms  "
+                          f"request={(server.bytes_received - received) / n / 1024:8.1f} KB  peak={peak / 1e6:6.1f} MB  "
+                          f"end-to-end={e2e_time / n * 1000:7.1f} ms")
+    finally:
+        shutil.rmtree(media_dir, ignore_errors=True)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="DotsOCR benchmarks")
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    docx_parser = subparsers.add_parser('docx', help="DOCX generation throughput (pages/second)")
+    docx_parser.add_argument('--pages', type=int, default=900)
+    docx_parser.add_argument('--split-every', type=int, default=300)
+    docx_parser.add_argument('--processes', type=int, default=None)
+    docx_parser.set_defaults(func=bench_docx)
+
+    encoding_parser = subparsers.add_parser('encoding', help="Inference payload encoding: time, size and latency per policy")
+    encoding_parser.add_argument('--pages', type=int, default=10)
+    encoding_parser.add_argument('--scale', type=float, default=1.0, help="Scale the 150 DPI sample page (2.0 ~ 300 DPI)")
+    encoding_parser.add_argument('--latency', type=float, default=0.0, help="Simulated model latency of the mock server (seconds)")
+    encoding_parser.add_argument('--policies', nargs='*', choices=sorted(IMAGE_ENCODING_PRESETS))
+    encoding_parser.add_argument('--transports', nargs='*', choices=IMAGE_TRANSPORTS)
+    encoding_parser.set_defaults(func=bench_encoding)
+
+    args = arg_parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
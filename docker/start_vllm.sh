@@ -5,6 +5,8 @@ set -ex
 TARGET_PHYSICAL_ID=$1
 # 接收环境变量端口，默认 8000
 PORT=${VLLM_PORT:-8000}
+# 允许 vLLM 读取的本地图片目录 (file:// 传图)，为空则只接受 base64/HTTP 图片
+MEDIA_PATH=${VLLM_MEDIA_PATH:-}
 
 echo "--- vLLM Launcher ---"
 echo "Target Physical GPU: $TARGET_PHYSICAL_ID"
@@ -42,6 +44,11 @@ export NCCL_P2P_DISABLE=1
 export CUDA_LAUNCH_BLOCKING=1
 
 # === 4. 启动 vLLM ===
+EXTRA_ARGS=()
+if [ -n "$MEDIA_PATH" ]; then
+    EXTRA_ARGS+=(--allowed-local-media-path "$MEDIA_PATH")
+fi
+
 # 注意：tensor-parallel-size 始终为 1，因为我们已经通过 CUDA_VISIBLE_DEVICES 锁定了一张卡
 exec vllm serve /workspace/weights/DotsOCR \
     --host 0.0.0.0 \
@@ -54,4 +61,5 @@ exec vllm serve /workspace/weights/DotsOCR \
     --served-model-name dots-ocr \
     --trust-remote-code \
     --enforce-eager \
-    --disable-log-stats
\ No newline at end of file
+    --disable-log-stats \
+    "${EXTRA_ARGS[@]}"
\ No newline at end of file
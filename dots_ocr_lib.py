@@ -6,15 +6,25 @@ import math
 import io
 import re
 import copy
+import uuid
+import hashlib
+import random
+import http.client
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
 from multiprocessing.pool import ThreadPool
 from io import BytesIO
+from pathlib import Path
 
 # Third-party imports that need to be installed by the user
 import fitz  # PyMuPDF
 import requests
 from tqdm import tqdm
-from openai import OpenAI
-from PIL import Image
+from openai import OpenAI, APIConnectionError, APIStatusError, APITimeoutError
+from PIL import Image, ImageChops
 
 # ==============================================================================
 # SECTION 1: CONSTANTS (from dots_ocr.utils.consts)
@@ -23,8 +33,36 @@ from PIL import Image
 MIN_PIXELS = 3136
 MAX_PIXELS = 11289600
 IMAGE_FACTOR = 28
+MAX_ASPECT_RATIO = 200  # smart_resize rejects images more elongated than this
 image_extensions = {'.jpg', '.jpeg', '.png'}
 
+# Blank page detection (see blank_page_stats): ink = pixels at least ink_delta darker than the paper, margins ignored
+BLANK_PAGE_THRESHOLDS = {'margin': 0.05, 'ink_delta': 64, 'max_ink_ratio': 0.0002, 'max_stddev': 20.0}
+
+# Text-layer fast path for born-digital PDF pages (see text_layer_cells)
+TEXT_LAYER_THRESHOLDS = {'min_chars': 50, 'max_bad_char_ratio': 0.01, 'max_drawings': 20}
+
+# Adaptive pixel budget (see adaptive_max_pixels): pages whose smallest text is large are sent smaller, as long as their small
+# text lines (ink core of the line, about the x-height) keep target_line_height px; min_scale bounds the linear downscale
+ADAPTIVE_PIXELS_THRESHOLDS = {'target_line_height': 10, 'min_scale': 0.5, 'percentile': 0.02, 'strips': 4, 'min_lines': 3}
+
+# Predicted model output length of a page (characters of layout JSON) from cheap page features, used to dispatch the
+# longest pages first (LPT); see page_cost_features / fit_decode_length_coefficients
+DECODE_LENGTH_COEFFICIENTS = {'intercept': 300.0, 'text_chars': 1.2, 'ink': 60000.0, 'vector_ops': 10.0}
+
+# Near-duplicate pages (see page_perceptual_hash): hash_size**2 bit hash, reuse within max_distance bits (Hamming)
+NEAR_DUPLICATE_THRESHOLDS = {'hash_size': 32, 'tolerance': 2, 'max_distance': 24}
+
+# Wire encoding of the image sent to the inference server (see PILimage_to_base64)
+# grayscale: True, False or 'auto' (only for pages without color)
+IMAGE_ENCODING_PRESETS = {
+    'png': {'format': 'PNG'},
+    'png-fast': {'format': 'PNG', 'compress_level': 1},
+    'jpeg': {'format': 'JPEG', 'quality': 90},
+    'jpeg-gray': {'format': 'JPEG', 'quality': 90, 'grayscale': 'auto'},
+    'webp': {'format': 'WEBP', 'quality': 90},
+}
+
 # ==============================================================================
 # SECTION 2: PROMPTS (from dots_ocr.utils.prompts)
 # ==============================================================================
@@ -59,7 +97,131 @@ dict_promptmode_to_prompt = {
 
 # --- From doc_utils.py ---
 
-def fitz_doc_to_image(doc, target_dpi=200, origin_dpi=None):
+# --- Page fingerprints (identify unchanged pages across document revisions) ---
+
+_PDF_REF_RE = re.compile(r'(\d+) 0 R')
+# Keys that differ between revisions without changing what the page shows
+_VOLATILE_KEY_RE = re.compile(r'/(Parent|P|StructParents?|Metadata|LastModified)\s*(\d+ 0 R|\d+|\([^)]*\))')
+# Stream encoding keys: streams are hashed decompressed, so recompression does not change the digest
+_STREAM_KEY_RE = re.compile(r'/(Length|DL)\s*(\d+ 0 R|\d+)|/(Filter|DecodeParms)\s*(/\w+|\[[^\]]*\]|<<[^>]*>>|null)')
+
+def _pdf_source_digest(doc, source, memo):
+    # Object references are replaced by the digest of the referenced object, so xref numbering does not matter
+    source = _PDF_REF_RE.sub(lambda m: _xref_digest(doc, int(m.group(1)), memo), _VOLATILE_KEY_RE.sub('', source))
+    return hashlib.sha256(source.encode('utf-8', 'surrogateescape')).hexdigest()
+
+def _xref_digest(doc, xref, memo):
+    if xref not in memo:
+        memo[xref] = 'cycle'
+        source = doc.xref_object(xref, compressed=True)
+        if doc.xref_is_stream(xref):
+            digest = _pdf_source_digest(doc, _STREAM_KEY_RE.sub('', source), memo)
+            digest = hashlib.sha256(digest.encode() + (doc.xref_stream(xref) or b'')).hexdigest()
+        else:
+            digest = _pdf_source_digest(doc, source, memo)
+        memo[xref] = digest
+    return memo[xref]
+
+def _page_resources_source(doc, xref):
+    # Resources may be inherited from the page tree
+    for _ in range(32):
+        kind, value = doc.xref_get_key(xref, 'Resources')
+        if kind != 'null': return value
+        kind, value = doc.xref_get_key(xref, 'Parent')
+        if kind != 'xref': return ''
+        xref = int(value.split()[0])
+    return ''
+
+def page_fingerprints(doc):
+    """Per-page content digest from the decompressed content streams, the resources they use, the annotations and form fields
+    (with their appearance streams) and the page geometry (no rendering)"""
+    memo, fingerprints = {}, []
+    for page in doc:
+        h = hashlib.sha256(f"{tuple(page.mediabox)}|{tuple(page.cropbox)}|{page.rotation}".encode())
+        for xref in page.get_contents(): h.update(doc.xref_stream(xref) or b'')
+        h.update(_pdf_source_digest(doc, _page_resources_source(doc, page.xref), memo).encode())
+        # Annotations are drawn on top of the content: filled form values and FreeText notes change the page without touching its streams
+        annots = page.annot_xrefs()
+        for xref, *_ in annots: h.update(_xref_digest(doc, xref, memo).encode())
+        if any(kind == fitz.PDF_ANNOT_WIDGET for _, kind, *_ in annots):
+            # Field values can live in a parent field object, which the annotation digest leaves out (/Parent is volatile)
+            for widget in page.widgets(): h.update(f"|{widget.field_name}={widget.field_value}".encode('utf-8', 'surrogateescape'))
+        fingerprints.append(h.hexdigest())
+    return fingerprints
+
+def page_cost_features(page, ink_dpi=12):
+    """Cheap features of a PDF page that predict the length of the model output: text layer characters, ink (mean darkness of
+    a ink_dpi thumbnail relative to the paper) and vector path operations (ruled tables); a few ms per page"""
+    pix = page.get_pixmap(matrix=fitz.Matrix(ink_dpi / 72, ink_dpi / 72), colorspace=fitz.csGRAY, alpha=False)
+    hist = Image.frombytes('L', (pix.width, pix.height), pix.samples).histogram()
+    background = max(range(256), key=hist.__getitem__)
+    ink = sum(n * (background - i) for i, n in enumerate(hist[:background])) / ((sum(hist) or 1) * 255)
+    return {'text_chars': len(''.join(page.get_text('text').split())), 'ink': round(ink, 5),
+            'vector_ops': sum(1 for op, _ in page.get_bboxlog() if op in ('fill-path', 'stroke-path'))}
+
+def estimate_decode_length(features, coefficients=None):
+    c = coefficients or DECODE_LENGTH_COEFFICIENTS
+    return max(0.0, c['intercept'] + sum(c[k] * features.get(k, 0) for k in c if k != 'intercept'))
+
+def fit_decode_length_coefficients(samples, ridge=1e-3):
+    """Least-squares fit of DECODE_LENGTH_COEFFICIENTS to [(features, output_chars)] of processed pages; features are scaled
+    to unit mean for conditioning, coefficients clamped to >= 0 (more content never means a shorter output)"""
+    keys = [k for k in DECODE_LENGTH_COEFFICIENTS if k != 'intercept']
+    scale = [sum(abs(f.get(k, 0)) for f, _ in samples) / len(samples) or 1.0 for k in keys]
+    rows = [[1.0] + [f.get(k, 0) / sc for k, sc in zip(keys, scale)] for f, _ in samples]
+    n = len(keys) + 1
+    # Normal equations (X'X + ridge I) b = X'y, Gaussian elimination with partial pivoting
+    a = [[sum(r[i] * r[j] for r in rows) + (ridge * len(rows) if i == j else 0.0) for j in range(n)] + [sum(r[i] * y for r, (_, y) in zip(rows, samples))] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col])); a[col], a[pivot] = a[pivot], a[col]
+        if abs(a[col][col]) < 1e-12: return dict(DECODE_LENGTH_COEFFICIENTS)
+        for r in range(n):
+            if r != col:
+                f = a[r][col] / a[col][col]; a[r] = [x - f * y for x, y in zip(a[r], a[col])]
+    b = [a[i][n] / a[i][i] for i in range(n)]
+    return {'intercept': max(0.0, b[0]), **{k: max(0.0, bi / sc) for k, bi, sc in zip(keys, b[1:], scale)}}
+
+def embedded_page_image(page, target_dpi=200, min_coverage=0.95):
+    """Full-page scan image taken from the PDF image stream instead of rendering the page; None when the page needs rendering"""
+    # Only pages that are exactly one upright image covering the page: no visible text, vector graphics or annotations on top
+    # (bbox log and image info without xrefs are cheap; they do not decode the image)
+    if page.rotation or page.first_annot: return None
+    ops = [op for op, _ in page.get_bboxlog()]
+    if ops.count('fill-image') != 1 or any(op not in ('fill-image', 'ignore-text') for op in ops): return None
+    info, images = page.get_image_info(), page.get_images(full=True)
+    if len(info) != 1 or len(images) != 1 or (info[0]['width'], info[0]['height']) != (images[0][2], images[0][3]): return None
+    a, b, c, d, _, _ = info[0]['transform']
+    if a <= 0 or d <= 0 or abs(b) > 1e-3 or abs(c) > 1e-3: return None
+    if abs(fitz.Rect(info[0]['bbox']) & page.rect) < min_coverage * abs(page.rect): return None
+
+    xref, smask, doc = images[0][0], images[0][1], page.parent
+    size = page_render_size(page, target_dpi)
+    if images[0][8] == 'DCTDecode' and info[0]['colorspace'] in (1, 3) and not smask and doc.xref_get_key(xref, 'Decode')[0] == 'null':
+        # JPEG: the raw stream is the JPEG file; libjpeg downscales by 1/2..1/8 while decoding
+        image = Image.open(BytesIO(doc.xref_stream_raw(xref))); image.draft('RGB', (int(size[0] * 0.99), int(size[1] * 0.99)))
+        image.load()
+    else:
+        # JBIG2 / CCITT / Flate / JPX ...: decoded by MuPDF at native resolution, without rendering the page
+        pix = fitz.Pixmap(doc, xref)
+        if pix.alpha: pix = fitz.Pixmap(pix, 0)
+        if pix.n not in (1, 3): pix = fitz.Pixmap(fitz.csRGB, pix)
+        image = Image.frombytes('L' if pix.n == 1 else 'RGB', (pix.width, pix.height), pix.samples)
+    factor = min(image.width // size[0], image.height // size[1])
+    if factor >= 2: image = image.reduce(factor)
+    if max(abs(image.width - size[0]), abs(image.height - size[1])) <= 2:
+        # Rounding differences only: pad/crop on white instead of resampling
+        canvas = Image.new(image.mode, size, 'white'); canvas.paste(image); image = canvas
+    elif image.size != size:
+        image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+def fitz_doc_to_image(doc, target_dpi=200, origin_dpi=None, use_embedded=True):
+    if use_embedded:
+        try:
+            image = embedded_page_image(doc, target_dpi)
+            if image is not None: return image
+        except Exception:
+            pass  # fall back to rendering
     mat = fitz.Matrix(target_dpi / 72, target_dpi / 72)
     pm = doc.get_pixmap(matrix=mat, alpha=False)
     if pm.width > 4500 or pm.height > 4500:
@@ -79,6 +241,70 @@ def load_images_from_pdf(pdf_file, dpi=200, start_page_id=0, end_page_id=None):
             images.append(fitz_doc_to_image(page, target_dpi=dpi))
     return images
 
+# --- Text layer (born-digital PDF pages) ---
+
+_CJK_RE = re.compile(r'[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_LIST_ITEM_RE = re.compile(r'^\s*([\u2022\u00b7\u25aa\u25cf\u2013\-*]|\(?\d{1,3}[.)]|[a-zA-Z][.)])\s')
+
+def page_render_scale(page, dpi):
+    # Same size limit as fitz_doc_to_image
+    scale = dpi / 72
+    return scale if max(page.rect.width, page.rect.height) * scale <= 4500 else 1.0
+
+def page_render_size(page, dpi):
+    # Pixel size of the pixmap fitz_doc_to_image would render
+    rect = (page.rect * fitz.Matrix(page_render_scale(page, dpi), page_render_scale(page, dpi))).irect
+    return rect.width, rect.height
+
+def _bad_char(c):
+    o = ord(c)
+    return c == '\ufffd' or (o < 32 and c not in '\t\n\r') or 0xe000 <= o <= 0xf8ff
+
+def _join_text(a, b):
+    if not a or not b: return a + b
+    return a + b if _CJK_RE.match(a[-1]) or _CJK_RE.match(b[0]) else f"{a} {b}"
+
+def _text_layer_category(text, size, bold, top, bottom, page_height, body_size, title_seen):
+    if bottom < page_height * 0.06: return 'Page-header'
+    if top > page_height * 0.94: return 'Page-footer'
+    if size >= body_size * 1.5: return 'Section-header' if title_seen else 'Title'
+    if (size >= body_size * 1.15 or bold) and len(text) < 120 and '\n' not in text: return 'Section-header'
+    if _LIST_ITEM_RE.match(text): return 'List-item'
+    return 'Text'
+
+def text_layer_cells(page, dpi=200, min_chars=50, max_bad_char_ratio=0.01, max_drawings=20, first_page=False):
+    """Layout cells built from the PDF text layer, in the pixel space of the page rendered at dpi; None when the layer is not trustworthy"""
+    # Pages with images or heavy vector graphics (charts, ruled tables) need the model
+    if page.get_image_info() or len(page.get_drawings()) > max_drawings: return None
+    blocks = [b for b in page.get_text('dict', flags=fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP)['blocks'] if b['type'] == 0]
+    chars = ''.join(span['text'] for b in blocks for line in b['lines'] for span in line['spans'])
+    n_chars = len(chars.strip())
+    if n_chars < min_chars or sum(map(_bad_char, chars)) > n_chars * max_bad_char_ratio: return None
+
+    # Body font size = the size carrying most characters
+    size_chars = {}
+    for b in blocks:
+        for line in b['lines']:
+            for span in line['spans']: size_chars[round(span['size'], 1)] = size_chars.get(round(span['size'], 1), 0) + len(span['text'].strip())
+    body_size = max(size_chars, key=size_chars.get)
+
+    scale, cells, title_seen = page_render_scale(page, dpi), [], not first_page
+    for b in blocks:
+        spans = [span for line in b['lines'] for span in line['spans'] if span['text'].strip()]
+        if not spans: continue
+        size, bold = max(span['size'] for span in spans), all(span['flags'] & 16 for span in spans)
+        plain = '\n'.join(''.join(span['text'] for span in line['spans']).strip() for line in b['lines']).strip()
+        category = _text_layer_category(plain, size, bold, b['bbox'][1], b['bbox'][3], page.rect.height, body_size, title_seen)
+        title_seen = title_seen or category == 'Title'
+        text = ''
+        for line in b['lines']:
+            line_text = ''.join(f"**{span['text'].strip()}** " if span['flags'] & 16 and category in ('Text', 'List-item') and span['text'].strip() else span['text'] for span in line['spans']).strip()
+            text = _join_text(text, line_text)
+        if category == 'Title': text = f"# {text}"
+        elif category == 'Section-header': text = f"## {text}"
+        cells.append({'bbox': [int(round(v * scale)) for v in b['bbox']], 'category': category, 'text': text})
+    return cells
+
 # --- From image_utils.py ---
 
 def round_by_factor(number, factor): return round(number / factor) * factor
@@ -86,7 +312,7 @@ def ceil_by_factor(number, factor): return math.ceil(number / factor) * factor
 def floor_by_factor(number, factor): return math.floor(number / factor) * factor
 
 def smart_resize(height, width, factor=IMAGE_FACTOR, min_pixels=MIN_PIXELS, max_pixels=MAX_PIXELS):
-    if max(height, width) / min(height, width) > 200: raise ValueError("Aspect ratio too high")
+    if max(height, width) / min(height, width) > MAX_ASPECT_RATIO: raise ValueError("Aspect ratio too high")
     h_bar, w_bar = max(factor, round_by_factor(height, factor)), max(factor, round_by_factor(width, factor))
     if h_bar * w_bar > max_pixels:
         beta = math.sqrt((height * width) / max_pixels)
@@ -99,10 +325,92 @@ def smart_resize(height, width, factor=IMAGE_FACTOR, min_pixels=MIN_PIXELS, max_
             h_bar, w_bar = max(factor, floor_by_factor(h_bar / beta, factor)), max(factor, floor_by_factor(w_bar / beta, factor))
     return h_bar, w_bar
 
-def PILimage_to_base64(image, format='PNG'):
+def is_grayscale(image, tolerance=8):
+    if image.mode in ('1', 'L'): return True
+    scale = 256 / max(image.size)
+    thumb = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.NEAREST).convert('RGB')
+    r, g, b = thumb.split()
+    return max(ImageChops.difference(r, g).getextrema()[1], ImageChops.difference(g, b).getextrema()[1]) <= tolerance
+
+def blank_page_stats(image, margin=0.05, ink_delta=64):
+    # One grayscale histogram of the page without its margins (scan edges, punch holes); background = most common level
+    gray = image.convert('L')
+    mx, my = int(gray.width * margin), int(gray.height * margin)
+    hist = gray.crop((mx, my, gray.width - mx, gray.height - my)).histogram()
+    total = sum(hist) or 1
+    background = max(range(256), key=hist.__getitem__)
+    mean = sum(i * n for i, n in enumerate(hist)) / total
+    stddev = math.sqrt(sum(n * (i - mean) ** 2 for i, n in enumerate(hist)) / total)
+    return {'ink_ratio': sum(hist[:max(0, background - ink_delta)]) / total, 'stddev': stddev, 'background': background}
+
+def is_blank_page(image, margin=0.05, ink_delta=64, max_ink_ratio=0.0002, max_stddev=20.0):
+    stats = blank_page_stats(image, margin, ink_delta)
+    return stats['ink_ratio'] <= max_ink_ratio and stats['stddev'] <= max_stddev
+
+def page_perceptual_hash(image, hash_size=32, tolerance=2):
+    # Average hash of the page ink layout: the page downsampled to hash_size x hash_size gray cells, bit = cell darker than the
+    # median cell (paper) by more than tolerance. Layout of text blocks and lines separates document pages far better than a
+    # difference hash, whose gradients mostly follow scan noise on text pages. Returned as hex
+    cells = image.convert('L').resize((hash_size, hash_size), Image.BOX, reducing_gap=2.0).tobytes()
+    cut = sorted(cells)[len(cells) // 2] - tolerance
+    return f"{int(''.join('1' if v < cut else '0' for v in cells), 2):0{hash_size * hash_size // 4}x}"
+
+def hamming_distance(a, b): return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+_INK_ROW = bytes(48 if v <= 2 else 49 for v in range(256))  # profile byte -> b'0' / b'1' (row has more than ~1% ink)
+_INK_RUN_RE = re.compile(b'1+')
+
+def text_line_heights(image, strips=4, ink_delta=64, min_height=6):
+    # Text line heights (px) from the horizontal ink projection profile of each vertical strip of the page (strips keep the lines
+    # of side-by-side columns from merging). A short run close to a much taller one is a glyph part split off by thin strokes;
+    # runs lower than min_height are rules and specks
+    gray = image.convert('L')
+    hist = gray.reduce(4).histogram(); background = max(range(256), key=hist.__getitem__)
+    profile = gray.point(lambda v: 255 if v < background - ink_delta else 0).resize((strips, gray.height), Image.BOX).tobytes()
+    heights = []
+    for x in range(strips):
+        lines, prev = [], 0
+        for m in _INK_RUN_RE.finditer(profile[x::strips].translate(_INK_ROW)):
+            short, tall = sorted((prev, m.end() - m.start()))
+            if lines and short < tall / 2 and m.start() - lines[-1][1] < tall / 2: lines[-1][1] = m.end()
+            else: lines.append([m.start(), m.end()])
+            prev = m.end() - m.start()
+        heights += [end - start for start, end in lines if end - start >= min_height]
+    return heights
+
+def adaptive_max_pixels(image, max_pixels=MAX_PIXELS, min_pixels=MIN_PIXELS, target_line_height=10, min_scale=0.5, percentile=0.02, strips=4, min_lines=3):
+    """Per-page max_pixels: below the fixed budget when the small text lines of the page (low percentile of line heights) would
+    still be at least target_line_height px high; pages without enough text lines (photos, blank) keep max_pixels"""
+    heights = sorted(h for h in text_line_heights(image, strips) if h <= image.height / 10)
+    if len(heights) < min_lines: return max_pixels
+    base = min(max_pixels, image.width * image.height)  # what the fixed budget sends
+    line_height = heights[int(len(heights) * percentile)] * math.sqrt(base / (image.width * image.height))
+    scale = max(min_scale, min(1.0, target_line_height / line_height))
+    return max(min_pixels, int(base * scale * scale))
+
+def image_tokens(width, height, min_pixels=None, max_pixels=None, factor=IMAGE_FACTOR):
+    # Vision tokens of an image after smart_resize: one per factor x factor patch
+    h, w = smart_resize(height, width, factor, min_pixels or MIN_PIXELS, max_pixels or MAX_PIXELS)
+    return (h // factor) * (w // factor)
+
+def resolve_image_encoding(encoding):
+    if encoding is None: return {}
+    if isinstance(encoding, str):
+        if encoding not in IMAGE_ENCODING_PRESETS: raise ValueError(f"Unknown image encoding preset: {encoding}")
+        return dict(IMAGE_ENCODING_PRESETS[encoding])
+    return dict(encoding)
+
+def encode_image(image, format='PNG', quality=None, compress_level=None, grayscale=False):
+    if grayscale == 'auto': grayscale = is_grayscale(image)
+    if grayscale and image.mode != 'L': image = image.convert('L')
+    params = {k: v for k, v in (('quality', quality), ('compress_level', compress_level)) if v is not None}
     buffered = BytesIO()
-    image.save(buffered, format=format)
-    return f"data:image/{format.lower()};base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
+    image.save(buffered, format=format, **params)
+    return buffered.getvalue()
+
+def PILimage_to_base64(image, format='PNG', quality=None, compress_level=None, grayscale=False):
+    data = encode_image(image, format, quality, compress_level, grayscale)
+    return f"data:image/{format.lower()};base64,{base64.b64encode(data).decode('utf-8')}"
 
 def to_rgb(pil_image):
     if pil_image.mode == 'RGBA':
@@ -201,40 +509,487 @@ def layoutjson2md(image, cells, text_key='text', no_page_hf=False):
         else: items.append(clean_text(cell.get(text_key, '')))
     return '\n\n'.join(items)
 
+# --- Metrics (Prometheus text exposition format, no client library) ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+def _metric_labels(labels):
+    if not labels: return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+class Metrics:
+    """Process-wide counters and histograms; render() returns the Prometheus text format, gauges are passed in at scrape time"""
+    def __init__(self):
+        self.lock, self.meta, self.values = threading.Lock(), {}, {}
+
+    def counter(self, name, help):
+        self.meta[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self.meta[name] = ('histogram', help, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets, key = self.meta[name][2], (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(buckets) + 2))  # per-bucket counts, sum, count
+            i = next((i for i, bound in enumerate(buckets) if value <= bound), None)  # None: only in +Inf
+            if i is not None: counts[i] += 1
+            counts[-2] += value; counts[-1] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.time()
+        try: yield
+        finally: self.observe(name, time.time() - start, **labels)
+
+    def render(self, gauges=()):
+        # gauges: [(name, help, [(labels dict, value), ...])]
+        with self.lock: values = {k: (list(v) if isinstance(v, list) else v) for k, v in self.values.items()}
+        lines = []
+        for name, (kind, help, buckets) in self.meta.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name: continue
+                if kind == 'counter':
+                    lines.append(f"{name}{_metric_labels(labels)} {value}"); continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_metric_labels(labels + (('le', bound),))} {cumulative}")
+                lines += [f"{name}_bucket{_metric_labels(labels + (('le', '+Inf'),))} {value[-1]}",
+                          f"{name}_sum{_metric_labels(labels)} {value[-2]}", f"{name}_count{_metric_labels(labels)} {value[-1]}"]
+        for name, help, samples in gauges:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{_metric_labels(tuple(sorted(labels.items())))} {value}" for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+METRICS.histogram('dots_ocr_encode_seconds', "Image encoding for an inference request, by transport")
+METRICS.histogram('dots_ocr_inference_seconds', "Inference request attempts, by backend and status (ok or the error class)")
+METRICS.histogram('dots_ocr_postprocess_seconds', "Parsing and post-processing of the model output")
+METRICS.histogram('dots_ocr_layout_draw_seconds', "Drawing and saving the layout image of a page")
+METRICS.counter('dots_ocr_request_bytes_total', "Request body bytes sent to the inference backends, by transport")
+
 # ==============================================================================
 # SECTION 4: INFERENCE (from model.inference)
 # ==============================================================================
 
 import time
 
-def inference_with_vllm(image, prompt, ip="localhost", port=8000, temperature=0.1, top_p=0.9, max_completion_tokens=32768, model_name='dots-ocr', timeout=600.0, max_retries=3):
-    client = OpenAI(api_key="EMPTY", base_url=f"http://{ip}:{port}/v1")
-    messages = [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": PILimage_to_base64(image)}}, {"type": "text", "text": f"<|img|><|imgpad|><|endofimg|>{prompt}"}]}]
-    
-    for attempt in range(max_retries):
+# --- Image transport ---
+# 'base64': image embedded in the request as a data URL (default)
+# 'stream': same request, but the JSON body is written to the socket with the image base64-encoded chunk by chunk
+# 'file':   image written to a media directory shared with the server (vLLM --allowed-local-media-path), request carries only its URL
+
+IMAGE_TRANSPORTS = ('base64', 'stream', 'file')
+STREAM_CHUNK_SIZE = 3 * 64 * 1024  # multiple of 3 so chunks concatenate into one valid base64 string
+_IMAGE_PLACEHOLDER = '__DOTS_OCR_IMAGE__'
+
+def post_chat_completion_streaming(image_data, image_format, prompt, ip, port, model_name, max_completion_tokens, temperature, top_p, timeout, cancel=None, image_url=None, stats=None):
+    # Only the encoded image and one base64 chunk are in memory; the data URL and the full JSON body are never built
+    # (image_url: a URL sent as is instead of image_data, for the file transport; stats: receives payload_bytes, ttft and usage)
+    stats = stats if stats is not None else {}
+    content = [{"type": "image_url", "image_url": {"url": image_url or _IMAGE_PLACEHOLDER}}, {"type": "text", "text": f"<|img|><|imgpad|><|endofimg|>{prompt}"}]
+    envelope = json.dumps({"model": model_name, "messages": [{"role": "user", "content": content}], "max_tokens": max_completion_tokens, "temperature": temperature, "top_p": top_p}, ensure_ascii=False).encode('utf-8')
+    if image_url:
+        head, tail, data = envelope, b'', memoryview(b'')
+    else:
+        head, tail = envelope.split(_IMAGE_PLACEHOLDER.encode('utf-8'), 1)
+        head += f"data:image/{image_format.lower()};base64,".encode('utf-8')
+        data = memoryview(image_data)
+    conn = http.client.HTTPConnection(ip, port, timeout=timeout)
+    try:
+        if cancel:
+            # Connect first so the socket is attached before anything is sent; a closed connection would silently reopen
+            conn.connect(); cancel.attach(conn)
+            if cancel.cancelled: raise ConnectionAbortedError("Request cancelled")
+        start = time.time()
+        conn.putrequest('POST', '/v1/chat/completions')
+        conn.putheader('Content-Type', 'application/json')
+        conn.putheader('Authorization', 'Bearer EMPTY')
+        length = len(head) + 4 * ((len(data) + 2) // 3) + len(tail)
+        conn.putheader('Content-Length', str(length))
+        conn.endheaders()
+        conn.send(head)
+        for i in range(0, len(data), STREAM_CHUNK_SIZE): conn.send(base64.b64encode(data[i:i + STREAM_CHUNK_SIZE]))
+        conn.send(tail)
+        METRICS.inc('dots_ocr_request_bytes_total', length, transport='file' if image_url else 'stream')
+        stats['payload_bytes'] = stats.get('payload_bytes', 0) + length
+        # Time to the response headers: the answer is not streamed, so this is the first token only as seen by the client
+        resp = conn.getresponse(); stats['ttft'] = time.time() - start
+        body = resp.read()
+        if resp.status != 200: raise InferenceHTTPError(resp.status, body[:200].decode('utf-8', 'replace'), resp.getheader('Retry-After'))
+        answer = json.loads(body)
+        stats['usage'] = answer.get('usage') or {}
+        return answer['choices'][0]['message']['content']
+    finally:
+        conn.close()
+
+def write_media_file(data, format, media_dir):
+    os.makedirs(media_dir, exist_ok=True)
+    path = os.path.join(media_dir, f"{uuid.uuid4().hex}.{format.lower()}")
+    with open(path, 'wb') as f: f.write(data)
+    return path
+
+def media_file_url(path, media_url=None):
+    # media_url: how the server sees media_dir (e.g. file:///workspace/media inside the vLLM container); defaults to the local path
+    return f"{media_url.rstrip('/')}/{os.path.basename(path)}" if media_url else Path(os.path.abspath(path)).as_uri()
+
+# --- Backends and token-budget admission ---
+# vLLM schedules by tokens, not by requests: a request holds its image tokens (one per 28x28 patch of the smart_resize image),
+# the prompt text and up to max_tokens of output in the KV cache. Requests are admitted per backend against a token budget
+# instead of a fixed count, so a burst of large pages cannot overcommit the cache and trigger preemption and recompute.
+
+PROMPT_TEXT_TOKENS = 256  # prompt text + chat template, upper bound
+
+def estimate_prompt_tokens(width, height, factor=IMAGE_FACTOR): return (width // factor) * (height // factor) + PROMPT_TEXT_TOKENS
+
+class Backend:
+    def __init__(self, ip, port, token_budget=None):
+        self.ip, self.port, self.token_budget = ip, int(port), token_budget
+        self.in_flight, self.tokens_in_flight = 0, 0
+
+    def __str__(self): return f"{self.ip}:{self.port}"
+
+    def free_tokens(self): return (self.token_budget - self.tokens_in_flight) if self.token_budget else -self.in_flight
+
+    def fits(self, tokens): return not self.token_budget or self.in_flight == 0 or self.tokens_in_flight + tokens <= self.token_budget
+
+class BackendPool:
+    """Inference backends ("host:port" or (host, port)); admit() waits until one has room for a request's tokens and picks the one
+    with the most free budget. Waiting requests are admitted in arrival order; a request larger than the budget runs alone"""
+    def __init__(self, backends, token_budget=None, max_model_len=None):
+        self.backends = [Backend(*(b.rsplit(':', 1) if isinstance(b, str) else b), token_budget=token_budget) for b in backends]
+        if not self.backends: raise ValueError("At least one inference backend is required")
+        self.max_model_len = max_model_len
+        self.cond, self.waiting = threading.Condition(), deque()
+
+    def completion_tokens(self, prompt_tokens, max_completion_tokens):
+        # max_tokens capped so prompt + output fit --max-model-len (vLLM rejects the request otherwise)
+        if not self.max_model_len: return max_completion_tokens
+        if prompt_tokens >= self.max_model_len: raise ValueError(f"Image needs {prompt_tokens} prompt tokens, over max_model_len {self.max_model_len}")
+        return min(max_completion_tokens, self.max_model_len - prompt_tokens)
+
+    def acquire(self, tokens, exclude=(), wait=True):
+        # Backend admitted for tokens (release() it afterwards); wait=False returns None instead of queueing
+        ticket = object()
+        with self.cond:
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    backend = self.waiting[0] is ticket and max((b for b in self.backends if b not in exclude and b.fits(tokens)), key=Backend.free_tokens, default=None)
+                    if backend or not wait: break
+                    self.cond.wait()
+            finally:
+                self.waiting.remove(ticket); self.cond.notify_all()
+            if not backend: return None
+            backend.in_flight += 1; backend.tokens_in_flight += tokens
+            return backend
+
+    def release(self, backend, tokens):
+        with self.cond:
+            backend.in_flight -= 1; backend.tokens_in_flight -= tokens; self.cond.notify_all()
+
+    @contextmanager
+    def admit(self, tokens):
+        backend = self.acquire(tokens)
         try:
-            resp = client.chat.completions.create(messages=messages, model=model_name, max_tokens=max_completion_tokens, temperature=temperature, top_p=top_p, timeout=timeout)
-            return resp.choices[0].message.content
-        except Exception as e:
-            print(f"Request error (attempt {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2)  # Wait 2 seconds before retrying
-            else:
-                return None
+            yield backend
+        finally:
+            self.release(backend, tokens)
+
+    def status(self):
+        with self.cond:
+            return {'waiting': len(self.waiting), 'backends': [{'backend': str(b), 'in_flight': b.in_flight, 'tokens_in_flight': b.tokens_in_flight, 'token_budget': b.token_budget} for b in self.backends]}
+
+# --- Hedged requests ---
+# With several backends, a request in flight for longer than a percentile of recent latencies is duplicated on another backend;
+# the first answer wins and the other request is cancelled by closing its connection (vLLM aborts requests whose client is gone).
+
+class RequestCancel:
+    """Cancels an in-flight request from another thread by shutting down the connections attached to it"""
+    def __init__(self):
+        self.cancelled, self._conns, self._lock, self._event = False, [], threading.Lock(), threading.Event()
+
+    def attach(self, conn):
+        with self._lock:
+            self._conns.append(conn)
+            if self.cancelled: self._close(conn)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True; self._event.set()
+            for conn in self._conns: self._close(conn)
+
+    def sleep(self, seconds):
+        # Backoff between retries that returns early when cancelled
+        self._event.wait(seconds)
+
+    @staticmethod
+    def _close(conn):
+        # shutdown() wakes a thread blocked reading the socket, close() alone does not
+        try:
+            if getattr(conn, 'sock', None): conn.sock.shutdown(socket.SHUT_RDWR)
+            conn.close()
+        except Exception:
+            pass
+
+class LatencyTracker:
+    """Sliding window of recent request latencies (seconds)"""
+    def __init__(self, window=200):
+        self.samples, self.lock = deque(maxlen=window), threading.Lock()
+
+    def add(self, seconds):
+        with self.lock: self.samples.append(seconds)
+
+    def percentile(self, q, min_samples=20):
+        with self.lock:
+            if len(self.samples) < min_samples: return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+# --- Retries ---
+
+class InferenceHTTPError(RuntimeError):
+    def __init__(self, status, body='', retry_after=None):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status, self.retry_after = status, retry_after
+
+def parse_retry_after(value):
+    # Retry-After is either delay-seconds or an HTTP date
+    if value is None: return None
+    try: return max(0.0, float(value))
+    except ValueError: pass
+    try: return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError): return None
+
+class RetryPolicy:
+    """Error classification, exponential backoff with full jitter and a process-wide retry budget.
+
+    Every first attempt deposits budget_ratio tokens (up to budget_burst) and every retry spends one, so under
+    overload retries stay a fixed fraction of traffic instead of multiplying it."""
+    RETRYABLE = ('timeout', 'connection', 'throttled', 'server', 'other')
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=60.0, budget_ratio=0.2, budget_burst=20):
+        self.max_attempts, self.base_delay, self.max_delay = max_attempts, base_delay, max_delay
+        self.budget_ratio, self.budget_burst = budget_ratio, budget_burst
+        self.tokens, self.lock = float(budget_burst), threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'budget_denied': 0, 'failed': 0, 'errors': {}}
+
+    @staticmethod
+    def classify(exc):
+        # -> (error class, Retry-After seconds or None)
+        status, retry_after = None, None
+        if isinstance(exc, InferenceHTTPError): status, retry_after = exc.status, exc.retry_after
+        elif isinstance(exc, APIStatusError): status, retry_after = exc.status_code, exc.response.headers.get('retry-after')
+        if status is not None:
+            kind = 'throttled' if status == 429 else 'server' if status >= 500 else 'timeout' if status == 408 else 'client'
+            return kind, parse_retry_after(retry_after)
+        if isinstance(exc, (APITimeoutError, TimeoutError)): return 'timeout', None
+        if isinstance(exc, (APIConnectionError, ConnectionError, http.client.HTTPException, OSError)): return 'connection', None
+        return 'other', None
+
+    def delay(self, attempt, retry_after=None):
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(self.max_delay, max(backoff, retry_after or 0))
+
+    def start(self):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.tokens = min(self.budget_burst, self.tokens + self.budget_ratio)
+
+    def should_retry(self, kind, attempt, max_attempts=None):
+        # Records the error; True when the request may be retried (attempt: 0-based index of the failed attempt)
+        with self.lock:
+            self.stats['errors'][kind] = self.stats['errors'].get(kind, 0) + 1
+            if kind not in self.RETRYABLE or attempt + 1 >= (max_attempts or self.max_attempts):
+                self.stats['failed'] += 1; return False
+            if self.tokens < 1:
+                self.stats['budget_denied'] += 1; self.stats['failed'] += 1; return False
+            self.tokens -= 1; self.stats['retries'] += 1
+            return True
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, errors=dict(self.stats['errors']), budget=round(self.tokens, 2))
+
+DEFAULT_RETRY_POLICY = RetryPolicy()  # shared by all requests of the process unless one is passed explicitly
+
+def inference_with_vllm(image, prompt, ip="localhost", port=8000, temperature=0.1, top_p=0.9, max_completion_tokens=32768, model_name='dots-ocr', timeout=600.0, max_retries=None, image_encoding=None, image_transport='base64', media_dir=None, media_url=None, cancel=None, retry_policy=None, stats=None, on_retry=None):
+    # max_retries: overrides the policy's max_attempts; on_retry: called with kind, attempt, delay and error before each retry; stats: dict receiving 'attempts', 'retries' and 'errors' (error class counts) of this request,
+    # and the encode / last attempt ('request') / time to first byte ('ttft') durations, payload_bytes and the API usage
+    policy = retry_policy or DEFAULT_RETRY_POLICY
+    max_attempts = max_retries or policy.max_attempts
+    stats = stats if stats is not None else {}
+    stats.setdefault('attempts', 0); stats.setdefault('retries', 0); stats.setdefault('errors', {})
+    client = OpenAI(api_key="EMPTY", base_url=f"http://{ip}:{port}/v1", max_retries=0)  # retries are handled by the RetryPolicy below
+    encoding = resolve_image_encoding(image_encoding)
+    image_format = encoding.get('format', 'PNG')
+    # Cancellable requests always go through http.client: the OpenAI client cannot be interrupted from another thread
+    direct = image_transport == 'stream' or cancel is not None
+    media_path, image_data, image_url, messages = None, None, None, None
+    start = time.time()
+    if image_transport == 'file':
+        media_path = write_media_file(encode_image(image, **encoding), image_format, media_dir)
+        image_url = media_file_url(media_path, media_url)
+    elif direct:
+        image_data = encode_image(image, **encoding)
+    else:
+        image_url = PILimage_to_base64(image, **encoding)
+    stats['encode'] = time.time() - start
+    METRICS.observe('dots_ocr_encode_seconds', stats['encode'], transport=image_transport)
+    if not direct:
+        messages = [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url}}, {"type": "text", "text": f"<|img|><|imgpad|><|endofimg|>{prompt}"}]}]
+    
+    try:
+        policy.start()
+        for attempt in range(max_attempts):
+            if cancel and cancel.cancelled: return None
+            stats['attempts'] += 1
+            start = time.time()
+            try:
+                if direct:
+                    content = post_chat_completion_streaming(image_data, image_format, prompt, ip, port, model_name, max_completion_tokens, temperature, top_p, timeout, cancel, image_url, stats)
+                else:
+                    payload = len(image_url) + len(prompt)  # approximate: image URL and prompt
+                    METRICS.inc('dots_ocr_request_bytes_total', payload, transport=image_transport)
+                    stats['payload_bytes'] = stats.get('payload_bytes', 0) + payload
+                    resp = client.chat.completions.create(messages=messages, model=model_name, max_tokens=max_completion_tokens, temperature=temperature, top_p=top_p, timeout=timeout)
+                    stats['usage'] = resp.usage.model_dump() if resp.usage else {}
+                    content = resp.choices[0].message.content
+                stats['request'] = time.time() - start
+                METRICS.observe('dots_ocr_inference_seconds', stats['request'], backend=f"{ip}:{port}", status='ok')
+                return content
+            except Exception as e:
+                stats['request'] = time.time() - start
+                if cancel and cancel.cancelled:
+                    METRICS.observe('dots_ocr_inference_seconds', stats['request'], backend=f"{ip}:{port}", status='cancelled')
+                    return None
+                kind, retry_after = policy.classify(e)
+                METRICS.observe('dots_ocr_inference_seconds', stats['request'], backend=f"{ip}:{port}", status=kind)
+                stats['errors'][kind] = stats['errors'].get(kind, 0) + 1; stats['error'] = kind
+                if policy.should_retry(kind, attempt, max_attempts):
+                    wait = policy.delay(attempt, retry_after)
+                    print(f"Request error [{kind}] (attempt {attempt+1}/{max_attempts}), retrying in {wait:.1f}s: {e}")
+                    stats['retries'] += 1
+                    if on_retry: on_retry(kind=kind, attempt=attempt + 1, delay=wait, error=str(e))
+                    if cancel: cancel.sleep(wait)
+                    else: time.sleep(wait)
+                else:
+                    print(f"Request error [{kind}] (attempt {attempt+1}/{max_attempts}), giving up: {e}")
+                    return None
+    finally:
+        if media_path and os.path.exists(media_path): os.remove(media_path)
+
+# --- Per-page telemetry (written with each page result, e.g. the parse_file JSONL) ---
+# timings (seconds): render, resize, queue_wait (backend admission), encode, request (last attempt), ttft (time to the response
+# headers), postprocess, draw_save; with region OCR the request phases are summed over the requests of the page
+
+REQUEST_TIMINGS = ('queue_wait', 'encode', 'request', 'ttft')
+
+def add_request_telemetry(result, stats):
+    # Adds the timings, payload bytes and token usage of one request (stats from DotsOCRParser._infer) to a page result
+    for name in REQUEST_TIMINGS:
+        if stats.get(name) is not None: result['timings'][name] = result['timings'].get(name, 0) + stats[name]
+    result['payload_bytes'] += stats.get('payload_bytes', 0)
+    for name in ('prompt_tokens', 'completion_tokens'):
+        value = (stats.get('usage') or {}).get(name)
+        if value is not None: result[name] = (result[name] or 0) + value
+
+def round_timings(timings): return {name: round(value, 4) for name, value in timings.items()}
 
 # ==============================================================================
 # SECTION 5: MAIN PARSER CLASS (from parser.py)
 # ==============================================================================
 
+# Parser events: callbacks subscribed with DotsOCRParser.on() run in the thread that processes the page and get keyword arguments,
+# page_idx, save_dir and save_name for every event, plus:
+#   page_started:  -
+#   page_finished: result (with its timings), elapsed
+#   page_failed:   error, result (None when the page raised)
+#   retry:         kind (error class), attempt, delay, error
+PARSER_EVENTS = ('page_started', 'page_finished', 'page_failed', 'retry')
+
+# Region OCR: tables and formulas keep the output format of the full-page layout prompt (HTML / LaTeX), other regions are plain text
+REGION_PROMPTS = {
+    'Table': "Extract the table in this image. Format it as HTML, with no other text.",
+    'Formula': "Extract the formula in this image. Format it as LaTeX, with no other text.",
+}
+_CODE_FENCE_RE = re.compile(r'^```[\w-]*\s*\n?(.*?)\n?```$', re.S)
+
+def region_text(category, response):
+    # The reply of a region request in the form the layout prompt gives for the category (fences removed, formulas as $$...$$)
+    text = response.strip()
+    m = _CODE_FENCE_RE.match(text)
+    if m: text = m.group(1).strip()
+    if category == 'Formula' and not text.startswith('$'): text = f"$${text}$$"
+    return text
+
+def region_box(bbox, size):
+    # A layout bbox clamped to the image as an integer crop box; None when it is malformed, empty after clamping or too elongated to resize
+    try: x1, y1, x2, y2 = (int(round(float(v))) for v in bbox)
+    except (TypeError, ValueError): return None
+    width, height = size
+    x1, x2 = max(0, min(x1, width)), max(0, min(x2, width))
+    y1, y2 = max(0, min(y1, height)), max(0, min(y2, height))
+    if x2 <= x1 or y2 <= y1 or max(x2 - x1, y2 - y1) / min(x2 - x1, y2 - y1) > MAX_ASPECT_RATIO: return None
+    return x1, y1, x2, y2
+
 class DotsOCRParser:
-    def __init__(self, ip='localhost', port=8000, model_name='dots-ocr', temperature=0.1, top_p=1.0, max_completion_tokens=16384, num_thread=64, dpi=200, output_dir="./output", min_pixels=None, max_pixels=None, timeout=600.0):
+    def __init__(self, ip='localhost', port=8000, model_name='dots-ocr', temperature=0.1, top_p=1.0, max_completion_tokens=16384, num_thread=64, dpi=200, output_dir="./output", min_pixels=None, max_pixels=None, timeout=600.0, image_encoding=None, image_transport='base64', media_dir=None, media_url=None, skip_blank=False, blank_thresholds=None, use_text_layer=False, text_layer_thresholds=None, order_by_cost=False, backends=None, token_budget=None, max_model_len=None, adaptive_pixels=False, adaptive_pixel_thresholds=None, hedging=False, hedge_percentile=0.95, hedge_budget=0.05, hedge_min_delay=5.0, retry_policy=None, region_ocr=False):
         self.ip, self.port, self.model_name = ip, port, model_name
+        # backends: several vLLM replicas addressed directly (default: ip:port); token_budget: tokens admitted at once per backend
+        self.backend_pool = BackendPool(backends or [(ip, port)], token_budget, max_model_len)
+        # hedging: duplicate requests slower than hedge_percentile of recent latencies on another backend, at most hedge_budget of all requests
+        self.hedging, self.hedge_percentile, self.hedge_budget, self.hedge_min_delay = hedging, hedge_percentile, hedge_budget, hedge_min_delay
+        self.latencies = LatencyTracker()
+        self.hedge_stats, self.hedge_lock = {'requests': 0, 'hedged': 0, 'hedge_won': 0}, threading.Lock()
+        self.retry_policy = retry_policy or DEFAULT_RETRY_POLICY
         self.temperature, self.top_p, self.max_completion_tokens = temperature, top_p, max_completion_tokens
         self.num_thread, self.dpi, self.output_dir = num_thread, dpi, output_dir
         self.min_pixels, self.max_pixels, self.timeout = min_pixels, max_pixels, timeout
+        self.image_encoding = resolve_image_encoding(image_encoding)
+        self.image_transport, self.media_dir, self.media_url = image_transport, media_dir, media_url
+        if image_transport not in IMAGE_TRANSPORTS: raise ValueError(f"Unknown image transport: {image_transport}")
+        if image_transport == 'file' and not media_dir: raise ValueError("image_transport='file' requires media_dir")
+        self.skip_blank, self.blank_thresholds = skip_blank, {**BLANK_PAGE_THRESHOLDS, **(blank_thresholds or {})}
+        self.use_text_layer, self.text_layer_thresholds = use_text_layer, {**TEXT_LAYER_THRESHOLDS, **(text_layer_thresholds or {})}
+        self.order_by_cost = order_by_cost
+        self.adaptive_pixels, self.adaptive_pixel_thresholds = adaptive_pixels, {**ADAPTIVE_PIXELS_THRESHOLDS, **(adaptive_pixel_thresholds or {})}
+        # region_ocr: layout first, then the text of each region from its crop (many short requests instead of one long one)
+        self.region_ocr = region_ocr
+        self.listeners, self.listeners_lock = {}, threading.Lock()  # event -> tuple of callbacks, replaced on subscribe so emit() needs no lock
         if min_pixels: assert min_pixels >= MIN_PIXELS
         if max_pixels: assert max_pixels <= MAX_PIXELS
 
+    def escalated(self, **overrides):
+        """Copy of the parser with some settings replaced (e.g. timeout, max_completion_tokens, region_ocr); backends, latencies, the retry budget and event subscribers are shared"""
+        parser = copy.copy(self)
+        for name, value in overrides.items():
+            if not hasattr(parser, name): raise AttributeError(f"Unknown parser setting: {name}")
+            setattr(parser, name, value)
+        return parser
+
+    def on(self, event, callback):
+        # Subscribes callback to one of PARSER_EVENTS; returns it, so it can be used as a decorator
+        if event not in PARSER_EVENTS: raise ValueError(f"Unknown parser event: {event}")
+        with self.listeners_lock: self.listeners[event] = self.listeners.get(event, ()) + (callback,)
+        return callback
+
+    def off(self, event, callback):
+        with self.listeners_lock: self.listeners[event] = tuple(c for c in self.listeners.get(event, ()) if c is not callback)
+
+    def emit(self, event, **payload):
+        # Costs a dict lookup when nobody is subscribed; a failing callback is reported and does not affect the page
+        for callback in self.listeners.get(event, ()):
+            try: callback(**payload)
+            except Exception as e: print(f"Error in {event} callback {getattr(callback, '__name__', callback)}: {e}")
+
     def get_prompt(self, prompt_mode, bbox=None, origin_image=None, image=None, min_pixels=None, max_pixels=None):
         prompt = dict_promptmode_to_prompt[prompt_mode]
         if prompt_mode == 'prompt_grounding_ocr' and bbox:
@@ -243,23 +998,58 @@ class DotsOCRParser:
         return prompt
 
     def _parse_single_image(self, origin_image, prompt_mode, save_dir, save_name, source="image", page_idx=0, bbox=None, fitz_preprocess=False):
+        page, start = {'page_idx': page_idx, 'save_dir': save_dir, 'save_name': save_name}, time.time()
+        self.emit('page_started', **page)
+        try:
+            result = self._parse_page(origin_image, prompt_mode, save_dir, save_name, source, page_idx, bbox, fitz_preprocess, page)
+        except Exception as e:
+            self.emit('page_failed', **page, error=str(e), result=None)
+            raise
+        if result.get('request_error'): self.emit('page_failed', **page, error=result['request_error'], result=result)
+        else: self.emit('page_finished', **page, result=result, elapsed=time.time() - start)
+        return result
+
+    def _parse_page(self, origin_image, prompt_mode, save_dir, save_name, source="image", page_idx=0, bbox=None, fitz_preprocess=False, page=None):
+        # page: event payload of the page, for the retry events of its requests
         min_p, max_p = self.min_pixels, self.max_pixels
         if prompt_mode == "prompt_grounding_ocr": min_p, max_p = min_p or MIN_PIXELS, max_p or MAX_PIXELS
+        s_name = f"{save_name}_page_{page_idx}" if source == 'pdf' else save_name
+        if self.region_ocr and prompt_mode == 'prompt_layout_all_en': return self._parse_regions(origin_image, save_dir, s_name, page_idx, page)
         
+        # Blank / near-blank pages get an empty result without an inference request
+        if self.skip_blank and prompt_mode != "prompt_grounding_ocr" and is_blank_page(origin_image, **self.blank_thresholds):
+            return self._save_cells_result([], origin_image.width, origin_image.height, save_dir, s_name, page_idx, skipped_blank=True, route='blank')
+        
+        fixed_tokens = image_tokens(origin_image.width, origin_image.height, min_p, max_p)
+        start = time.time()
+        # Per-page pixel budget: pages whose smallest text is large are sent smaller (fewer image tokens to prefill)
+        if self.adaptive_pixels and prompt_mode != "prompt_grounding_ocr" and not (source == 'image' and fitz_preprocess):
+            max_p = adaptive_max_pixels(origin_image, max_p or MAX_PIXELS, min_p or MIN_PIXELS, **self.adaptive_pixel_thresholds)
         image = get_image_by_fitz_doc(origin_image, self.dpi) if source=='image' and fitz_preprocess else fetch_image(origin_image, min_p, max_p)
+        timings = {'resize': time.time() - start}
         prompt = self.get_prompt(prompt_mode, bbox, origin_image, image, min_p, max_p)
-        response = inference_with_vllm(image, prompt, self.ip, self.port, self.temperature, self.top_p, self.max_completion_tokens, self.model_name, self.timeout)
+        prompt_tokens = estimate_prompt_tokens(image.width, image.height)
+        max_tokens = self.backend_pool.completion_tokens(prompt_tokens, self.max_completion_tokens)
+        response, backend, hedged, request_stats = self._infer(image, prompt, prompt_tokens + max_tokens, max_tokens, page)
         
-        result = {'page_no': page_idx, 'input_height': image.height, 'input_width': image.width}
-        s_name = f"{save_name}_page_{page_idx}" if source == 'pdf' else save_name
+        result = {'page_no': page_idx, 'input_height': image.height, 'input_width': image.width, 'skipped_blank': False, 'route': 'model', 'backend': backend, 'hedged': hedged,
+                  'retries': request_stats['retries'], 'request_errors': request_stats['errors'], 'request_error': request_stats.get('error') if response is None else None,
+                  'image_tokens': (image.width // IMAGE_FACTOR) * (image.height // IMAGE_FACTOR), 'fixed_image_tokens': fixed_tokens,
+                  'payload_bytes': 0, 'prompt_tokens': None, 'completion_tokens': None, 'timings': timings}
+        add_request_telemetry(result, request_stats)
         
+        start = time.time()
         cells, filtered = post_process_output(response, prompt_mode, origin_image, image, min_p, max_p)
+        timings['postprocess'] = time.time() - start
+        METRICS.observe('dots_ocr_postprocess_seconds', timings['postprocess'])
         
+        start = time.time()
         if filtered:
             md_content = cells
         else:
             img_layout = draw_layout_on_image(origin_image, cells)
             img_layout_path = os.path.join(save_dir, f"{s_name}.jpg"); img_layout.save(img_layout_path)
+            METRICS.observe('dots_ocr_layout_draw_seconds', time.time() - start)
             result.update({'layout_info_path': os.path.join(save_dir, f"{s_name}.json"), 'layout_image_path': img_layout_path})
             with open(result['layout_info_path'], 'w', encoding='utf-8') as f: json.dump(cells, f, ensure_ascii=False)
             if prompt_mode != "prompt_layout_only_en": md_content = layoutjson2md(origin_image, cells)
@@ -267,23 +1057,159 @@ class DotsOCRParser:
 
         md_path = os.path.join(save_dir, f"{s_name}.md");
         with open(md_path, "w", encoding="utf-8") as f: f.write(md_content)
-        result.update({'md_content_path': md_path, 'filtered': filtered})
+        timings['draw_save'] = time.time() - start
+        result.update({'md_content_path': md_path, 'filtered': filtered, 'timings': round_timings(timings)})
+        return result
+
+    def _parse_regions(self, origin_image, save_dir, s_name, page_idx, page=None):
+        # Region OCR: a layout-only request, then one text request per region crop (pictures are kept as crops)
+        result = self._parse_page(origin_image, 'prompt_layout_only_en', save_dir, s_name, page_idx=page_idx, page=page)
+        if result.get('filtered') or result.get('skipped_blank'): return result
+        with open(result['layout_info_path'], 'r', encoding='utf-8') as f: cells = json.load(f)
+        result.update({'region_ocr': True, 'request_errors': dict(result['request_errors'])})
+        for cell in cells:
+            if cell['category'] == 'Picture': continue
+            box = region_box(cell.get('bbox'), origin_image.size)
+            if box is None: result['skipped_regions'] = result.get('skipped_regions', 0) + 1; continue  # cell keeps what the layout pass gave
+            crop = fetch_image(origin_image.crop(box), self.min_pixels or MIN_PIXELS, self.max_pixels or MAX_PIXELS)
+            prompt_tokens = estimate_prompt_tokens(crop.width, crop.height)
+            max_tokens = self.backend_pool.completion_tokens(prompt_tokens, self.max_completion_tokens)
+            prompt = REGION_PROMPTS.get(cell['category'], dict_promptmode_to_prompt['prompt_ocr'])
+            response, _, _, stats = self._infer(crop, prompt, prompt_tokens + max_tokens, max_tokens, page)
+            result['retries'] += stats['retries']; result['image_tokens'] += (crop.width // IMAGE_FACTOR) * (crop.height // IMAGE_FACTOR)
+            add_request_telemetry(result, stats)
+            for kind, n in stats['errors'].items(): result['request_errors'][kind] = result['request_errors'].get(kind, 0) + n
+            if response is None:
+                result.update({'request_error': stats.get('error'), 'filtered': True, 'timings': round_timings(result['timings'])})
+                with open(result['md_content_path'], 'w', encoding='utf-8') as f: f.write("Error: Model returned None (Request failed)")
+                return result
+            cell['text'] = region_text(cell['category'], response)
+        with open(result['layout_info_path'], 'w', encoding='utf-8') as f: json.dump(cells, f, ensure_ascii=False)
+        with open(result['md_content_path'], 'w', encoding='utf-8') as f: f.write(layoutjson2md(origin_image, cells))
+        result['timings'] = round_timings(result['timings'])
+        return result
+
+    def _request(self, backend, image, prompt, max_tokens, cancel=None, stats=None, on_retry=None):
+        return inference_with_vllm(image, prompt, backend.ip, backend.port, self.temperature, self.top_p, max_tokens, self.model_name, self.timeout, image_encoding=self.image_encoding, image_transport=self.image_transport, media_dir=self.media_dir, media_url=self.media_url, cancel=cancel, retry_policy=self.retry_policy, stats=stats, on_retry=on_retry)
+
+    def _hedge_delay(self):
+        # In-flight time after which a request is duplicated; None when hedging is off or there is no latency history yet
+        if not self.hedging or len(self.backend_pool.backends) < 2: return None
+        with self.hedge_lock: self.hedge_stats['requests'] += 1
+        latency = self.latencies.percentile(self.hedge_percentile)
+        return None if latency is None else max(self.hedge_min_delay, latency)
+
+    def _infer(self, image, prompt, tokens, max_tokens, page=None):
+        """One inference request, returns (response, backend, hedged, stats); a hedged request races a duplicate on another backend"""
+        start, delay = time.time(), self._hedge_delay()
+        on_retry = (lambda **info: self.emit('retry', **page, **info)) if page is not None and self.listeners.get('retry') else None
+        if delay is None:
+            stats = {}
+            with self.backend_pool.admit(tokens) as backend:
+                stats['queue_wait'] = time.time() - start
+                response = self._request(backend, image, prompt, max_tokens, stats=stats, on_retry=on_retry)
+            if response is not None: self.latencies.add(time.time() - start)
+            return response, str(backend), False, stats
+
+        finished, attempts = threading.Condition(), []
+        def run(attempt):
+            try: attempt['response'] = self._request(attempt['backend'], image, prompt, max_tokens, attempt['cancel'], attempt['stats'], on_retry)
+            except Exception: attempt['response'] = None
+            finally:
+                self.backend_pool.release(attempt['backend'], tokens)
+                with finished: attempt['done'] = True; finished.notify_all()
+        def launch(backend):
+            attempts.append({'backend': backend, 'cancel': RequestCancel(), 'response': None, 'done': False, 'stats': {}})
+            threading.Thread(target=run, args=(attempts[-1],), daemon=True).start()
+
+        launch(self.backend_pool.acquire(tokens))
+        queue_wait = time.time() - start
+        with finished:
+            finished.wait_for(lambda: attempts[0]['done'], timeout=delay)
+            if not attempts[0]['done']:
+                # The budget is taken when the duplicate is sent, so concurrent slow requests cannot all pass the check
+                with self.hedge_lock:
+                    other = self.hedge_stats['hedged'] < self.hedge_budget * self.hedge_stats['requests'] and self.backend_pool.acquire(tokens, exclude=(attempts[0]['backend'],), wait=False)
+                    if other: self.hedge_stats['hedged'] += 1
+                if other: launch(other)
+            # First successful answer wins; None only when every attempt failed
+            finished.wait_for(lambda: any(a['done'] and a['response'] is not None for a in attempts) or all(a['done'] for a in attempts))
+            winner = next((a for a in attempts if a['done'] and a['response'] is not None), attempts[0])
+        for attempt in attempts:
+            if attempt is not winner: attempt['cancel'].cancel()
+        hedged = len(attempts) > 1
+        if hedged and winner is not attempts[0]:
+            with self.hedge_lock: self.hedge_stats['hedge_won'] += 1
+        if winner['response'] is not None: self.latencies.add(time.time() - start)
+        stats = {'retries': sum(a['stats'].get('retries', 0) for a in attempts), 'errors': {}, 'error': winner['stats'].get('error'), 'queue_wait': queue_wait,
+                 'payload_bytes': sum(a['stats'].get('payload_bytes', 0) for a in attempts), **{k: winner['stats'][k] for k in ('encode', 'request', 'ttft', 'usage') if k in winner['stats']}}
+        for attempt in attempts:
+            for kind, n in attempt['stats'].get('errors', {}).items(): stats['errors'][kind] = stats['errors'].get(kind, 0) + n
+        return winner['response'], str(winner['backend']), hedged, stats
+
+    def _save_cells_result(self, cells, width, height, save_dir, s_name, page_idx, skipped_blank=False, route='model'):
+        result = {'page_no': page_idx, 'input_height': height, 'input_width': width, 'layout_info_path': os.path.join(save_dir, f"{s_name}.json"), 'md_content_path': os.path.join(save_dir, f"{s_name}.md"), 'filtered': False, 'skipped_blank': skipped_blank, 'route': route}
+        with open(result['layout_info_path'], 'w', encoding='utf-8') as f: json.dump(cells, f, ensure_ascii=False)
+        with open(result['md_content_path'], 'w', encoding='utf-8') as f: f.write(layoutjson2md(None, cells))
+        return result
+
+    def save_text_layer_result(self, cells, width, height, save_dir, save_name, page_idx):
+        page, start = {'page_idx': page_idx, 'save_dir': save_dir, 'save_name': save_name}, time.time()
+        self.emit('page_started', **page)
+        result = self._save_cells_result(cells, width, height, save_dir, f"{save_name}_page_{page_idx}", page_idx, route='text_layer')
+        self.emit('page_finished', **page, result=result, elapsed=time.time() - start)
         return result
 
+    def route_pdf_page(self, page, prompt_mode, first_page=False):
+        # Text-layer cells when the page can skip inference, otherwise None
+        if not self.use_text_layer or prompt_mode != "prompt_layout_all_en": return None
+        return text_layer_cells(page, self.dpi, first_page=first_page, **self.text_layer_thresholds)
+
     def parse_image(self, input_path, filename, prompt_mode, save_dir, bbox=None, fitz_preprocess=False):
         result = self._parse_single_image(fetch_image(input_path), prompt_mode, save_dir, filename, "image", 0, bbox, fitz_preprocess)
         result['file_path'] = input_path
         return [result]
 
     def parse_pdf(self, input_path, filename, prompt_mode, save_dir):
-        images = load_images_from_pdf(input_path, self.dpi)
-        tasks = [{"origin_image": img, "prompt_mode": prompt_mode, "save_dir": save_dir, "save_name": filename, "source": "pdf", "page_idx": i} for i, img in enumerate(images)]
-        results = []
-        with ThreadPool(min(len(images), self.num_thread)) as pool:
-            for res in tqdm(pool.imap_unordered(lambda p: self._parse_single_image(**p), tasks), total=len(tasks)):
-                results.append(res)
+        results, tasks, costs, render_times = [], [], {}, {}
+        with fitz.open(input_path) as doc:
+            for i, page in enumerate(doc):
+                # Page router: trusted text layers become cells directly, everything else goes to the model
+                start = time.time()
+                cells = self.route_pdf_page(page, prompt_mode, first_page=(i == 0))
+                if cells is not None:
+                    render_times[i] = time.time() - start
+                    results.append(self.save_text_layer_result(cells, *page_render_size(page, self.dpi), save_dir, filename, i))
+                else:
+                    tasks.append({"origin_image": fitz_doc_to_image(page, target_dpi=self.dpi), "prompt_mode": prompt_mode, "save_dir": save_dir, "save_name": filename, "source": "pdf", "page_idx": i})
+                    render_times[i] = time.time() - start
+                    # Longest predicted output first (LPT), so a few long table pages do not start last and set the completion time
+                    if self.order_by_cost: costs[i] = estimate_decode_length(page_cost_features(page))
+        if self.use_text_layer: print(f"{filename}: {len(results)} pages from text layer, {len(tasks)} pages sent to the model")
+        if self.order_by_cost: tasks.sort(key=lambda t: -costs[t['page_idx']])
+        if tasks:
+            # The progress bar is an event subscriber like any other (other files parsed at the same time are filtered out by save_dir)
+            progress = tqdm(total=len(tasks))
+            def advance(**event):
+                if event['save_dir'] == save_dir: progress.update(1)
+            for event in ('page_finished', 'page_failed'): self.on(event, advance)
+            try:
+                with ThreadPool(min(len(tasks), self.num_thread)) as pool:
+                    results.extend(pool.imap_unordered(lambda p: self._parse_single_image(**p), tasks))
+            finally:
+                for event in ('page_finished', 'page_failed'): self.off(event, advance)
+                progress.close()
         results.sort(key=lambda x: x["page_no"])
-        for r in results: r['file_path'] = input_path
+        for r in results:
+            r['file_path'] = input_path
+            r['timings'] = {'render': round(render_times[r['page_no']], 4), **r.get('timings', {})}
+        if self.adaptive_pixels:
+            sent, fixed = sum(r.get('image_tokens', 0) for r in results), sum(r.get('fixed_image_tokens', 0) for r in results)
+            if sent: print(f"{filename}: {fixed - sent} image tokens saved by the adaptive pixel budget ({fixed} -> {sent}, prefill ~x{fixed / sent:.2f})")
+        hedged = sum(1 for r in results if r.get('hedged'))
+        if hedged: print(f"{filename}: {hedged} requests hedged on another backend (totals since start: {self.hedge_stats})")
+        failed = [r['page_no'] for r in results if r.get('request_error')]
+        if failed: print(f"{filename}: inference failed for pages {failed} after retries (retry policy: {self.retry_policy.status()})")
         return results
 
     def parse_file(self, input_path, output_dir="", prompt_mode="prompt_layout_all_en", bbox=None, fitz_preprocess=False):
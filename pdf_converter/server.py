@@ -16,8 +16,9 @@ import logging
 from logging.handlers import RotatingFileHandler
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from urllib.parse import unquote, quote
+from urllib.parse import unquote, quote, urlparse, parse_qs
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import threading
 import sys
 import fitz  # PyMuPDF
@@ -25,18 +26,27 @@ from PIL import Image
 import queue
 import shutil
 import math
+import zlib
+import itertools
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 # 添加父目录到路径以导入库
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from dots_ocr_lib import DotsOCRParser, load_images_from_pdf
+from dots_ocr_lib import DotsOCRParser, load_images_from_pdf, get_formula_in_markdown, page_render_size, embedded_page_image, page_fingerprints, \
+    page_perceptual_hash, hamming_distance, NEAR_DUPLICATE_THRESHOLDS, page_cost_features, estimate_decode_length, \
+    fit_decode_length_coefficients, RetryPolicy, METRICS
 
 # Markdown to DOCX
 from docx import Document
-from docx.shared import Pt
+from docx.shared import Pt, Inches
 import base64
 import io
 import re
+import textwrap
+from html.parser import HTMLParser
 
 # ==============================================================================
 # Configuration
@@ -51,10 +61,113 @@ LOG_DIR.mkdir(exist_ok=True)
 
 # Concurrency Settings
 MAX_CONCURRENT_IMAGES = 32  # Number of images processed in parallel per PDF
+# Inference backends: with OCR_BACKENDS, requests can be admitted per replica by a token budget (image tokens + prompt +
+# max_tokens reservation) rather than by count. Off by default: every request reserves its full max_tokens, so a budget
+# sized for one replica admits far fewer requests than MAX_CONCURRENT_IMAGES and must match the replica it guards
+OCR_BACKENDS = None  # e.g. ["192.168.24.78:8001", "192.168.24.78:8002"] to address the vLLM replicas directly; None: the LiteLLM proxy
+# Per replica, only used with OCR_BACKENDS: the KV cache of one vLLM instance of docker/start_vllm.sh (logged at startup as
+# "GPU KV cache size: N tokens", depends on the GPU and --gpu-memory-utilization 0.9), at least --max-model-len; None: no limit
+BACKEND_TOKEN_BUDGET = None
+VLLM_MAX_MODEL_LEN = 32768  # --max-model-len: max_tokens is capped so that image + prompt + output fit
+# Hedged requests (needs OCR_BACKENDS with 2+ replicas): a request still running after HEDGE_PERCENTILE of recent latencies
+# is duplicated on another replica, the first answer wins and the other is cancelled; at most HEDGE_BUDGET of requests are hedged
+HEDGE_REQUESTS = False
+HEDGE_PERCENTILE = 0.95
+HEDGE_BUDGET = 0.05
+# Retries: only timeouts, connection errors, 429 and 5xx are retried, with exponential backoff and full jitter (Retry-After honoured);
+# retries are limited process-wide to about RETRY_BUDGET_RATIO of requests so an overloaded backend is not hit by a retry storm
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRY_BUDGET_RATIO = 0.2
 MAX_CONCURRENT_PDFS = 1    # Number of PDFs processed in parallel (Sequential = 1)
 
+# Packaging Settings
+PACKAGING_WORKERS = os.cpu_count() or 4  # Threads used to compress ZIP entries in parallel
+ZIP_COMPRESS_LEVEL = 6
+# Python versions whose zipfile internals the parallel ZIP writer has been checked against; other versions fall back
+# to ZipFile.write (single-threaded compression)
+PRECOMPRESSED_ZIP_VERSIONS = ((3, 8), (3, 13))
+# Already-compressed formats are stored as-is instead of being deflated again
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.docx', '.zip'}
+
 # Task Queue for sequential processing
 task_queue = queue.Queue()
+PIPELINE_QUEUE_SIZE = 64  # Max pages rendered ahead of OCR (each holds its raw pixels in memory, ~6.5 MB for A4 at 150 DPI)
+RENDER_DPI = 150
+IMAGE_ENCODING = 'png-fast'  # Image encoding sent to vLLM: a preset in dots_ocr_lib.IMAGE_ENCODING_PRESETS or a dict of PILimage_to_base64 options
+IMAGE_TRANSPORT = 'stream'  # 'stream': base64 body streamed to the socket, 'file': shared directory (see docker-compose.yml), 'base64': OpenAI client
+MEDIA_DIR = None  # Shared media directory as seen by this server, e.g. r"F:\dots.ocr\media"
+MEDIA_URL = None  # The same directory as seen by vLLM, e.g. "file:///workspace/media"
+EXTRACT_EMBEDDED_IMAGES = True  # Scanned pages (one full-page image) are taken from the image stream instead of being rendered
+USE_TEXT_LAYER = True  # Born-digital pages with a trustworthy text layer skip inference (thresholds: dots_ocr_lib.TEXT_LAYER_THRESHOLDS)
+ADAPTIVE_PIXEL_BUDGET = False  # Pages whose smallest text is large are sent with fewer pixels (thresholds: dots_ocr_lib.ADAPTIVE_PIXELS_THRESHOLDS)
+SKIP_BLANK_PAGES = True  # Blank / near-blank pages get an empty result without an inference request (thresholds: dots_ocr_lib.BLANK_PAGE_THRESHOLDS)
+SAVE_PAGE_IMAGES = True  # Also keep page_XXXX.jpg on disk (written in the background; rendered on demand when off)
+PAGE_IMAGE_QUALITY = 95
+
+# Artifact Settings
+DOCX_SPLIT_PAGES = 300  # Split DOCX into a new file every N pages
+DOCX_WORKERS = os.cpu_count() or 4  # Processes used to build DOCX parts in parallel
+DOCX_BUILDER = 'cells'  # 'cells': build directly from layout cells, 'markdown': parse per-page Markdown
+DOCX_IMAGE_QUALITY = 90  # JPEG quality for pictures cropped into DOCX
+MARKDOWN_EMPHASIS_RE = re.compile(r'(\*\*|\*)(.+?)\1')
+_docx_style_ids = {}
+# Artifacts built in the background once a job finishes (e.g. ['docx', 'zip']);
+# everything else is generated on the first download request
+PREWARM_ARTIFACTS = []
+PREWARM_IDLE_POLL = 2.0  # Seconds between idle checks before prewarming
+ARTIFACT_TYPES = {
+    'json': 'application/json',
+    'md': 'text/markdown; charset=utf-8',
+    'txt': 'text/plain',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'zip': 'application/zip',
+    'images_zip': 'application/zip',
+}
+prewarm_queue = queue.Queue()
+artifact_locks = {}
+artifact_locks_guard = threading.Lock()
+
+# Page Index: results of pages whose content is unchanged (e.g. a new revision of a document) are reused
+REUSE_UNCHANGED_PAGES = True
+PAGE_INDEX_FILE = "page_index.jsonl"  # In DATA_DIR, one line per processed page
+# Pages that only look the same (re-scans of forms, cover sheets, boilerplate annexes) reuse results within a Hamming radius
+# of their perceptual hash (thresholds: dots_ocr_lib.NEAR_DUPLICATE_THRESHOLDS); off by default, a changed field value
+# on a form page can stay within the radius. Every decision is recorded per page in the job manifest.
+REUSE_NEAR_DUPLICATE_PAGES = False
+# Pages are sent to OCR longest predicted output first (LPT), so a few long table pages do not start last and set the
+# completion time of the document. The prediction (dots_ocr_lib.DECODE_LENGTH_COEFFICIENTS) is refitted to the output
+# lengths of processed pages recorded in the page index once there are enough of them. Pages are ordered in windows of
+# ORDER_WINDOW_PAGES as they are rendered, so the first render waits only for the features of one window (a few ms per page)
+ORDER_PAGES_BY_COST = True
+ORDER_WINDOW_PAGES = 32
+DECODE_LENGTH_MIN_SAMPLES = 50
+page_index = None  # key -> entry, loaded on first use
+near_duplicate_index = None  # NearDuplicateIndex over entries with a perceptual hash
+decode_length_samples = deque(maxlen=5000)  # (features, output_chars) of recent model-recognised pages
+decode_length_model = None  # Coefficients fitted to decode_length_samples, None when stale
+page_index_lock = threading.Lock()
+
+# Dead-letter queue: pages that still fail after the request retries are held back from the combined outputs and requeued
+# at the end of the job through escalating parser settings (DotsOCRParser attributes); pages that fail every step are
+# recorded in the manifest ('dead_letter') and retried once more with the last step when no job is queued
+REQUEUE_FAILED_PAGES = True
+REQUEUE_ESCALATION = [
+    {'timeout': 4000.0},
+    {'timeout': 4000.0, 'region_ocr': True},  # 版面 + 逐区域识别，单个请求的输出短得多
+]
+IDLE_RETRY_DEAD_LETTERS = True
+dead_letter_queue = queue.Queue()
+job_locks = {}  # hash_id -> Lock held while a job's pages are written (processing, reprocessing, idle dead-letter retries)
+job_locks_guard = threading.Lock()
+
+# Job Store: queue order, state, stage progress and the page completion bitmap of every job in SQLite (WAL), so a
+# restart re-enqueues unfinished jobs and resumes them without redoing the pages already recognised
+JOB_DB_FILE = "jobs.db"  # In DATA_DIR
+JOB_PROGRESS_FLUSH = 2.0  # Seconds between progress writes of a running job (the bitmap is also written at the end)
+job_store = None  # JobStore, opened on first use
+job_store_lock = threading.Lock()
 
 # 配置日志
 log_file = LOG_DIR / "server.log"
@@ -81,97 +194,232 @@ parser = DotsOCRParser(
     dpi=150,
     min_pixels=3136,
     max_pixels=11289600,
-    timeout=2000.0
+    timeout=2000.0,
+    image_encoding=IMAGE_ENCODING,
+    image_transport=IMAGE_TRANSPORT,
+    media_dir=MEDIA_DIR,
+    media_url=MEDIA_URL,
+    skip_blank=SKIP_BLANK_PAGES,
+    use_text_layer=USE_TEXT_LAYER,
+    adaptive_pixels=ADAPTIVE_PIXEL_BUDGET,
+    backends=OCR_BACKENDS,
+    token_budget=BACKEND_TOKEN_BUDGET if OCR_BACKENDS else None,  # 代理后面有多个副本，按单个副本的预算限制会降低并发
+    max_model_len=VLLM_MAX_MODEL_LEN,
+    hedging=HEDGE_REQUESTS,
+    hedge_percentile=HEDGE_PERCENTILE,
+    hedge_budget=HEDGE_BUDGET,
+    retry_policy=RetryPolicy(RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_BUDGET_RATIO)
 )
 
+# 指标：dots_ocr_lib.METRICS 已包含编码、推理、后处理、版面绘制与发送字节数，这里登记本服务各阶段的指标，由 /metrics 输出
+METRICS.histogram('pdf_converter_upload_receive_seconds', "Reading the request body of an upload")
+METRICS.counter('pdf_converter_upload_bytes_total', "Bytes received in uploads")
+METRICS.histogram('pdf_converter_hash_seconds', "Hashing an uploaded file")
+METRICS.histogram('pdf_converter_rasterize_seconds', "Preparing a page for OCR: text layer check, embedded image extraction or rendering")
+METRICS.histogram('pdf_converter_merge_seconds', "Appending a page to the merged JSON/MD/TXT files")
+METRICS.histogram('pdf_converter_artifact_seconds', "Building a download artifact, by kind (json, md, txt, docx, zip, images_zip)")
+METRICS.histogram('pdf_converter_page_seconds', "Processing a page in the parser (model or text layer), by route")
+METRICS.counter('pdf_converter_pages_total', "Pages finished, by route (model, text_layer, blank, near_duplicate, reused, cached, failed)")
+METRICS.counter('pdf_converter_cache_lookups_total', "Cache lookups, by cache (page_index, near_duplicate, artifact)")
+METRICS.counter('pdf_converter_cache_hits_total', "Cache hits, by cache (page_index, near_duplicate, artifact)")
+
 # 处理状态存储
 processing_state = {}
 
+# 任务日志：每个任务一个环形缓冲区，/progress/<hash_id>?cursor=N 只返回序号大于 N 的条目
+JOB_LOG_SIZE = 500
+job_logs = {}  # hash_id -> JobLog
+job_logs_lock = threading.Lock()
+
 # ==============================================================================
 # Helper Functions
 # ==============================================================================
 
-def log_to_state(hash_id, message, append=False, log_level='normal'):
+class JobLog:
+    """单个任务的日志环形缓冲区：条目 {seq, time, level, message}，seq 连续递增，客户端按游标增量获取"""
+
+    def __init__(self, size=JOB_LOG_SIZE):
+        self.entries = deque(maxlen=size)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def append(self, level, message):
+        with self.lock:
+            self.seq += 1
+            self.entries.append({'seq': self.seq, 'time': time.time(), 'level': level, 'message': message})
+
+    def since(self, cursor):
+        """返回 (序号大于 cursor 的条目, 新游标, 是否有条目已被丢弃)；cursor 超过当前序号（服务已重启）时从头返回"""
+        with self.lock:
+            if cursor > self.seq:
+                cursor = 0
+            first = self.entries[0]['seq'] if self.entries else self.seq + 1
+            entries = list(itertools.islice(self.entries, max(0, cursor + 1 - first), None))
+            return entries, self.seq, cursor + 1 < first
+
+def job_log(hash_id):
+    with job_logs_lock:
+        if hash_id not in job_logs:
+            job_logs[hash_id] = JobLog()
+        return job_logs[hash_id]
+
+def log_to_state(hash_id, message, log_level='normal'):
     """添加日志到处理状态
     
     Args:
         hash_id: 任务ID
         message: 日志消息
-        append: 是否追加到现有日志
         log_level: 日志级别 ('important' 会显示在Web界面, 'normal' 仅记录到文件, 'silent' 只更新状态)
     """
     if hash_id in processing_state:
-        # 只有 important 级别的消息才添加到 Web UI 日志
+        # log 只保留最新一条 important 消息，完整日志在任务的环形缓冲区中
         if log_level == 'important':
-            if append and 'log' in processing_state[hash_id]:
-                processing_state[hash_id]['log'] = processing_state[hash_id]['log'] + '\n' + message
-            else:
-                processing_state[hash_id]['log'] = message
+            processing_state[hash_id]['log'] = message
         
-        # 所有级别都记录到文件日志（除了 silent）
+        # 所有级别都记录到缓冲区和文件日志（除了 silent）
         if log_level != 'silent':
+            job_log(hash_id).append(log_level, message)
             logger.info(f"[{hash_id}] {message}")
 
 def get_file_hash(file_data, length=8):
     """获取文件的SHA256哈希"""
-    return hashlib.sha256(file_data).hexdigest()[:length]
+    with METRICS.time('pdf_converter_hash_seconds'):
+        return hashlib.sha256(file_data).hexdigest()[:length]
+
+def _render_pixmap(page, dpi):
+    # Use the same logic as fitz_doc_to_image in dots_ocr_lib
+    mat = fitz.Matrix(dpi / 72, dpi / 72)
+    pm = page.get_pixmap(matrix=mat, alpha=False)
+    
+    # Check size limit (from dots_ocr_lib)
+    if pm.width > 4500 or pm.height > 4500:
+        mat = fitz.Matrix(72 / 72, 72 / 72)
+        pm = page.get_pixmap(matrix=mat, alpha=False)
+    return pm
+
+def page_image_path(work_dir, page_idx):
+    return Path(work_dir) / f"page_{page_idx:04d}.jpg"
+
+def render_page(args):
+    """渲染单页（在进程池中运行），返回 (page_idx, pixels, text_layer, 耗时)
+    
+    pixels 为 (width, height, samples)，原始像素直接交给 OCR 阶段，不再经过 JPEG 保存、重新打开的编解码过程
+    文本层可信的页面不渲染，text_layer 为 (cells, width, height)；两者都为 None 表示失败
+    耗时在子进程中测量，由主进程记入指标
+    """
+    start = time.time()
+    page_idx, pixels, text_layer = _render_page(args)
+    return page_idx, pixels, text_layer, time.time() - start
+
+def _render_page(args):
+    pdf_path, page_idx, dpi = args
+    try:
+        with fitz.open(pdf_path) as doc:
+            page = doc[page_idx]
+            try:
+                cells = parser.route_pdf_page(page, 'prompt_layout_all_en', first_page=(page_idx == 0))
+            except Exception as e:
+                logger.warning(f"Text layer check failed on page {page_idx}: {e}")
+                cells = None
+            if cells is not None:
+                return page_idx, None, (cells, *page_render_size(page, dpi))
+            # 扫描件页面直接取出内嵌的整页图片，不经过页面渲染
+            if EXTRACT_EMBEDDED_IMAGES:
+                try:
+                    image = embedded_page_image(page, dpi)
+                    if image is not None:
+                        return page_idx, (image.width, image.height, image.tobytes()), None
+                except Exception as e:
+                    logger.warning(f"Embedded image extraction failed on page {page_idx}, rendering instead: {e}")
+            pm = _render_pixmap(page, dpi)
+            return page_idx, (pm.width, pm.height, pm.samples), None
+    except Exception as e:
+        logger.error(f"Error rendering page {page_idx}: {e}")
+        return page_idx, None, None
+
+def pixels_to_image(pixels):
+    width, height, samples = pixels
+    return Image.frombuffer('RGB', (width, height), samples, 'raw', 'RGB', 0, 1)
 
 def extract_page_image(args):
     """Extract a single page from PDF and save as image"""
-    pdf_path, page_idx, dpi, output_dir = args
+    pdf_path, page_idx, dpi, output_dir, skip_existing = args
+    
+    image_path = page_image_path(output_dir, page_idx)
+    if skip_existing and image_path.exists():
+        return str(image_path)
     
     try:
-        doc = fitz.open(pdf_path)
-        page = doc[page_idx]
-        
-        # Use the same logic as fitz_doc_to_image in dots_ocr_lib
-        mat = fitz.Matrix(dpi / 72, dpi / 72)
-        pm = page.get_pixmap(matrix=mat, alpha=False)
-        
-        # Check size limit (from dots_ocr_lib)
-        if pm.width > 4500 or pm.height > 4500:
-            mat = fitz.Matrix(72 / 72, 72 / 72)
-            pm = page.get_pixmap(matrix=mat, alpha=False)
-            
-        image_path = Path(output_dir) / f"page_{page_idx:04d}.jpg"
-        pm.save(str(image_path))
-        
+        with fitz.open(pdf_path) as doc:
+            _render_pixmap(doc[page_idx], dpi).save(str(image_path))
         return str(image_path)
     except Exception as e:
         logger.error(f"Error extracting page {page_idx}: {e}")
         return None
 
+def save_page_image(image, image_path):
+    """页面原图只用于下载和旧任务的 DOCX 图片，由后台线程写入，不占用 OCR 关键路径"""
+    tmp_path = Path(str(image_path) + '.tmp')
+    try:
+        image.save(tmp_path, format='JPEG', quality=PAGE_IMAGE_QUALITY)
+        os.replace(tmp_path, image_path)
+    except Exception as e:
+        logger.warning(f"Failed to save page image {image_path}: {e}")
+
+def ensure_page_images(work_dir, pdf_path, page_indices):
+    """返回页面原图路径，未保存的页面（SAVE_PAGE_IMAGES 关闭时）按需从 PDF 渲染"""
+    missing = [idx for idx in page_indices if not page_image_path(work_dir, idx).exists()]
+    if missing:
+        with Pool(processes=min(4, len(missing))) as pool:
+            pool.map(extract_page_image, [(str(pdf_path), idx, RENDER_DPI, str(work_dir), True) for idx in missing])
+    return [str(page_image_path(work_dir, idx)) for idx in page_indices]
+
+def page_outputs_exist(save_dir, save_name, page_idx):
+    return (Path(save_dir) / f"{save_name}_page_{page_idx}.json").exists() and \
+        (Path(save_dir) / f"{save_name}_page_{page_idx}.md").exists()
+
 def process_single_page(args):
-    """处理单个页面（多进程）"""
-    image_path, save_dir, save_name, page_idx, hash_id, skip_existing = args
-    
+    """处理单个页面（OCR 线程池），返回 (page_idx, result)，失败时 result 为 None"""
+    origin_image, text_layer, save_dir, save_name, page_idx, hash_id, cached = args
+    return page_idx, _process_single_page(origin_image, text_layer, save_dir, save_name, page_idx, hash_id, cached)
+
+def _process_single_page(origin_image, text_layer, save_dir, save_name, page_idx, hash_id, cached, ocr_parser=None):
     # Check if stopped
     if hash_id in processing_state and processing_state[hash_id].get('stopped', False):
         return None
     
     # Check if output exists
-    json_path = Path(save_dir) / f"{save_name}_page_{page_idx}.json"
-    md_path = Path(save_dir) / f"{save_name}_page_{page_idx}.md"
-    
-    if skip_existing and json_path.exists() and md_path.exists():
+    if cached and page_outputs_exist(save_dir, save_name, page_idx):
         # 跳过已处理的页面，不记录日志
         return {
             'page_no': page_idx,
-            'layout_info_path': str(json_path),
-            'md_content_path': str(md_path)
+            'layout_info_path': str(Path(save_dir) / f"{save_name}_page_{page_idx}.json"),
+            'md_content_path': str(Path(save_dir) / f"{save_name}_page_{page_idx}.md")
         }
-
-    # 不记录每页处理，只通过进度百分比显示
     
-    # Load image from path
-    try:
-        origin_image = Image.open(image_path)
-    except Exception as e:
-        log_to_state(hash_id, f"Error loading image {image_path}: {e}", log_level='important')
+    # 文本层可信的页面直接保存，不发送推理请求
+    if text_layer is not None:
+        cells, width, height = text_layer
+        try:
+            return parser.save_text_layer_result(cells, width, height, str(save_dir), save_name, page_idx)
+        except Exception as e:
+            log_to_state(hash_id, f"Error saving text layer of page {page_idx}: {e}", log_level='important')
+            return None
+    
+    # 渲染失败的页面
+    if origin_image is None:
         return None
 
+    # 不记录每页处理，只通过进度百分比显示
+
     try:
-        result = parser._parse_single_image(
+        near_duplicate = None
+        if REUSE_NEAR_DUPLICATE_PAGES:
+            phash, near_duplicate, result = reuse_near_duplicate_page(origin_image, save_dir, save_name, page_idx)
+            if result:
+                result['near_duplicate'] = near_duplicate
+                return result
+        result = (ocr_parser or parser)._parse_single_image(
             origin_image=origin_image,
             prompt_mode='prompt_layout_all_en',
             save_dir=str(save_dir),
@@ -179,6 +427,13 @@ def process_single_page(args):
             source='pdf',
             page_idx=page_idx
         )
+        if result.get('layout_info_path'):
+            with open(result['layout_info_path'], 'r', encoding='utf-8') as f:
+                save_picture_crops(origin_image, json.load(f), save_dir, save_name, page_idx)
+        if near_duplicate and not result.get('skipped_blank'):
+            # 模型识别的页面登记感知哈希，供之后的近似页面复用
+            result['near_duplicate'] = near_duplicate
+            result['phash'] = (phash, list(origin_image.size))
         return result
     except Exception as e:
         log_to_state(hash_id, f"Error processing page {page_idx}: {e}", log_level='important')
@@ -187,93 +442,271 @@ def process_single_page(args):
         # Returning None will make it show up in "failed_pages" list in process_pdf_background.
         return None
 
-def markdown_to_docx(md_parts, output_base_path, split_every=300):
-    """
-    将Markdown转换为DOCX，支持分页切割
-    md_parts: list of markdown strings (one per page)
-    output_base_path: base path for output (e.g., "file.docx")
-    split_every: split into new file every N pages
-    """
-    total_pages = len(md_parts)
-    num_files = math.ceil(total_pages / split_every)
+def _new_document():
+    doc = Document()
     
-    generated_files = []
+    # 设置默认字体
+    style = doc.styles['Normal']
+    font = style.font
+    font.name = 'Arial'
+    font.size = Pt(11)
+    return doc
+
+def append_markdown_to_docx(doc, md_content):
+    """将一段Markdown（通常为一页）追加到DOCX文档"""
+    lines = md_content.split('\n')
+    i = 0
     
-    for file_idx in range(num_files):
-        start_idx = file_idx * split_every
-        end_idx = min((file_idx + 1) * split_every, total_pages)
+    while i < len(lines):
+        line = lines[i].strip()
         
-        current_parts = md_parts[start_idx:end_idx]
+        if not line:
+            i += 1
+            continue
         
-        doc = Document()
+        # 标题
+        if line.startswith('#'):
+            level = len(line) - len(line.lstrip('#'))
+            text = line.lstrip('#').strip()
+            try:
+                doc.add_heading(text, level=min(level, 9))
+            except:
+                doc.add_paragraph(text)
         
-        # 设置默认字体
-        style = doc.styles['Normal']
-        font = style.font
-        font.name = 'Arial'
-        font.size = Pt(11)
+        # 图片
+        elif line.startswith('![') and '](data:image/' in line:
+            try:
+                match = re.search(r'!\[.*?\]\((data:image/[^;]+;base64,[^)]+)\)', line)
+                if match:
+                    data_url = match.group(1)
+                    header, encoded = data_url.split(',', 1)
+                    image_data = base64.b64decode(encoded)
+                    
+                    image_stream = io.BytesIO(image_data)
+                    try:
+                        doc.add_picture(image_stream, width=Inches(5))
+                    except:
+                        doc.add_paragraph('[Image]')
+            except Exception as e:
+                doc.add_paragraph(f'[Image - Error: {str(e)}]')
         
-        # Combine parts for this file
-        combined_content = '\n\n'.join(current_parts)
+        # LaTeX公式
+        elif line.startswith('$$'):
+            formula_lines = [line]
+            i += 1
+            while i < len(lines) and not lines[i].strip().endswith('$$'):
+                formula_lines.append(lines[i])
+                i += 1
+            if i < len(lines):
+                formula_lines.append(lines[i])
+            formula_text = '\n'.join(formula_lines)
+            p = doc.add_paragraph(formula_text)
+            p.style = 'Intense Quote'
         
-        lines = combined_content.split('\n')
-        i = 0
+        # 普通段落
+        else:
+            text = line
+            text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
+            text = re.sub(r'\*(.+?)\*', r'\1', text)
+            doc.add_paragraph(text)
         
-        while i < len(lines):
-            line = lines[i].strip()
-            
-            if not line:
-                i += 1
-                continue
-            
-            # 标题
-            if line.startswith('#'):
-                level = len(line) - len(line.lstrip('#'))
-                text = line.lstrip('#').strip()
-                try:
-                    doc.add_heading(text, level=min(level, 9))
-                except:
-                    doc.add_paragraph(text)
-            
-            # 图片
-            elif line.startswith('![') and '](data:image/' in line:
-                try:
-                    match = re.search(r'!\[.*?\]\((data:image/[^;]+;base64,[^)]+)\)', line)
-                    if match:
-                        data_url = match.group(1)
-                        header, encoded = data_url.split(',', 1)
-                        image_data = base64.b64decode(encoded)
-                        
-                        image_stream = io.BytesIO(image_data)
-                        try:
-                            from docx.shared import Inches
-                            doc.add_picture(image_stream, width=Inches(5))
-                        except:
-                            doc.add_paragraph('[Image]')
-                except Exception as e:
-                    doc.add_paragraph(f'[Image - Error: {str(e)}]')
-            
-            # LaTeX公式
-            elif line.startswith('$$'):
-                formula_lines = [line]
-                i += 1
-                while i < len(lines) and not lines[i].strip().endswith('$$'):
-                    formula_lines.append(lines[i])
-                    i += 1
-                if i < len(lines):
-                    formula_lines.append(lines[i])
-                formula_text = '\n'.join(formula_lines)
-                p = doc.add_paragraph(formula_text)
-                p.style = 'Intense Quote'
-            
-            # 普通段落
-            else:
-                text = line
-                text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
-                text = re.sub(r'\*(.+?)\*', r'\1', text)
-                doc.add_paragraph(text)
-            
-            i += 1
+        i += 1
+
+class _HTMLTableParser(HTMLParser):
+    """将模型输出的 HTML 表格解析为行列表，每个单元格为 {'text', 'rowspan', 'colspan'}"""
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self.rows.append([])
+        elif tag in ('td', 'th'):
+            if not self.rows:
+                self.rows.append([])
+            attrs = dict(attrs)
+            self._cell = {'text': [], 'rowspan': _span(attrs.get('rowspan')), 'colspan': _span(attrs.get('colspan'))}
+        elif tag == 'br' and self._cell is not None:
+            self._cell['text'].append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in ('td', 'th') and self._cell is not None:
+            self._cell['text'] = ''.join(self._cell['text']).strip()
+            self.rows[-1].append(self._cell)
+            self._cell = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell['text'].append(data)
+
+def _span(value):
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+def add_html_table_to_docx(doc, html):
+    """将 HTML 表格写成真正的 DOCX 表格（支持 rowspan/colspan），无法解析时返回 False"""
+    table_parser = _HTMLTableParser()
+    table_parser.feed(html)
+    if not any(table_parser.rows):
+        return False
+    
+    # 计算每个单元格在网格中的位置
+    occupied = set()
+    placed = []
+    for r, row in enumerate(table_parser.rows):
+        c = 0
+        for cell in row:
+            while (r, c) in occupied:
+                c += 1
+            for dr in range(cell['rowspan']):
+                for dc in range(cell['colspan']):
+                    occupied.add((r + dr, c + dc))
+            placed.append((r, c, cell))
+            c += cell['colspan']
+    n_rows = max(r for r, _ in occupied) + 1
+    n_cols = max(c for _, c in occupied) + 1
+    
+    table = doc.add_table(rows=n_rows, cols=n_cols)
+    table._tbl.tblPr.style = _style_id(doc, 'Table Grid')
+    if any(cell['rowspan'] > 1 or cell['colspan'] > 1 for _, _, cell in placed):
+        for r, c, cell in placed:
+            target = table.cell(r, c)
+            if cell['rowspan'] > 1 or cell['colspan'] > 1:
+                target = target.merge(table.cell(min(r + cell['rowspan'], n_rows) - 1, min(c + cell['colspan'], n_cols) - 1))
+            target.text = cell['text']
+    else:
+        # 没有合并单元格时按行取一次单元格，避免 table.cell() 每次都重建整个网格
+        row_cells = [row.cells for row in table.rows]
+        for r, c, cell in placed:
+            row_cells[r][c].text = cell['text']
+    return True
+
+def _style_id(doc, style_name):
+    """
+    按名称查找样式 ID 并缓存（python-docx 每次按名称设置样式都会遍历全部样式）
+    所有文档都由 _new_document() 基于同一默认模板创建，样式 ID 相同
+    """
+    if style_name not in _docx_style_ids:
+        _docx_style_ids[style_name] = doc.styles[style_name].style_id
+    return _docx_style_ids[style_name]
+
+def _add_styled_paragraph(doc, text, style_name):
+    paragraph = doc.add_paragraph(text)
+    paragraph._p.style = _style_id(doc, style_name)
+    return paragraph
+
+def append_cells_to_docx(doc, cells, page_image=None):
+    """
+    直接根据 layout cells 写入DOCX（一页一次遍历）
+    图片使用 OCR 阶段保存的裁剪文件直接写入，表格生成真正的DOCX表格，不经过 Markdown/base64 往返
+    page_image: 页面原图（PIL Image，cells 的 bbox 基于此图），仅在没有裁剪文件时使用
+    """
+    for cell in cells:
+        category = cell.get('category')
+        text = cell.get('text') or ''
+        
+        if category == 'Picture':
+            try:
+                if cell.get('image_path'):
+                    # 已编码的裁剪图片直接写入，无需解码/重新编码
+                    doc.add_picture(cell['image_path'], width=Inches(5))
+                elif page_image is not None:
+                    image_stream = io.BytesIO()
+                    page_image.crop(cell['bbox']).save(image_stream, format='JPEG', quality=DOCX_IMAGE_QUALITY)
+                    image_stream.seek(0)
+                    doc.add_picture(image_stream, width=Inches(5))
+                else:
+                    doc.add_paragraph('[Image]')
+            except Exception as e:
+                doc.add_paragraph(f'[Image - Error: {str(e)}]')
+        
+        elif category == 'Table':
+            if not add_html_table_to_docx(doc, text):
+                doc.add_paragraph(text.strip())
+        
+        elif category == 'Formula':
+            _add_styled_paragraph(doc, get_formula_in_markdown(text), 'Intense Quote')
+        
+        elif category in ('Title', 'Section-header'):
+            stripped = text.strip()
+            level = len(stripped) - len(stripped.lstrip('#'))
+            level = level or (1 if category == 'Title' else 2)
+            _add_styled_paragraph(doc, stripped.lstrip('#').strip(), f'Heading {min(level, 9)}')
+        
+        else:
+            for line in text.split('\n'):
+                line = line.strip()
+                if line:
+                    doc.add_paragraph(MARKDOWN_EMPHASIS_RE.sub(r'\2', line))
+
+def picture_crop_path(save_dir, save_name, page_idx, cell_idx):
+    return Path(save_dir) / f"{save_name}_page_{page_idx}_pic_{cell_idx}.jpg"
+
+def save_picture_crops(origin_image, cells, save_dir, save_name, page_idx):
+    """OCR 阶段页面原图仍在内存中时，把 Picture 区域裁剪保存一次，供生成 DOCX 时直接使用"""
+    for cell_idx, cell in enumerate(cells):
+        if cell.get('category') == 'Picture':
+            try:
+                crop = origin_image.crop(cell['bbox'])
+                crop.convert('RGB').save(picture_crop_path(save_dir, save_name, page_idx, cell_idx), format='JPEG', quality=DOCX_IMAGE_QUALITY)
+            except Exception as e:
+                logger.warning(f"Failed to save picture crop {cell_idx} of page {page_idx}: {e}")
+
+def _load_page_cells_for_docx(work_dir, base_name, page_idx):
+    """读取单页 cells，为 Picture cell 附上已保存的裁剪图片路径；没有 cells 时返回 (None, None)"""
+    json_path = work_dir / f"{base_name}_page_{page_idx}.json"
+    if not json_path.exists():
+        return None, None
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            cells = json.load(f)
+    except Exception:
+        return None, None
+    
+    # 旧任务没有保存裁剪图片时，才需要解码整页原图
+    page_image = None
+    for cell_idx, cell in enumerate(cells):
+        if cell.get('category') == 'Picture':
+            crop_path = picture_crop_path(work_dir, base_name, page_idx, cell_idx)
+            if crop_path.exists():
+                cell['image_path'] = str(crop_path)
+            elif page_image is None:
+                image_path = page_image_path(work_dir, page_idx)
+                if image_path.exists():
+                    page_image = Image.open(image_path)
+    return cells, page_image
+
+def build_docx_part(args):
+    """生成单个DOCX分卷（在进程池中运行），逐页从磁盘读取本分卷的页面结果"""
+    work_dir, base_name, start_idx, end_idx, out_path, builder = args
+    work_dir = Path(work_dir)
+    
+    doc = _new_document()
+    for page_idx in range(start_idx, end_idx):
+        cells = None
+        if builder == 'cells':
+            cells, page_image = _load_page_cells_for_docx(work_dir, base_name, page_idx)
+        
+        if cells is not None:
+            _add_styled_paragraph(doc, f"Page {page_idx + 1}", 'Heading 1')
+            append_cells_to_docx(doc, cells, page_image)
+        else:
+            # 没有 cells（失败或被过滤的页面）时使用 Markdown
+            append_markdown_to_docx(doc, read_page_markdown(work_dir, base_name, page_idx))
+    
+    doc.save(str(out_path))
+    return str(out_path)
+
+def docx_part_ranges(total_pages, output_base_path, split_every=300):
+    """按 split_every 切分页码范围，返回 [(start_idx, end_idx, out_path), ...]"""
+    num_files = math.ceil(total_pages / split_every)
+    ranges = []
+    for file_idx in range(num_files):
+        start_idx = file_idx * split_every
+        end_idx = min((file_idx + 1) * split_every, total_pages)
         
         # Determine output filename
         if num_files > 1:
@@ -282,15 +715,32 @@ def markdown_to_docx(md_parts, output_base_path, split_every=300):
             out_path = p.parent / f"{p.stem}_part{file_idx+1}{p.suffix}"
         else:
             out_path = output_base_path
-            
-        doc.save(str(out_path))
-        generated_files.append(str(out_path))
-        
-    return generated_files
+        ranges.append((start_idx, end_idx, str(out_path)))
+    return ranges
 
-def create_txt_file(md_content, output_path):
-    """将Markdown内容保存为TXT文件"""
-    # 简单去除一些Markdown标记，或者直接保存
+def markdown_to_docx(work_dir, base_name, total_pages, output_base_path, split_every=300, processes=None, builder=None):
+    """
+    将已落盘的逐页结果转换为DOCX，支持分页切割
+    output_base_path: base path for output (e.g., "file.docx")
+    split_every: split into new file every N pages
+    processes: 并行生成分卷的进程数（默认 DOCX_WORKERS），分卷在多个进程中同时生成
+    builder: 'cells' 直接使用 layout cells，'markdown' 解析逐页 Markdown（默认 DOCX_BUILDER）
+    """
+    builder = builder or DOCX_BUILDER
+    args_list = [
+        (str(work_dir), base_name, start_idx, end_idx, out_path, builder)
+        for start_idx, end_idx, out_path in docx_part_ranges(total_pages, output_base_path, split_every)
+    ]
+    processes = min(processes or DOCX_WORKERS, len(args_list))
+    
+    if processes <= 1:
+        return [build_docx_part(args) for args in args_list]
+    
+    with Pool(processes=processes) as pool:
+        return pool.map(build_docx_part, args_list)
+
+def markdown_to_txt(md_content):
+    """简单去除一些Markdown标记"""
     # 这里选择直接保存内容，因为用户说"MARKDOWN变成txt"
     # 可以考虑去除图片标记等
     txt_content = md_content
@@ -298,51 +748,919 @@ def create_txt_file(md_content, output_path):
     txt_content = re.sub(r'!\[.*?\]\(.*?\)', '[图片]', txt_content)
     # 去除公式标记 $$...$$ (保留内容)
     # txt_content = re.sub(r'\$\$(.*?)\$\$', r'\1', txt_content, flags=re.DOTALL)
-    
+    return txt_content
+
+def create_txt_file(md_content, output_path):
+    """将Markdown内容保存为TXT文件"""
     with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(txt_content)
+        f.write(markdown_to_txt(md_content))
+
+def _entry_compress_type(arcname):
+    """根据内容类型选择压缩方式：已压缩的格式直接存储"""
+    if Path(arcname).suffix.lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def _deflate_entry(src_path):
+    """读取并压缩单个条目（在线程池中运行，zlib 会释放 GIL）"""
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    compressor = zlib.compressobj(ZIP_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    return len(data), zlib.crc32(data), payload
+
+def _supports_precompressed(zipf):
+    """
+    zipfile 没有公开写入预压缩 deflate 数据的接口（ZipFile.open(zinfo, 'w') 总会自行压缩），
+    _write_precompressed 只能沿用 ZipFile.write 内部的写入步骤并依赖私有属性。
+    这些内部实现可能随 Python 升级而变化，因此只在核对过的版本上启用，其余情况退回 zipfile.write
+    """
+    low, high = PRECOMPRESSED_ZIP_VERSIONS
+    return (low <= sys.version_info[:2] <= high
+            and all(hasattr(zipf, attr) for attr in ('_lock', '_didModify', 'start_dir', 'fp', 'filelist', 'NameToInfo')))
+
+def _write_precompressed(zipf, src_path, arcname, file_size, crc, payload):
+    """将已压缩好的 deflate 数据直接写入 ZIP（跳过 zipfile 自身的单线程压缩，仅在 _supports_precompressed 时调用）"""
+    zinfo = zipfile.ZipInfo.from_file(src_path, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(payload)
+    zinfo.CRC = crc
+    zip64 = file_size > zipfile.ZIP64_LIMIT or len(payload) > zipfile.ZIP64_LIMIT
+    # 与 ZipFile.write 内部的写入步骤一致（私有属性，见 _supports_precompressed）
+    with zipf._lock:
+        zinfo.header_offset = zipf.fp.tell()
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        zipf.fp.write(payload)
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.start_dir = zipf.fp.tell()
+        zipf._didModify = True
+
+def write_zip(zip_path, entries):
+    """
+    写入ZIP包：按条目类型选择压缩方式，需要压缩的条目在多个核心上并行压缩
+    entries: list of (src_path, arcname)
+    """
+    entries = [(Path(src), arcname) for src, arcname in entries if src and Path(src).exists()]
+    to_deflate = [(src, arcname) for src, arcname in entries if _entry_compress_type(arcname) == zipfile.ZIP_DEFLATED]
+
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        futures = {}
+        if to_deflate and not _supports_precompressed(zipf):
+            logger.debug(f"Parallel ZIP compression not enabled on Python {sys.version.split()[0]}, using zipfile.write")
+            to_deflate = []
+        if to_deflate:
+            executor = ThreadPoolExecutor(max_workers=min(PACKAGING_WORKERS, len(to_deflate)))
+            futures = {arcname: executor.submit(_deflate_entry, src) for src, arcname in to_deflate}
+            executor.shutdown(wait=False)
+
+        # 按原顺序写入：已压缩格式直接存储，其余等待对应的压缩结果
+        for src, arcname in entries:
+            if arcname in futures:
+                file_size, crc, payload = futures.pop(arcname).result()
+                _write_precompressed(zipf, src, arcname, file_size, crc, payload)
+            else:
+                zipf.write(src, arcname, compress_type=_entry_compress_type(arcname), compresslevel=ZIP_COMPRESS_LEVEL)
+
+    return zip_path
 
-def create_zip_package(base_dir, base_name, hash_id):
+def create_zip_package(base_dir, base_name, hash_id, zip_path=None):
     """创建包含DOCX、MD、JSON、TXT的ZIP包"""
     zip_name = f"{base_name}_{hash_id}.zip"
-    zip_path = base_dir / zip_name
+    zip_path = zip_path or base_dir / zip_name
+
+    # Add all DOCX files (including parts)
+    entries = [(item, item.name) for item in sorted(base_dir.glob(f"{base_name}_{hash_id}*.docx"))]
+    entries += [
+        (base_dir / f"{base_name}_{hash_id}_combined.md", f"{base_name}_{hash_id}.md"),
+        (base_dir / f"{base_name}_{hash_id}_combined.txt", f"{base_name}_{hash_id}.txt"),
+        (base_dir / f"{base_name}_{hash_id}_combined.json", f"{base_name}_{hash_id}.json"),
+    ]
+
+    return write_zip(zip_path, entries)
+
+def create_images_zip(base_dir, base_name, hash_id, image_paths, zip_path=None):
+    """Create a zip file containing all extracted images"""
+    zip_name = f"{base_name}_{hash_id}_images.zip"
+    zip_path = zip_path or base_dir / zip_name
+
+    return write_zip(zip_path, [(p, os.path.basename(p)) for p in image_paths if p])
+
+# ==============================================================================
+# Artifacts (generated on demand)
+# ==============================================================================
+
+def artifact_path(work_dir, base_name, hash_id, kind):
+    """返回某类下载产物的缓存路径"""
+    prefix = f"{base_name}_{hash_id}"
+    return {
+        'json': work_dir / f"{prefix}_combined.json",
+        'md': work_dir / f"{prefix}_combined.md",
+        'txt': work_dir / f"{prefix}_combined.txt",
+        'docx': work_dir / f"{prefix}.docx",
+        'zip': work_dir / f"{prefix}.zip",
+        'images_zip': work_dir / f"{prefix}_images.zip",
+    }[kind]
+
+def manifest_path(work_dir, base_name, hash_id):
+    return work_dir / f"{base_name}_{hash_id}_manifest.json"
+
+def load_manifest(work_dir, base_name, hash_id):
+    """读取任务清单（页面结果全部落盘后写入），不存在则返回 None"""
+    path = manifest_path(work_dir, base_name, hash_id)
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"Failed to read manifest {path}: {e}")
+        return None
+
+def write_manifest(work_dir, base_name, hash_id, manifest):
+    path = manifest_path(work_dir, base_name, hash_id)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def _artifact_cached(work_dir, base_name, hash_id, kind):
+    if kind == 'docx':
+        # DOCX may have been split into _partN files
+        return any(work_dir.glob(f"{base_name}_{hash_id}*.docx"))
+    return artifact_path(work_dir, base_name, hash_id, kind).exists()
+
+def job_lock(hash_id):
+    with job_locks_guard:
+        return job_locks.setdefault(hash_id, threading.Lock())
+
+def _artifact_lock(hash_id, kind):
+    with artifact_locks_guard:
+        return artifact_locks.setdefault((hash_id, kind), threading.Lock())
+
+def read_page_cells(work_dir, base_name, page_idx, hash_id=None):
+    """读取单页已落盘的 layout JSON，缺失页面返回空 cells"""
+    json_path = work_dir / f"{base_name}_page_{page_idx}.json"
+    cells = []
+    if json_path.exists():
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                cells = json.load(f)
+        except Exception as e:
+            log_to_state(hash_id, f"Warning: Failed to load JSON for page {page_idx}: {e}", log_level='normal')
+    return {'page': page_idx, 'cells': cells}
+
+def combined_json_part(page_idx, page_cells):
+    """合并 JSON 中一页的片段：'[' + 各页片段 + combined_json_end() 与 json.dump(all_cells, indent=2) 逐字节相同
     
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        # Add all DOCX files (including parts)
-        for item in base_dir.glob(f"{base_name}_{hash_id}*.docx"):
-            zipf.write(item, item.name)
-        
-        md_file = base_dir / f"{base_name}_{hash_id}_combined.md"
-        if md_file.exists():
-            zipf.write(md_file, f"{base_name}_{hash_id}.md")
-            
-        txt_file = base_dir / f"{base_name}_{hash_id}_combined.txt"
-        if txt_file.exists():
-            zipf.write(txt_file, f"{base_name}_{hash_id}.txt")
+    增量合并和按需生成都使用这两个函数，产物格式与生成路径无关
+    """
+    return (',\n' if page_idx > 0 else '\n') + textwrap.indent(json.dumps(page_cells, ensure_ascii=False, indent=2), '  ')
+
+def combined_json_end(total_pages):
+    return '\n]' if total_pages else ']'
+
+def read_page_markdown(work_dir, base_name, page_idx, hash_id=None):
+    """读取单页已落盘的 Markdown（带页标题），缺失页面使用占位内容"""
+    md_path = work_dir / f"{base_name}_page_{page_idx}.md"
+    md_content = None
+    if md_path.exists():
+        try:
+            with open(md_path, 'r', encoding='utf-8') as f:
+                md_content = f.read()
+        except Exception as e:
+            log_to_state(hash_id, f"Warning: Failed to load Markdown for page {page_idx}: {e}", log_level='normal')
+    if md_content is None:
+        # Fallback for missing markdown
+        md_content = "[Content missing or processing failed]"
+    return f"# Page {page_idx + 1}\n\n{md_content}"
+
+def load_page_markdown(work_dir, base_name, total_pages, hash_id=None):
+    """按页读取已落盘的 Markdown"""
+    return [read_page_markdown(work_dir, base_name, page_idx, hash_id) for page_idx in range(total_pages)]
+
+class IncrementalMerger:
+    """
+    OCR 结果到达时按页码顺序追加到合并的 JSON/MD/TXT 文件
+    结果乱序到达时先记录，等前面的页面都到齐后再写入；finish() 写入剩余页面并替换为正式文件
+    """
+    KINDS = ('json', 'md', 'txt')
+
+    def __init__(self, work_dir, base_name, hash_id, total_pages, pending_pages=()):
+        self.work_dir, self.base_name, self.hash_id = work_dir, base_name, hash_id
+        self.total_pages = total_pages
+        self.next_page = 0
+        # 不在本次处理范围内的页面视为已就绪（写入空 cells / 占位内容）
+        self.ready = set(range(total_pages)) - set(pending_pages)
+        self.paths = {kind: artifact_path(work_dir, base_name, hash_id, kind) for kind in self.KINDS}
+        self.tmp_paths = {kind: path.with_name(path.name + '.tmp') for kind, path in self.paths.items()}
+        self.files = {kind: open(path, 'w', encoding='utf-8') for kind, path in self.tmp_paths.items()}
+        self.files['json'].write('[')
+
+    @property
+    def merged_pages(self):
+        return self.next_page
+
+    def add(self, page_idx):
+        """标记某页结果已落盘（或已失败），并写入所有已连续就绪的页面"""
+        self.ready.add(page_idx)
+        while self.next_page in self.ready:
+            self._append(self.next_page)
+            self.ready.discard(self.next_page)
+            self.next_page += 1
+
+    def _append(self, page_idx):
+        with METRICS.time('pdf_converter_merge_seconds'):
+            page_cells = read_page_cells(self.work_dir, self.base_name, page_idx, self.hash_id)
+            md_part = read_page_markdown(self.work_dir, self.base_name, page_idx, self.hash_id)
+            sep = '\n\n---\n\n' if page_idx > 0 else ''
+            self.files['json'].write(combined_json_part(page_idx, page_cells))
+            self.files['md'].write(sep + md_part)
+            self.files['txt'].write(sep + markdown_to_txt(md_part))
+
+    def finish(self):
+        """写入剩余页面，关闭并原子替换为正式文件"""
+        for page_idx in range(self.next_page, self.total_pages):
+            self._append(page_idx)
+        self.next_page = self.total_pages
+        self.files['json'].write(combined_json_end(self.total_pages))
+        for kind in self.KINDS:
+            self.files[kind].close()
+            os.replace(self.tmp_paths[kind], self.paths[kind])
+
+    def abort(self):
+        for kind in self.KINDS:
+            self.files[kind].close()
+            if self.tmp_paths[kind].exists():
+                self.tmp_paths[kind].unlink()
+
+def _build_artifact(work_dir, base_name, hash_id, kind, manifest):
+    """生成单个产物；单文件产物先写临时文件再原子替换"""
+    total_pages = manifest['total_pages']
+    out_path = artifact_path(work_dir, base_name, hash_id, kind)
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+
+    if kind == 'json':
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('[')
+            for page_idx in range(total_pages):
+                f.write(combined_json_part(page_idx, read_page_cells(work_dir, base_name, page_idx, hash_id)))
+            f.write(combined_json_end(total_pages))
+    elif kind == 'md':
+        combined_md = '\n\n---\n\n'.join(load_page_markdown(work_dir, base_name, total_pages, hash_id))
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(combined_md)
+    elif kind == 'txt':
+        md_path = ensure_artifact(work_dir, base_name, hash_id, 'md')
+        with open(md_path, 'r', encoding='utf-8') as f:
+            create_txt_file(f.read(), str(tmp_path))
+    elif kind == 'docx':
+        generated_files = markdown_to_docx(work_dir, base_name, total_pages, str(out_path), split_every=DOCX_SPLIT_PAGES)
+        log_to_state(hash_id, f"📄 已生成 {len(generated_files)} 个 DOCX 文件", log_level='normal')
+        return out_path
+    elif kind == 'zip':
+        for dep in ('docx', 'md', 'txt', 'json'):
+            ensure_artifact(work_dir, base_name, hash_id, dep)
+        create_zip_package(work_dir, base_name, hash_id, zip_path=tmp_path)
+    elif kind == 'images_zip':
+        image_paths = ensure_page_images(work_dir, work_dir / manifest['filename'],
+                                         manifest.get('processed_pages', range(total_pages)))
+        create_images_zip(work_dir, base_name, hash_id, image_paths, zip_path=tmp_path)
+
+    os.replace(tmp_path, out_path)
+    return out_path
+
+def ensure_artifact(work_dir, base_name, hash_id, kind):
+    """
+    返回产物路径，首次请求时才生成（同一产物同时只会生成一次，之后直接使用缓存）
+    任务尚未完成（没有清单）且没有旧版缓存时返回 None
+    """
+    with _artifact_lock(hash_id, kind):
+        METRICS.inc('pdf_converter_cache_lookups_total', cache='artifact')
+        if _artifact_cached(work_dir, base_name, hash_id, kind):
+            METRICS.inc('pdf_converter_cache_hits_total', cache='artifact')
+            return artifact_path(work_dir, base_name, hash_id, kind)
+
+        manifest = load_manifest(work_dir, base_name, hash_id)
+        if manifest is None:
+            return None
+
+        build_start = time.time()
+        out_path = _build_artifact(work_dir, base_name, hash_id, kind, manifest)
+        elapsed = time.time() - build_start
+        METRICS.observe('pdf_converter_artifact_seconds', elapsed, kind=kind)
+
+        if hash_id in processing_state:
+            artifact_times = processing_state[hash_id].setdefault('artifact_times', {})
+            artifact_times[kind] = f"{elapsed:.1f}s"
+            if kind in ('zip', 'images_zip'):
+                packaging_time = sum(float(artifact_times[k][:-1]) for k in ('zip', 'images_zip') if k in artifact_times)
+                processing_state[hash_id]['packaging_time'] = f"{packaging_time:.1f}s"
+        log_to_state(hash_id, f"按需生成 {kind} 完成，耗时 {elapsed:.1f}秒", log_level='normal')
+        return out_path
+
+def invalidate_artifacts(work_dir, base_name, hash_id):
+    """删除缓存的产物与任务清单（重新处理前调用）"""
+    for kind in ARTIFACT_TYPES:
+        with _artifact_lock(hash_id, kind):
+            if kind == 'docx':
+                stale = list(work_dir.glob(f"{base_name}_{hash_id}*.docx"))
+            else:
+                stale = [artifact_path(work_dir, base_name, hash_id, kind)]
+            for path in stale:
+                if path.exists():
+                    path.unlink()
+    path = manifest_path(work_dir, base_name, hash_id)
+    if path.exists():
+        path.unlink()
+
+def prewarm_worker():
+    """低优先级后台线程：队列空闲时预先生成常用产物"""
+    while True:
+        work_dir, base_name, hash_id, kind = prewarm_queue.get()
+        try:
+            # 只在没有 PDF 正在处理时运行，避免与 OCR 争抢资源
+            while task_queue.unfinished_tasks > 0:
+                time.sleep(PREWARM_IDLE_POLL)
+            ensure_artifact(work_dir, base_name, hash_id, kind)
+        except Exception as e:
+            logger.warning(f"[{hash_id}] Prewarm {kind} failed: {e}")
+        finally:
+            prewarm_queue.task_done()
+
+def refresh_artifacts(work_dir, base_name, hash_id, page_indices):
+    """页面结果更新后只重建受影响的产物：合并的 JSON/MD/TXT 重新拼接，DOCX 只重建包含这些页面的分卷，ZIP 删除后按需重新打包"""
+    manifest = load_manifest(work_dir, base_name, hash_id)
+    if manifest is None:
+        return
+    for kind in ('json', 'md', 'txt'):
+        with _artifact_lock(hash_id, kind):
+            if artifact_path(work_dir, base_name, hash_id, kind).exists():
+                _build_artifact(work_dir, base_name, hash_id, kind, manifest)
+    with _artifact_lock(hash_id, 'docx'):
+        if _artifact_cached(work_dir, base_name, hash_id, 'docx'):
+            docx_path = str(artifact_path(work_dir, base_name, hash_id, 'docx'))
+            for start_idx, end_idx, out_path in docx_part_ranges(manifest['total_pages'], docx_path, DOCX_SPLIT_PAGES):
+                if any(start_idx <= idx < end_idx for idx in page_indices):
+                    tmp_path = out_path + '.tmp'
+                    build_docx_part((str(work_dir), base_name, start_idx, end_idx, tmp_path, DOCX_BUILDER))
+                    os.replace(tmp_path, out_path)
+    with _artifact_lock(hash_id, 'zip'):
+        zip_path = artifact_path(work_dir, base_name, hash_id, 'zip')
+        if zip_path.exists():
+            zip_path.unlink()
+
+# ==============================================================================
+# Job Store (durable queue and progress)
+# ==============================================================================
+
+JOB_PROGRESS_KEYS = ('extract_progress', 'extract_status', 'ocr_progress', 'ocr_status', 'generate_progress', 'generate_status')
+
+def pages_to_bitmap(pages, total_pages):
+    bitmap = bytearray((total_pages + 7) // 8)
+    for idx in pages:
+        bitmap[idx // 8] |= 1 << (idx % 8)
+    return bytes(bitmap)
+
+def bitmap_to_pages(bitmap):
+    return {i * 8 + bit for i, byte in enumerate(bitmap or b'') for bit in range(8) if byte >> bit & 1}
+
+class JobStore:
+    """任务表（SQLite WAL）：排队顺序、状态、各阶段进度与页面完成位图；所有线程共用一个连接"""
+
+    COLUMNS = ('hash_id', 'seq', 'filename', 'base_name', 'work_dir', 'pdf_path', 'process_mode', 'skip_existing',
+               'state', 'progress', 'total_pages', 'pages_done', 'error', 'created_at', 'updated_at')
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            hash_id TEXT PRIMARY KEY, seq INTEGER NOT NULL, filename TEXT, base_name TEXT, work_dir TEXT, pdf_path TEXT,
+            process_mode TEXT, skip_existing INTEGER, state TEXT NOT NULL, progress TEXT, total_pages INTEGER,
+            pages_done BLOB, error TEXT, created_at REAL, updated_at REAL)""")
+
+    def enqueue(self, hash_id, pdf_path, work_dir, base_name, process_mode, filename, skip_existing=False):
+        """加入队尾；skip_existing（重新处理）时保留已完成页面的位图"""
+        now = time.time()
+        with self.lock:
+            seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM jobs").fetchone()[0]
+            self.conn.execute(
+                """INSERT INTO jobs (hash_id, seq, filename, base_name, work_dir, pdf_path, process_mode, skip_existing, state, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)
+                   ON CONFLICT(hash_id) DO UPDATE SET seq=excluded.seq, filename=excluded.filename, base_name=excluded.base_name,
+                       work_dir=excluded.work_dir, pdf_path=excluded.pdf_path, process_mode=excluded.process_mode,
+                       skip_existing=excluded.skip_existing, state='queued', progress=NULL, error=NULL, updated_at=excluded.updated_at,
+                       pages_done=CASE WHEN excluded.skip_existing THEN jobs.pages_done END""",
+                (hash_id, seq, filename, base_name, str(work_dir), str(pdf_path), process_mode, int(skip_existing), now, now))
+
+    def update(self, hash_id, **fields):
+        if 'progress' in fields:
+            fields['progress'] = json.dumps({k: fields['progress'][k] for k in JOB_PROGRESS_KEYS if k in fields['progress']}, ensure_ascii=False)
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields if name in self.COLUMNS)
+        with self.lock:
+            self.conn.execute(f"UPDATE jobs SET {assignments} WHERE hash_id = ?", [v for k, v in fields.items() if k in self.COLUMNS] + [hash_id])
+
+    def get(self, hash_id):
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE hash_id = ?", (hash_id,)).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def unfinished(self):
+        """排队中或处理中（服务停止时未完成）的任务，按排队顺序"""
+        with self.lock:
+            rows = self.conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE state IN ('queued', 'running') ORDER BY seq").fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+def get_job_store():
+    global job_store
+    with job_store_lock:
+        if job_store is None:
+            DATA_DIR.mkdir(parents=True, exist_ok=True)
+            job_store = JobStore(DATA_DIR / JOB_DB_FILE)
+        return job_store
+
+def enqueue_job(pdf_path, work_dir, base_name, hash_id, process_mode, filename, skip_existing=False):
+    """写入任务表后加入内存队列"""
+    get_job_store().enqueue(hash_id, pdf_path, work_dir, base_name, process_mode, filename, skip_existing)
+    task_queue.put((
+        process_pdf_background,
+        (pdf_path, work_dir, base_name, hash_id, process_mode, filename, skip_existing),
+        hash_id
+    ))
+
+def recover_jobs():
+    """启动时按原排队顺序重新加入未完成的任务，已完成的页面（位图）不再识别"""
+    for job in get_job_store().unfinished():
+        hash_id, pdf_path = job['hash_id'], Path(job['pdf_path'])
+        if not pdf_path.exists():
+            get_job_store().update(hash_id, state='failed', error='PDF file not found after restart')
+            continue
+        pages_done = len(bitmap_to_pages(job['pages_done']))
+        processing_state[hash_id] = {
+            'extract_progress': 0,
+            'extract_status': 'Queued (Recovered)',
+            'ocr_progress': 0,
+            'ocr_status': 'Waiting...',
+            'generate_progress': 0,
+            'generate_status': 'Waiting...',
+            'complete': False,
+            'log': f'Recovered after restart ({pages_done} pages already done)',
+            'status': 'Queued'
+        }
+        job_log(hash_id).append('important', processing_state[hash_id]['log'])
+        logger.info(f"Recovering task {job['filename']} ({hash_id}), {pages_done}/{job['total_pages'] or '?'} pages done")
+        enqueue_job(pdf_path, Path(job['work_dir']), job['base_name'], hash_id, job['process_mode'], job['filename'],
+                    skip_existing=bool(job['skip_existing'] or job['pages_done']))
+
+# ==============================================================================
+# Dead-letter Queue (failed pages)
+# ==============================================================================
+
+def requeue_failed_pages(pdf_path, work_dir, base_name, hash_id, page_indices, dead_letters, steps):
+    """
+    按 steps（逐级加强的解析设置）重试失败页面，每级只重试上一级仍失败的页面
+    返回恢复成功的 {page_idx: result}；dead_letters 中更新仍失败页面的记录、移除已恢复的页面
+    """
+    recovered = {}
+    pending = sorted(page_indices)
+    image_paths = dict(zip(pending, ensure_page_images(work_dir, pdf_path, pending)))
+    for overrides in steps:
+        if not pending or processing_state.get(hash_id, {}).get('stopped', False):
+            break
+        # 重试请求不再对冲，避免失败页面占用两份推理资源
+        ocr_parser = parser.escalated(hedging=False, **overrides)
+
+        def retry(page_idx):
+            try:
+                with Image.open(image_paths[page_idx]) as image:
+                    origin_image = image.convert('RGB')
+            except Exception as e:
+                return page_idx, None, f"page image: {e}"
+            result = _process_single_page(origin_image, None, str(work_dir), base_name, page_idx, hash_id, False, ocr_parser)
+            if result is None or result.get('request_error'):
+                return page_idx, None, (result or {}).get('request_error') or 'error'
+            return page_idx, result, None
+
+        still_failed = []
+        with ThreadPool(processes=min(MAX_CONCURRENT_IMAGES, len(pending))) as pool:
+            for page_idx, result, error in pool.imap_unordered(retry, pending):
+                record = dead_letters.setdefault(page_idx, {'attempts': 1, 'errors': []})
+                record['attempts'] += 1
+                if result is None:
+                    record['errors'].append({'settings': overrides, 'error': error})
+                    still_failed.append(page_idx)
+                else:
+                    recovered[page_idx] = result
+                    dead_letters.pop(page_idx)
+        pending = sorted(still_failed)
+    return recovered
+
+def record_recovered_pages(pdf_path, work_dir, base_name, hash_id, total_pages, recovered):
+    """空闲重试恢复的页面按主流程的方式登记：任务表的页面完成位图，以及页面索引（指纹、感知哈希、输出长度样本）"""
+    store = get_job_store()
+    job = store.get(hash_id)
+    if job:
+        store.update(hash_id, pages_done=pages_to_bitmap(bitmap_to_pages(job['pages_done']) | set(recovered), total_pages))
+    fingerprints, features = None, {}
+    with fitz.open(pdf_path) as doc:
+        if REUSE_UNCHANGED_PAGES:
+            fingerprints = page_fingerprints(doc)
+        if ORDER_PAGES_BY_COST:
+            features = {idx: page_cost_features(doc[idx]) for idx in recovered}
+    phashes = {idx: result['phash'] for idx, result in recovered.items() if result.get('phash')}
+    record_page_index(work_dir, base_name, sorted(recovered), fingerprints, phashes, features)
+
+def dead_letter_worker():
+    """低优先级后台线程：没有任务排队时用最后一级设置重试死信队列中的页面，成功后只重建受影响的产物
+    
+    重试期间持有任务锁，同一任务的重新处理要等重试写完页面和产物后才开始
+    """
+    while True:
+        pdf_path, work_dir, base_name, hash_id = dead_letter_queue.get()
+        try:
+            while task_queue.unfinished_tasks > 0:
+                time.sleep(PREWARM_IDLE_POLL)
+            with job_lock(hash_id):
+                # 排队期间任务可能已被重新处理，以当前清单为准
+                manifest = load_manifest(work_dir, base_name, hash_id)
+                if not manifest or not manifest.get('dead_letter'):
+                    continue
+                dead_letters = {int(idx): record for idx, record in manifest['dead_letter'].items()}
+                recovered = requeue_failed_pages(pdf_path, work_dir, base_name, hash_id, list(dead_letters), dead_letters, REQUEUE_ESCALATION[-1:])
+                if recovered:
+                    manifest.update({
+                        'failed_pages': [idx for idx in manifest['failed_pages'] if idx not in recovered],
+                        'dead_letter': {idx: dead_letters[idx] for idx in sorted(dead_letters)},
+                        'recovered_pages': sorted(set(manifest.get('recovered_pages', [])) | set(recovered))
+                    })
+                    write_manifest(work_dir, base_name, hash_id, manifest)
+                    record_recovered_pages(pdf_path, work_dir, base_name, hash_id, manifest['total_pages'], recovered)
+                    refresh_artifacts(work_dir, base_name, hash_id, recovered)
+            log_to_state(hash_id, f"📮 空闲重试死信页面：恢复 {len(recovered)} 页，仍失败 {len(dead_letters)} 页", log_level='important')
+        except Exception as e:
+            logger.warning(f"[{hash_id}] Dead-letter retry failed: {e}")
+        finally:
+            dead_letter_queue.task_done()
+
+# ==============================================================================
+# Page Index (reuse results of unchanged pages)
+# ==============================================================================
+
+def _page_index_key(fingerprint):
+    # 页面结果（bbox 坐标）与渲染 DPI 相关
+    return f"{fingerprint}:{RENDER_DPI}"
+
+class NearDuplicateIndex:
+    """感知哈希的相似索引：哈希切成 max_distance + 1 段，汉明距离不超过 max_distance 的两个哈希
+    至少有一段完全相同（鸽巢原理），查询只需比较有相同分段的候选，而不是全部历史页面"""
+    
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.entries = []
+        self.bands = [{} for _ in range(max_distance + 1)]
+    
+    def _band_keys(self, phash):
+        step = math.ceil(len(phash) / len(self.bands))
+        return [phash[i * step:(i + 1) * step] for i in range(len(self.bands))]
+    
+    def add(self, entry):
+        self.entries.append(entry)
+        for band, key in zip(self.bands, self._band_keys(entry['phash'])):
+            band.setdefault(key, []).append(len(self.entries) - 1)
+    
+    def nearest(self, phash, size):
+        """最相近的同尺寸历史页面，返回 (distance, entry)，没有候选时为 (None, None)
         
-        json_file = base_dir / f"{base_name}_{hash_id}_combined.json"
-        if json_file.exists():
-            zipf.write(json_file, f"{base_name}_{hash_id}.json")
+        半径内的页面一定能找到；超出半径的结果只是有相同分段的候选中最近的一个，仅供核查参考
+        """
+        candidates = set()
+        for band, key in zip(self.bands, self._band_keys(phash)):
+            candidates.update(band.get(key, ()))
+        best_distance, best_entry = None, None
+        for i in sorted(candidates, reverse=True):  # 距离相同时取最近登记的页面
+            entry = self.entries[i]
+            if len(entry['phash']) != len(phash) or entry['size'] != list(size):
+                continue
+            distance = hamming_distance(entry['phash'], phash)
+            if best_distance is None or distance < best_distance:
+                best_distance, best_entry = distance, entry
+        return best_distance, best_entry
+
+def _load_page_index():
+    global page_index, near_duplicate_index
+    if page_index is None:
+        page_index = {}
+        near_duplicate_index = NearDuplicateIndex(NEAR_DUPLICATE_THRESHOLDS['max_distance'])
+        path = DATA_DIR / PAGE_INDEX_FILE
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # 写入中断留下的残行
+                    _index_entry(entry)
+    return page_index
+
+def _index_entry(entry):
+    global decode_length_model
+    if entry.get('key'):
+        page_index[entry['key']] = entry
+    if entry.get('phash'):
+        near_duplicate_index.add(entry)
+    if entry.get('features') and entry.get('output_chars') is not None:
+        decode_length_samples.append((entry['features'], entry['output_chars']))
+        decode_length_model = None
+
+def record_page_index(work_dir, base_name, pages, fingerprints=None, phashes=None, features=None):
+    """任务完成后登记已处理页面的指纹、感知哈希和输出长度（后写入的覆盖旧记录）
     
-    return zip_path
+    features 只传入模型识别的页面，其输出长度用于校准页面排序的预测
+    """
+    entries = []
+    for idx in pages:
+        entry = {'key': _page_index_key(fingerprints[idx]) if fingerprints else None,
+                 'dir': Path(work_dir).name, 'base_name': base_name, 'page_idx': idx}
+        if phashes and idx in phashes:
+            entry['phash'], entry['size'] = phashes[idx]
+        if features and idx in features:
+            try:
+                with open(Path(work_dir) / f"{base_name}_page_{idx}.json", 'r', encoding='utf-8') as f:
+                    entry['features'], entry['output_chars'] = features[idx], len(f.read())
+            except OSError:
+                pass
+        if entry['key'] or entry.get('phash') or entry.get('features'):
+            entries.append(entry)
+    with page_index_lock:
+        _load_page_index()
+        with open(DATA_DIR / PAGE_INDEX_FILE, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                _index_entry(entry)
 
-def create_images_zip(base_dir, base_name, hash_id, image_paths):
-    """Create a zip file containing all extracted images"""
-    zip_name = f"{base_name}_{hash_id}_images.zip"
-    zip_path = base_dir / zip_name
+def decode_length_coefficients():
+    """按历史页面拟合的输出长度预测系数，样本不足时为 None（使用默认系数）"""
+    global decode_length_model
+    with page_index_lock:
+        _load_page_index()
+        if len(decode_length_samples) < DECODE_LENGTH_MIN_SAMPLES:
+            return None
+        if decode_length_model is None:
+            decode_length_model = fit_decode_length_coefficients(list(decode_length_samples))
+        return decode_length_model
+
+def order_pages_by_cost(pdf_path, page_indices):
+    """按预测输出长度从长到短排列页面（LPT），返回 (排序后的页面, {page_idx: features}, 是否使用历史校准)"""
+    with fitz.open(pdf_path) as doc:
+        features = {idx: page_cost_features(doc[idx]) for idx in page_indices}
+    coefficients = decode_length_coefficients()
+    estimates = {idx: estimate_decode_length(f, coefficients) for idx, f in features.items()}
+    return sorted(page_indices, key=lambda idx: -estimates[idx]), features, coefficients is not None
+
+def _copy_page_files(src_dir, src_base, src_idx, dst_dir, dst_base, dst_idx, images=True):
+    pairs = [
+        (src_dir / f"{src_base}_page_{src_idx}.json", dst_dir / f"{dst_base}_page_{dst_idx}.json"),
+        (src_dir / f"{src_base}_page_{src_idx}.md", dst_dir / f"{dst_base}_page_{dst_idx}.md"),
+    ]
+    if images:
+        pairs.append((page_image_path(src_dir, src_idx), page_image_path(dst_dir, dst_idx)))
+        pic_prefix = f"{src_base}_page_{src_idx}_pic_"
+        for pic in src_dir.glob(f"{pic_prefix}*.jpg"):
+            pairs.append((pic, dst_dir / f"{dst_base}_page_{dst_idx}_pic_{pic.name[len(pic_prefix):]}"))
+    for src, dst in pairs:
+        if src.exists() and src != dst:
+            shutil.copyfile(src, dst)
+
+def reuse_unchanged_pages(work_dir, base_name, fingerprints, page_indices):
+    """把指纹相同的历史页面结果复制到当前任务，返回 {page_idx: 来源}，这些页面不再渲染和识别"""
+    with page_index_lock:
+        index = _load_page_index()
+        matches = {idx: index.get(_page_index_key(fingerprints[idx])) for idx in page_indices}
+    reused = {}
+    for idx, entry in matches.items():
+        if not entry or entry['dir'] == Path(work_dir).name:
+            continue  # 本任务目录中的输出是否完整以任务表位图为准（中断时可能只写了一半）
+        src_dir = DATA_DIR / entry['dir']
+        if not page_outputs_exist(src_dir, entry['base_name'], entry['page_idx']):
+            continue  # 来源任务已删除
+        try:
+            _copy_page_files(src_dir, entry['base_name'], entry['page_idx'], Path(work_dir), base_name, idx)
+            reused[idx] = f"{entry['dir']}#{entry['page_idx']}"
+        except OSError as e:
+            logger.warning(f"Failed to reuse page {idx} from {entry['dir']}: {e}")
+    METRICS.inc('pdf_converter_cache_lookups_total', len(matches), cache='page_index')
+    METRICS.inc('pdf_converter_cache_hits_total', len(reused), cache='page_index')
+    return reused
+
+def reuse_near_duplicate_page(origin_image, save_dir, save_name, page_idx):
+    """查找与当前页面近似重复的历史页面，返回 (phash, decision, result)
     
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for img_path in image_paths:
-            if img_path and os.path.exists(img_path):
-                zipf.write(img_path, os.path.basename(img_path))
-                
-    return zip_path
+    decision 记录判定依据（最近的候选、距离、阈值、是否复用），写入任务清单供核查；复用成功时 result 为页面结果
+    """
+    thresholds = NEAR_DUPLICATE_THRESHOLDS
+    phash = page_perceptual_hash(origin_image, thresholds['hash_size'], thresholds['tolerance'])
+    with page_index_lock:
+        _load_page_index()
+        distance, entry = near_duplicate_index.nearest(phash, origin_image.size)
+    METRICS.inc('pdf_converter_cache_lookups_total', cache='near_duplicate')
+    decision = {'phash': phash, 'candidate': None, 'distance': distance, 'max_distance': thresholds['max_distance'], 'reused': False}
+    if entry is None:
+        return phash, decision, None
+    decision['candidate'] = f"{entry['dir']}#{entry['page_idx']}"
+    src_dir = DATA_DIR / entry['dir']
+    if entry['dir'] == Path(save_dir).name:
+        return phash, decision, None  # 同 reuse_unchanged_pages：不复用本任务目录中的输出
+    if distance > thresholds['max_distance'] or not page_outputs_exist(src_dir, entry['base_name'], entry['page_idx']):
+        return phash, decision, None
+    try:
+        # 只复用识别结果，页面原图和图片裁剪取自当前页面
+        _copy_page_files(src_dir, entry['base_name'], entry['page_idx'], Path(save_dir), save_name, page_idx, images=False)
+        with open(Path(save_dir) / f"{save_name}_page_{page_idx}.json", 'r', encoding='utf-8') as f:
+            save_picture_crops(origin_image, json.load(f), save_dir, save_name, page_idx)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to reuse near-duplicate page {page_idx} from {entry['dir']}: {e}")
+        return phash, decision, None
+    decision['reused'] = True
+    METRICS.inc('pdf_converter_cache_hits_total', cache='near_duplicate')
+    return phash, decision, {
+        'page_no': page_idx,
+        'layout_info_path': str(Path(save_dir) / f"{save_name}_page_{page_idx}.json"),
+        'md_content_path': str(Path(save_dir) / f"{save_name}_page_{page_idx}.md"),
+        'route': 'near_duplicate'
+    }
+
+# ==============================================================================
+# Parser Events
+# ==============================================================================
+
+page_events_lock = threading.Lock()
+
+def _event_job(save_dir):
+    """事件对应的任务状态：工作目录为 DATA_DIR/<base_name>_<hash_id>"""
+    hash_id = Path(save_dir).name.rsplit('_', 1)[-1]
+    return hash_id, processing_state.get(hash_id)
+
+def _count_in_flight(save_dir, delta):
+    hash_id, state = _event_job(save_dir)
+    if state is not None:
+        with page_events_lock:
+            state['pages_in_flight'] = max(0, state.get('pages_in_flight', 0) + delta)
+
+def on_page_started(page_idx, save_dir, save_name):
+    _count_in_flight(save_dir, 1)
+
+def on_page_finished(page_idx, save_dir, save_name, result, elapsed):
+    _count_in_flight(save_dir, -1)
+    METRICS.observe('pdf_converter_page_seconds', elapsed, route=result.get('route', 'model'))
+
+def on_page_failed(page_idx, save_dir, save_name, error, result):
+    _count_in_flight(save_dir, -1)
+    hash_id, state = _event_job(save_dir)
+    if result is not None:
+        log_to_state(hash_id, f"第 {page_idx + 1} 页推理失败（重试后）：{error}", log_level='normal')
+
+def on_retry(page_idx, save_dir, save_name, kind, attempt, delay, error):
+    hash_id, state = _event_job(save_dir)
+    log_to_state(hash_id, f"🔄 第 {page_idx + 1} 页请求错误 [{kind}]，{delay:.1f} 秒后第 {attempt} 次重试：{error}", log_level='normal')
+
+def subscribe_parser_events(ocr_parser):
+    """订阅解析器事件：任务的在途页数、每页耗时指标以及重试与失败日志（重新排队使用的 escalated 副本共享订阅）"""
+    ocr_parser.on('page_started', on_page_started)
+    ocr_parser.on('page_finished', on_page_finished)
+    ocr_parser.on('page_failed', on_page_failed)
+    ocr_parser.on('retry', on_retry)
+
+# ==============================================================================
+# Pipeline
+# ==============================================================================
+
+PAGE_TELEMETRY_KEYS = ('route', 'backend', 'retries', 'payload_bytes', 'prompt_tokens', 'completion_tokens')
+
+def page_telemetry(result, render_time=None):
+    """任务清单中单页的记录：各阶段耗时（秒，见 dots_ocr_lib.REQUEST_TIMINGS）与请求信息，页面级的 render 来自拆图阶段"""
+    timings = dict(result.get('timings') or {})
+    if render_time is not None:
+        timings = {'render': round(render_time, 4), **timings}
+    return {'timings': timings, **{key: result[key] for key in PAGE_TELEMETRY_KEYS if key in result}}
+
+def _put_until_stopped(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+def _get_until_stopped(q, stop_event):
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            continue
+    return None
+
+def _acquire_until_stopped(sem, stop_event):
+    while not sem.acquire(timeout=1):
+        if stop_event.is_set():
+            return False
+    return not stop_event.is_set()
+
+def _rasterize_stage(pdf_path, work_dir, base_name, page_indices, cached_pages, skip_existing, page_queue, render_slots, stop_event, hash_id, stats, image_writer):
+    """拆图阶段（后台线程）：按页渲染为内存中的图片放入有界队列，OCR 阶段一有页面就开始处理"""
+    done = 0
+    
+    def report():
+        processing_state[hash_id].update({
+            'extract_progress': 20 + done / len(page_indices) * 80,
+            'extract_status': f'Extracted {done}/{len(page_indices)}'
+        })
+    
+    try:
+        # 已有结果的页面（已识别或复用）不需要渲染
+        to_render = []
+        for idx in page_indices:
+            if idx in cached_pages:
+                if not _acquire_until_stopped(render_slots, stop_event):
+                    return
+                _put_until_stopped(page_queue, (idx, None, None), stop_event)
+                done += 1
+                stats['extracted'] += 1
+            else:
+                to_render.append(idx)
+        if done:
+            report()
+        
+        def ordered_window(window, first):
+            # 每个窗口内按预测输出长度排序，特征在渲染过程中逐窗口计算，不在第一页渲染前遍历全部页面
+            if not ORDER_PAGES_BY_COST or len(window) < 2:
+                return window
+            try:
+                window, features, calibrated = order_pages_by_cost(pdf_path, window)
+            except Exception as e:
+                logger.warning(f"[{hash_id}] Page cost estimation failed, keeping page order: {e}")
+                return window
+            stats['features'].update(features)
+            if first:
+                log_to_state(hash_id, f"🧮 按预测输出长度从长到短发送（每 {ORDER_WINDOW_PAGES} 页一组，{'历史校准' if calibrated else '默认系数'}），"
+                                      f"最先发送第 {', '.join(str(idx + 1) for idx in window[:3])} 页", log_level='normal')
+            return window
+        
+        def render_tasks():
+            for start in range(0, len(to_render), ORDER_WINDOW_PAGES):
+                for idx in ordered_window(to_render[start:start + ORDER_WINDOW_PAGES], start == 0):
+                    # 渲染领先 OCR 的页数受 render_slots 限制
+                    if not _acquire_until_stopped(render_slots, stop_event):
+                        return
+                    yield (str(pdf_path), idx, RENDER_DPI)
+        
+        with Pool(processes=4) as pool:
+            for page_idx, pixels, text_layer, elapsed in pool.imap(render_page, render_tasks()):
+                if stop_event.is_set():
+                    break
+                METRICS.observe('pdf_converter_rasterize_seconds', elapsed)
+                stats['render_times'][page_idx] = elapsed
+                image = None
+                if text_layer:
+                    stats['extracted'] += 1
+                elif pixels:
+                    image = pixels_to_image(pixels)
+                    stats['extracted'] += 1
+                    image_path = page_image_path(work_dir, page_idx)
+                    if SAVE_PAGE_IMAGES and not (skip_existing and image_path.exists()):
+                        image_writer.submit(save_page_image, image, image_path)
+                _put_until_stopped(page_queue, (page_idx, image, text_layer), stop_event)
+                done += 1
+                report()
+        
+        processing_state[hash_id].update({
+            'extract_progress': 100,
+            'extract_status': 'Complete' if stats['extracted'] else 'No images extracted from PDF'
+        })
+    except Exception as e:
+        logger.error(f"[{hash_id}] Rasterize stage error: {traceback.format_exc()}")
+        processing_state[hash_id]['extract_status'] = f'Error: {e}'
+    finally:
+        _put_until_stopped(page_queue, None, stop_event)
 
 def process_pdf_background(pdf_path, work_dir, base_name, hash_id, process_mode, filename, skip_existing=False):
-    """后台处理PDF"""
+    """
+    后台处理PDF
+    拆图、OCR、合并三个阶段流水线并行：页面渲染好即送去 OCR，OCR 结果到达即按页序追加到合并文件
+    """
     start_time = time.time()
+    stop_event = threading.Event()
+    merger = None
+    image_writer = None
+    done_pages = None
     
     try:
+        # 之前生成的下载产物可能已过期
+        invalidate_artifacts(work_dir, base_name, hash_id)
+        
         # 1. 拆图阶段
         log_to_state(hash_id, "📄 开始提取 PDF 页面图片...", log_level='important')
         processing_state[hash_id].update({
@@ -353,6 +1671,8 @@ def process_pdf_background(pdf_path, work_dir, base_name, hash_id, process_mode,
         # Get page count
         with fitz.open(pdf_path) as doc:
             total_pages = doc.page_count
+        job = get_job_store().get(hash_id)
+        get_job_store().update(hash_id, state='running', total_pages=total_pages)
         
         log_to_state(hash_id, f"PDF加载成功，共 {total_pages} 页", log_level='normal')
         
@@ -364,133 +1684,221 @@ def process_pdf_background(pdf_path, work_dir, base_name, hash_id, process_mode,
             page_indices = list(range(total_pages))
             log_to_state(hash_id, f"处理模式: 处理全部 {total_pages} 页", log_level='important')
             
+        # 已识别的页面，以及内容与历史页面完全相同的页面，直接使用已有结果
+        cached_pages = {idx for idx in page_indices if skip_existing and page_outputs_exist(work_dir, base_name, idx)}
+        if skip_existing and job and job['pages_done'] is not None:
+            # 任务表记录了完成位图时只跳过位图中的页面（中断时正在写入的页面输出可能不完整）
+            cached_pages &= bitmap_to_pages(job['pages_done'])
+            log_to_state(hash_id, f"⏯️ 从上次中断处继续：{len(cached_pages)} 页已完成", log_level='important')
+        done_pages = set(cached_pages)  # 写入任务表的页面完成位图
+        fingerprints, reused_pages = None, {}
+        if REUSE_UNCHANGED_PAGES:
+            try:
+                with fitz.open(pdf_path) as doc:
+                    fingerprints = page_fingerprints(doc)
+                reused_pages = reuse_unchanged_pages(work_dir, base_name, fingerprints,
+                                                     [idx for idx in page_indices if idx not in cached_pages])
+            except Exception as e:
+                logger.warning(f"[{hash_id}] Page fingerprinting failed: {e}")
+            if reused_pages:
+                log_to_state(hash_id, f"♻️ {len(reused_pages)} 页内容与历史文档相同，直接复用识别结果", log_level='important')
+        cached_pages |= set(reused_pages)
+        
         processing_state[hash_id].update({
             'extract_progress': 20,
-            'extract_status': f'Extracting {len(page_indices)} pages...'
+            'extract_status': f'Extracting {len(page_indices)} pages...',
+            'reused_pages': len(reused_pages)
         })
         
-        # Check if images already exist
-        images_exist = False
-        image_paths = []
-        
-        if skip_existing:
-            # Check if all expected images exist
-            all_exist = True
-            temp_paths = []
-            for idx in page_indices:
-                img_path = work_dir / f"page_{idx:04d}.jpg"
-                if not img_path.exists():
-                    all_exist = False
-                    break
-                temp_paths.append(str(img_path))
-            
-            if all_exist:
-                images_exist = True
-                image_paths = temp_paths
-                log_to_state(hash_id, "✅ 图片文件已存在，直接使用缓存", log_level='normal')
-        
-        if not images_exist:
-            # Parallel extraction
-            extract_args = [
-                (str(pdf_path), idx, 150, str(work_dir))
-                for idx in page_indices
-            ]
-            
-            image_paths = []
-            with Pool(processes=4) as pool:
-                for i, img_path in enumerate(pool.imap(extract_page_image, extract_args)):
-                    image_paths.append(img_path)
-                    progress = 20 + (i + 1) / len(extract_args) * 80
-                    processing_state[hash_id].update({
-                        'extract_progress': progress,
-                        'extract_status': f'Extracted {i+1}/{len(extract_args)}'
-                    })
-        
-        # Filter out failed extractions
-        valid_pages = []
-        for img_path, page_idx in zip(image_paths, page_indices):
-             if img_path:
-                valid_pages.append((img_path, page_idx))
-        
-        if not valid_pages:
-            raise Exception("No images extracted from PDF")
-
-        # Create images zip if not exists
-        if not (work_dir / f"{base_name}_{hash_id}_images.zip").exists():
-            log_to_state(hash_id, "创建图片ZIP包...", log_level='normal')
-            create_images_zip(work_dir, base_name, hash_id, [p[0] for p in valid_pages])
-
-        processing_state[hash_id].update({
-            'extract_progress': 100,
-            'extract_status': 'Complete'
-        })
+        page_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        render_slots = threading.BoundedSemaphore(PIPELINE_QUEUE_SIZE)
+        raster_stats = {'extracted': 0, 'features': {}, 'render_times': {}}
+        image_writer = ThreadPoolExecutor(max_workers=2)
+        threading.Thread(
+            target=_rasterize_stage,
+            args=(pdf_path, work_dir, base_name, page_indices, cached_pages, skip_existing, page_queue, render_slots, stop_event, hash_id, raster_stats, image_writer),
+            daemon=True
+        ).start()
         
-        # 2. OCR处理阶段
-        log_to_state(hash_id, f"🔍 开始 OCR 识别，共 {len(valid_pages)} 页（{MAX_CONCURRENT_IMAGES} 并发）", log_level='important')
+        # 2. OCR处理阶段（与拆图同时进行）
+        log_to_state(hash_id, f"🔍 开始 OCR 识别，共 {len(page_indices)} 页（{MAX_CONCURRENT_IMAGES} 并发）", log_level='important')
         processing_state[hash_id].update({
             'ocr_progress': 0,
-            'ocr_status': 'Starting OCR...'
+            'ocr_status': 'Starting OCR...',
+            'generate_progress': 0,
+            'generate_status': 'Merging results as pages finish...'
         })
         
-        # 多进程处理
-        args_list = [
-            (img_path, str(work_dir), base_name, idx, hash_id, skip_existing)
-            for img_path, idx in valid_pages
-        ]
+        def ocr_tasks():
+            while True:
+                item = _get_until_stopped(page_queue, stop_event)
+                if item is None:
+                    return
+                page_idx, image, text_layer = item
+                yield (image, text_layer, str(work_dir), base_name, page_idx, hash_id, page_idx in cached_pages)
+        
+        # 3. 合并阶段：OCR 结果按页序增量写入合并文件
+        merger = IncrementalMerger(work_dir, base_name, hash_id, total_pages, pending_pages=page_indices)
         
-        results = []
-        ocr_start_time = time.time()
-        total_tasks = len(args_list)
+        success_count = 0
+        ocr_start_time = last_job_flush = time.time()
+        total_tasks = len(page_indices)
         last_logged_milestone = 0
         failed_pages = []
+        blank_pages = []
+        text_layer_pages = []
+        near_duplicates = {}  # page_idx -> 近似页面判定记录
+        phashes = {}
+        model_pages = []
+        hedged_pages = []
+        dead_letters = {}  # page_idx -> 失败记录（尝试次数与每次的错误），重新排队后仍失败的页面留在死信队列中
+        page_timings = {}  # page_idx -> 各阶段耗时、请求字节数、token 用量、后端与重试次数，写入任务清单供离线分析
+        retry_stats = {'retries': 0, 'pages_retried': 0, 'errors': {}}  # 本任务的推理重试统计
+        image_tokens = {'fixed': 0, 'sent': 0}  # 固定像素预算下的图像 token 与实际发送的图像 token
         
         # 限制并发数为 MAX_CONCURRENT_IMAGES，防止请求过多导致超时
-        with Pool(processes=MAX_CONCURRENT_IMAGES) as pool:
+        # OCR 主要在等待推理服务，使用线程池，页面图片直接在内存中传递
+        with ThreadPool(processes=MAX_CONCURRENT_IMAGES) as pool:
             # 使用 imap_unordered 以便更快更新进度
-            for i, result in enumerate(pool.imap_unordered(process_single_page, args_list)):
-                # Check if stopped
-                if processing_state[hash_id].get('stopped', False):
-                    pool.terminate()
-                    pool.join()
-                    raise Exception("Processing stopped by user")
+            try:
+                for i, (page_idx, result) in enumerate(pool.imap_unordered(process_single_page, ocr_tasks())):
+                    render_slots.release()
                 
-                if result:
-                    results.append(result)
-                else:
-                    # Track failed pages
-                    failed_pages.append(args_list[i][3])  # page_idx
+                    # Check if stopped
+                    if processing_state[hash_id].get('stopped', False):
+                        # 线程无法强制结束，正在进行的请求完成后线程自行退出，这里不等待
+                        stop_event.set()
+                        pool.terminate()
+                        raise Exception("Processing stopped by user")
+                
+                    if result is None or result.get('request_error'):
+                        route = 'failed'
+                    elif page_idx in cached_pages:
+                        route = 'reused' if page_idx in reused_pages else 'cached'
+                    else:
+                        route = result.get('route', 'model')
+                    METRICS.inc('pdf_converter_pages_total', route=route)
                 
-                # 计算进度和速度
-                completed_count = i + 1
-                progress = completed_count / total_tasks * 100
+                    if result is not None and page_idx not in cached_pages:
+                        page_timings[page_idx] = page_telemetry(result, raster_stats['render_times'].get(page_idx))
                 
-                elapsed_time = time.time() - ocr_start_time
-                speed = completed_count / elapsed_time if elapsed_time > 0 else 0 # pages per second
-                avg_time_per_page = elapsed_time / completed_count if completed_count > 0 else 0
-                remaining_tasks = total_tasks - completed_count
-                remaining_time = remaining_tasks * avg_time_per_page
+                    if result and result.get('retries'):
+                        retry_stats['retries'] += result['retries']
+                        retry_stats['pages_retried'] += 1
+                    for kind, n in ((result or {}).get('request_errors') or {}).items():
+                        retry_stats['errors'][kind] = retry_stats['errors'].get(kind, 0) + n
                 
-                # 计算预计完成时间 (UTC+8)
-                utc_now = datetime.now(timezone.utc)
-                utc_plus_8 = timezone(timedelta(hours=8))
-                eta_time = utc_now + timedelta(seconds=remaining_time)
-                eta_str = eta_time.astimezone(utc_plus_8).strftime("%H:%M:%S")
+                    if result and result.get('request_error'):
+                        # 重试后推理仍失败：页面只有错误占位内容，计为失败页
+                        failed_pages.append(page_idx)
+                        dead_letters[page_idx] = {'attempts': 1, 'errors': [{'settings': {}, 'error': result['request_error']}]}
+                    elif result:
+                        success_count += 1
+                        done_pages.add(page_idx)
+                        if result.get('near_duplicate'):
+                            near_duplicates[page_idx] = result['near_duplicate']
+                        if result.get('phash'):
+                            phashes[page_idx] = result['phash']
+                        if result.get('skipped_blank'):
+                            blank_pages.append(page_idx)
+                        elif result.get('route') == 'text_layer':
+                            text_layer_pages.append(page_idx)
+                        elif result.get('route') == 'model':
+                            model_pages.append(page_idx)
+                            if result.get('hedged'):
+                                hedged_pages.append(page_idx)
+                            image_tokens['fixed'] += result.get('fixed_image_tokens', 0)
+                            image_tokens['sent'] += result.get('image_tokens', 0)
+                    else:
+                        # Track failed pages
+                        failed_pages.append(page_idx)
+                        dead_letters[page_idx] = {'attempts': 1, 'errors': [{'settings': {}, 'error': 'error'}]}
                 
-                status_msg = f'Page {completed_count}/{total_tasks} | Speed: {speed:.2f} p/s | ETA: {eta_str}'
+                    # 失败页面等重新排队后再写入合并文件，之后的页面先记录为就绪
+                    if not (REQUEUE_FAILED_PAGES and page_idx in dead_letters):
+                        merger.add(page_idx)
                 
-                processing_state[hash_id].update({
-                    'ocr_progress': progress,
-                    'ocr_status': status_msg,
-                    'speed': f"{speed:.2f}",
-                    'eta': eta_str,
-                    'remaining_time': f"{remaining_time:.0f}s"
-                })
+                    # 计算进度和速度
+                    completed_count = i + 1
+                    progress = completed_count / total_tasks * 100
+                
+                    elapsed_time = time.time() - ocr_start_time
+                    speed = completed_count / elapsed_time if elapsed_time > 0 else 0 # pages per second
+                    avg_time_per_page = elapsed_time / completed_count if completed_count > 0 else 0
+                    remaining_tasks = total_tasks - completed_count
+                    remaining_time = remaining_tasks * avg_time_per_page
+                
+                    # 计算预计完成时间 (UTC+8)
+                    utc_now = datetime.now(timezone.utc)
+                    utc_plus_8 = timezone(timedelta(hours=8))
+                    eta_time = utc_now + timedelta(seconds=remaining_time)
+                    eta_str = eta_time.astimezone(utc_plus_8).strftime("%H:%M:%S")
                 
-                # 只在50%里程碑记录一次重要日志，避免刷屏
-                current_milestone = int(progress / 50) * 50
-                if current_milestone > last_logged_milestone and current_milestone == 50:
-                    log_to_state(hash_id, f"📊 OCR 进度: {current_milestone}% ({completed_count}/{total_tasks} 页，速度: {speed:.2f} p/s)", log_level='important')
-                    last_logged_milestone = current_milestone
+                    status_msg = f'Page {completed_count}/{total_tasks} | Speed: {speed:.2f} p/s | ETA: {eta_str}'
+                    if text_layer_pages:
+                        status_msg += f' | Text layer: {len(text_layer_pages)}'
+                    if blank_pages:
+                        status_msg += f' | Blank: {len(blank_pages)}'
+                    near_duplicate_count = sum(1 for d in near_duplicates.values() if d['reused'])
+                    if near_duplicate_count:
+                        status_msg += f' | Near-duplicate: {near_duplicate_count}'
+                    if retry_stats['retries']:
+                        status_msg += f' | Retries: {retry_stats["retries"]}'
+                    if processing_state[hash_id].get('pages_in_flight'):
+                        status_msg += f' | In flight: {processing_state[hash_id]["pages_in_flight"]}'
+                
+                    processing_state[hash_id].update({
+                        'ocr_progress': progress,
+                        'skipped_blank': len(blank_pages),
+                        'near_duplicate_pages': near_duplicate_count,
+                        'image_tokens_saved': image_tokens['fixed'] - image_tokens['sent'],
+                        'retries': retry_stats['retries'],
+                        'text_layer_pages': len(text_layer_pages),
+                        'ocr_status': status_msg,
+                        'speed': f"{speed:.2f}",
+                        'eta': eta_str,
+                        'remaining_time': f"{remaining_time:.0f}s",
+                        'generate_progress': merger.merged_pages / total_pages * 100,
+                        'generate_status': f'Merged {merger.merged_pages}/{total_pages}'
+                    })
+                    if time.time() - last_job_flush >= JOB_PROGRESS_FLUSH:
+                        get_job_store().update(hash_id, progress=processing_state[hash_id], pages_done=pages_to_bitmap(done_pages, total_pages))
+                        last_job_flush = time.time()
+                
+                    # 只在50%里程碑记录一次重要日志，避免刷屏
+                    current_milestone = int(progress / 50) * 50
+                    if current_milestone > last_logged_milestone and current_milestone == 50:
+                        log_to_state(hash_id, f"📊 OCR 进度: {current_milestone}% ({completed_count}/{total_tasks} 页，速度: {speed:.2f} p/s)", log_level='important')
+                        last_logged_milestone = current_milestone
+        
+            except BaseException:
+                # 先通知拆图阶段停止，否则 terminate 会一直等待阻塞在任务队列上的任务线程
+                stop_event.set()
+                raise
+        
+        if not raster_stats['extracted']:
+            raise Exception("No images extracted from PDF")
+        
+        # 失败页面在其余页面完成后用逐级加强的设置重新识别（只重新生成这些页面，合并文件此时才写入它们）
+        recovered = {}
+        if REQUEUE_FAILED_PAGES and dead_letters:
+            log_to_state(hash_id, f"📮 {len(dead_letters)} 页识别失败，使用加强设置重新排队...", log_level='important')
+            processing_state[hash_id]['ocr_status'] = f'Requeueing {len(dead_letters)} failed pages...'
+            image_writer.shutdown(wait=True)  # 重试读取落盘的页面原图
+            recovered = requeue_failed_pages(pdf_path, work_dir, base_name, hash_id, list(dead_letters), dead_letters, REQUEUE_ESCALATION)
+            if processing_state[hash_id].get('stopped', False):
+                raise Exception("Processing stopped by user")
+            for page_idx, result in recovered.items():
+                page_timings[page_idx] = page_telemetry(result, raster_stats['render_times'].get(page_idx))
+                if result.get('phash'):
+                    phashes[page_idx] = result['phash']
+                success_count += 1
+                done_pages.add(page_idx)
+                model_pages.append(page_idx)
+                image_tokens['fixed'] += result.get('fixed_image_tokens', 0)
+                image_tokens['sent'] += result.get('image_tokens', 0)
+            failed_pages = [idx for idx in failed_pages if idx not in recovered]
+            log_to_state(hash_id, f"📮 重新识别恢复 {len(recovered)} 页" + (f"，{len(dead_letters)} 页仍失败，已记入死信队列" if dead_letters else ""), log_level='important')
         
         ocr_elapsed = time.time() - ocr_start_time
         processing_state[hash_id].update({
@@ -499,120 +1907,65 @@ def process_pdf_background(pdf_path, work_dir, base_name, hash_id, process_mode,
         })
         
         # Log completion summary
-        success_count = len(results)
         fail_count = len(failed_pages)
         if fail_count > 0:
             log_to_state(hash_id, f"✅ OCR 识别完成，耗时 {ocr_elapsed:.1f}秒\n成功: {success_count}/{total_tasks} 页，失败: {fail_count} 页", log_level='important')
             if fail_count <= 10:
-                log_to_state(hash_id, f"失败页面: {', '.join(map(str, failed_pages))}", log_level='important')
+                log_to_state(hash_id, f"失败页面: {', '.join(map(str, sorted(failed_pages)))}", log_level='important')
         else:
             log_to_state(hash_id, f"✅ OCR 识别完成，耗时 {ocr_elapsed:.1f}秒，全部 {success_count} 页识别成功", log_level='important')
+        if text_layer_pages:
+            log_to_state(hash_id, f"📝 文本层直接提取 {len(text_layer_pages)} 页，模型识别 {len(model_pages)} 页", log_level='important')
+        if blank_pages:
+            log_to_state(hash_id, f"⬜ 跳过空白页 {len(blank_pages)} 页（未发送推理请求）", log_level='important')
+        if ADAPTIVE_PIXEL_BUDGET and image_tokens['sent']:
+            saved = image_tokens['fixed'] - image_tokens['sent']
+            log_to_state(hash_id, f"🔬 自适应像素预算：图像 token {image_tokens['fixed']} → {image_tokens['sent']}（节省 {saved}，"
+                                  f"{saved / image_tokens['fixed'] * 100:.0f}%），预填充吞吐约为固定预算的 {image_tokens['fixed'] / image_tokens['sent']:.2f} 倍", log_level='important')
+        if retry_stats['retries'] or retry_stats['errors']:
+            errors = ', '.join(f"{kind} {n}" for kind, n in sorted(retry_stats['errors'].items()))
+            log_to_state(hash_id, f"🔄 推理重试 {retry_stats['retries']} 次（{retry_stats['pages_retried']} 页），错误分类: {errors or '无'}", log_level='important')
+        if hedged_pages:
+            log_to_state(hash_id, f"🏁 {len(hedged_pages)} 页请求超过 P{HEDGE_PERCENTILE * 100:.0f} 延迟，已在其他后端重发（先返回者生效）", log_level='important')
+        near_duplicate_pages = sorted(idx for idx, d in near_duplicates.items() if d['reused'])
+        if near_duplicate_pages:
+            log_to_state(hash_id, f"🔁 {len(near_duplicate_pages)} 页与历史页面近似重复（汉明距离 ≤ {NEAR_DUPLICATE_THRESHOLDS['max_distance']}），复用识别结果", log_level='important')
         
-        # 3. 生成文档阶段
-        log_to_state(hash_id, "📝 开始合并结果并生成文档...", log_level='important')
-        processing_state[hash_id].update({
-            'generate_progress': 10,
-            'generate_status': 'Merging results...'
-        })
-        
-        all_cells = []
-        all_md_parts = []
-        
-        # Filter results to ensure they are valid dictionaries
-        valid_results = [r for r in results if isinstance(r, dict) and 'page_no' in r]
-        
-        # Create a map of page_no to result for easy lookup
-        result_map = {r['page_no']: r for r in valid_results}
-        
-        # Iterate through ALL pages, not just the ones in results
-        # This ensures we generate a complete document even if some pages failed completely
-        for page_idx in range(total_pages):
-            result = result_map.get(page_idx)
-            
-            # Try to load JSON
-            json_loaded = False
-            if result and 'layout_info_path' in result and result['layout_info_path'] and os.path.exists(result['layout_info_path']):
-                try:
-                    with open(result['layout_info_path'], 'r', encoding='utf-8') as f:
-                        cells = json.load(f)
-                        all_cells.append({'page': page_idx, 'cells': cells})
-                        json_loaded = True
-                except Exception as e:
-                    log_to_state(hash_id, f"Warning: Failed to load JSON for page {page_idx}: {e}", log_level='normal')
-            
-            if not json_loaded:
-                # Add empty cells for failed/missing pages
-                all_cells.append({'page': page_idx, 'cells': []})
-
-            # Try to load Markdown
-            md_loaded = False
-            if result and 'md_content_path' in result and result['md_content_path'] and os.path.exists(result['md_content_path']):
-                try:
-                    with open(result['md_content_path'], 'r', encoding='utf-8') as f:
-                        md_content = f.read()
-                        all_md_parts.append(f"# Page {page_idx + 1}\n\n{md_content}")
-                        md_loaded = True
-                except Exception as e:
-                    log_to_state(hash_id, f"Warning: Failed to load Markdown for page {page_idx}: {e}", log_level='normal')
-            
-            if not md_loaded:
-                # Fallback for missing markdown
-                all_md_parts.append(f"# Page {page_idx + 1}\n\n[Content missing or processing failed]")
-        
-        processing_state[hash_id].update({
-            'generate_progress': 40,
-            'generate_status': 'Saving JSON...'
-        })
-        
-        # 保存合并的JSON
-        combined_json_path = work_dir / f"{base_name}_{hash_id}_combined.json"
-        with open(combined_json_path, 'w', encoding='utf-8') as f:
-            json.dump(all_cells, f, ensure_ascii=False, indent=2)
-        
-        processing_state[hash_id].update({
-            'generate_progress': 60,
-            'generate_status': 'Saving Markdown...'
-        })
-        
-        # 保存合并的MD
-        combined_md = '\n\n---\n\n'.join(all_md_parts)
-        combined_md_path = work_dir / f"{base_name}_{hash_id}_combined.md"
-        with open(combined_md_path, 'w', encoding='utf-8') as f:
-            f.write(combined_md)
-        
-        # 保存合并的TXT
-        combined_txt_path = work_dir / f"{base_name}_{hash_id}_combined.txt"
-        create_txt_file(combined_md, str(combined_txt_path))
-        
+        # 最后只需写入剩余页面
+        merger.finish()
+        image_writer.shutdown(wait=True)
         log_to_state(hash_id, "💾 已保存 JSON、Markdown、TXT 文件", log_level='normal')
-
-        processing_state[hash_id].update({
-            'generate_progress': 75,
-            'generate_status': 'Creating DOCX...'
-        })
-        
-        # 生成DOCX (Pass list of parts for splitting)
-        docx_path = work_dir / f"{base_name}_{hash_id}.docx"
-        generated_files = markdown_to_docx(all_md_parts, str(docx_path), split_every=300)
         
-        log_to_state(hash_id, f"📄 已生成 {len(generated_files)} 个 DOCX 文件", log_level='normal')
-        
-        processing_state[hash_id].update({
-            'generate_progress': 90,
-            'generate_status': 'Creating ZIP...'
+        # 4. 完成：页面结果已落盘，其余下载产物在首次请求时生成
+        processing_time = f"{time.time() - start_time:.1f}s"
+        write_manifest(work_dir, base_name, hash_id, {
+            'filename': filename,
+            'total_pages': total_pages,
+            'processed_pages': page_indices,
+            'failed_pages': sorted(failed_pages),
+            'skipped_blank': sorted(blank_pages),
+            'text_layer_pages': sorted(text_layer_pages),
+            'reused_pages': reused_pages,
+            'near_duplicates': {idx: near_duplicates[idx] for idx in sorted(near_duplicates)},
+            'image_tokens': image_tokens,
+            'hedged_pages': sorted(hedged_pages),
+            'retries': retry_stats,
+            'recovered_pages': sorted(recovered),
+            'dead_letter': {idx: dead_letters[idx] for idx in sorted(dead_letters)},
+            'page_timings': {idx: page_timings[idx] for idx in sorted(page_timings)},
+            'processing_time': processing_time,
+            'completed_at': datetime.now(timezone.utc).isoformat()
         })
         
-        # 创建ZIP
-        create_zip_package(work_dir, base_name, hash_id)
-        
-        log_to_state(hash_id, "📦 ZIP 打包完成", log_level='normal')
-        
-        processing_time = f"{time.time() - start_time:.1f}s"
+        page_features = {idx: raster_stats['features'][idx] for idx in model_pages if idx in raster_stats['features']}
+        if fingerprints or phashes or page_features:
+            failed = set(failed_pages)
+            record_page_index(work_dir, base_name, [idx for idx in page_indices if idx not in failed], fingerprints, phashes, page_features)
         
         # 完成
         processing_state[hash_id].update({
             'generate_progress': 100,
-            'generate_status': 'Complete',
+            'generate_status': 'Complete (files are generated on download)',
             'complete': True,
             'filename': filename,
             'total_pages': total_pages,
@@ -620,9 +1973,17 @@ def process_pdf_background(pdf_path, work_dir, base_name, hash_id, process_mode,
             'processing_time': processing_time
         })
         
+        get_job_store().update(hash_id, state='complete', progress=processing_state[hash_id], pages_done=pages_to_bitmap(done_pages, total_pages))
         log_to_state(hash_id, f"🎉 处理完成！\n📊 总页数: {total_pages}\n⏱️ 总耗时: {processing_time}\n📦 文件已准备好下载", log_level='important')
+        
+        for kind in PREWARM_ARTIFACTS:
+            prewarm_queue.put((work_dir, base_name, hash_id, kind))
+        if IDLE_RETRY_DEAD_LETTERS and dead_letters:
+            dead_letter_queue.put((pdf_path, work_dir, base_name, hash_id))
     
     except Exception as e:
+        if merger is not None and merger.merged_pages < merger.total_pages:
+            merger.abort()
         error_msg = str(e)
         log_to_state(hash_id, f"处理失败: {error_msg}", log_level='important')
         processing_state[hash_id].update({
@@ -630,6 +1991,31 @@ def process_pdf_background(pdf_path, work_dir, base_name, hash_id, process_mode,
             'error': error_msg
         })
         logger.error(f"Processing error: {traceback.format_exc()}")
+        try:
+            fields = {'pages_done': pages_to_bitmap(done_pages, total_pages)} if done_pages is not None else {}
+            get_job_store().update(hash_id, state='stopped' if processing_state[hash_id].get('stopped') else 'failed', error=error_msg,
+                                   progress=processing_state[hash_id], **fields)
+        except Exception as store_error:
+            logger.warning(f"[{hash_id}] Failed to record job state: {store_error}")
+    finally:
+        stop_event.set()
+        if image_writer is not None:
+            image_writer.shutdown(wait=False)
+
+def render_metrics():
+    """/metrics 的内容：累计的计数器和直方图，加上抓取时读取的队列、并发和重试预算"""
+    pool_status = parser.backend_pool.status()
+    backends = pool_status['backends']
+    active = sum(1 for state in list(processing_state.values()) if state.get('status') == 'Processing' and not state.get('complete'))
+    return METRICS.render([
+        ('pdf_converter_queue_depth', "Jobs waiting in a queue, by queue (jobs, prewarm, dead_letter)",
+         [({'queue': 'jobs'}, task_queue.qsize()), ({'queue': 'prewarm'}, prewarm_queue.qsize()), ({'queue': 'dead_letter'}, dead_letter_queue.qsize())]),
+        ('pdf_converter_active_jobs', "Jobs currently being processed", [({}, active)]),
+        ('dots_ocr_requests_in_flight', "Inference requests in flight, by backend", [({'backend': b['backend']}, b['in_flight']) for b in backends]),
+        ('dots_ocr_tokens_in_flight', "Tokens reserved by requests in flight, by backend", [({'backend': b['backend']}, b['tokens_in_flight']) for b in backends]),
+        ('dots_ocr_requests_waiting', "Inference requests waiting for backend capacity", [({}, pool_status['waiting'])]),
+        ('dots_ocr_retry_budget', "Retry tokens left in the process-wide retry budget", [({}, parser.retry_policy.status()['budget'])]),
+    ])
 
 def worker():
     """Background worker to process PDFs sequentially"""
@@ -648,7 +2034,9 @@ def worker():
                 log_to_state(hash_id, "Starting processing...", log_level='normal')
             
             try:
-                func(*args)
+                # 同一任务的空闲死信重试正在写入页面时等待其结束
+                with job_lock(hash_id):
+                    func(*args)
             except Exception as e:
                 logger.error(f"Error in worker for {hash_id}: {e}")
                 if hash_id in processing_state:
@@ -686,7 +2074,8 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                 info = {
                     'max_concurrent_images': MAX_CONCURRENT_IMAGES,
                     'max_concurrent_pdfs': MAX_CONCURRENT_PDFS,
-                    'queue_size': task_queue.qsize()
+                    'queue_size': task_queue.qsize(),
+                    'retry': parser.retry_policy.status()
                 }
                 response_data = json.dumps(info).encode('utf-8')
                 self.send_response(200)
@@ -696,6 +2085,15 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                 self.wfile.write(response_data)
                 return
 
+            if self.path == '/metrics':
+                response_data = render_metrics().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(response_data)))
+                self.end_headers()
+                self.wfile.write(response_data)
+                return
+
             if self.path == '/settings':
                 settings = {
                     'max_concurrent_images': MAX_CONCURRENT_IMAGES,
@@ -710,7 +2108,21 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                 return
 
             if self.path.startswith('/progress/'):
-                hash_id = self.path.split('/')[-1]
+                url = urlparse(self.path)
+                hash_id = url.path.split('/')[-1]
+                cursor = parse_qs(url.query).get('cursor')
+                job = None if hash_id in processing_state else get_job_store().get(hash_id)
+                if job:
+                    # 服务重启前已结束的任务：使用任务表中保存的进度
+                    processing_state.setdefault(hash_id, {
+                        **json.loads(job['progress'] or '{}'),
+                        'complete': job['state'] in ('complete', 'failed', 'stopped'),
+                        'error': job['error'],
+                        'status': job['state'].capitalize(),
+                        'filename': job['filename'],
+                        'total_pages': job['total_pages'],
+                        'hash_id': hash_id
+                    })
                 state = processing_state.get(hash_id, {
                     'extract_progress': 0,
                     'extract_status': 'Unknown',
@@ -720,6 +2132,10 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                     'generate_status': 'Unknown',
                     'complete': False
                 })
+                if cursor:
+                    # 只返回客户端游标之后的日志条目；log_truncated 表示中间有条目已被环形缓冲区丢弃
+                    entries, next_cursor, truncated = job_log(hash_id).since(int(cursor[0]) if cursor[0].isdigit() else 0)
+                    state = {**state, 'logs': entries, 'log_cursor': next_cursor, 'log_truncated': truncated}
                 
                 response_data = json.dumps(state).encode('utf-8')
                 self.send_response(200)
@@ -738,30 +2154,23 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                 hash_id = parts[2]
                 file_type = parts[3]
                 
+                if file_type not in ARTIFACT_TYPES:
+                    self.send_error(400, "Invalid file type")
+                    return
+                
                 for item in DATA_DIR.iterdir():
                     if item.is_dir() and hash_id in item.name:
                         base_name = item.name.replace(f"_{hash_id}", "")
                         
-                        if file_type == 'zip':
-                            zip_path = item / f"{base_name}_{hash_id}.zip"
-                            if zip_path.exists():
-                                self.send_file(zip_path, 'application/zip')
-                                return
-                        elif file_type == 'images_zip':
-                            zip_path = item / f"{base_name}_{hash_id}_images.zip"
-                            if zip_path.exists():
-                                self.send_file(zip_path, 'application/zip')
-                                return
-                        elif file_type == 'docx':
-                            docx_path = item / f"{base_name}_{hash_id}.docx"
-                            if docx_path.exists():
-                                self.send_file(docx_path, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-                                return
-                        elif file_type == 'txt':
-                            txt_path = item / f"{base_name}_{hash_id}_combined.txt"
-                            if txt_path.exists():
-                                self.send_file(txt_path, 'text/plain')
-                                return
+                        # 首次请求时生成产物，之后直接使用缓存
+                        file_path = ensure_artifact(item, base_name, hash_id, file_type)
+                        if file_path and file_type == 'docx' and not file_path.exists():
+                            # 超长文档被拆分为多个 DOCX，改为发送包含全部分卷的 ZIP 包
+                            file_type = 'zip'
+                            file_path = ensure_artifact(item, base_name, hash_id, file_type)
+                        if file_path and file_path.exists():
+                            self.send_file(file_path, ARTIFACT_TYPES[file_type])
+                            return
                 
                 self.send_error(404, "File not found")
                 return
@@ -802,32 +2211,27 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                                     file_info['processing_progress'] = int((extract_prog + ocr_prog + gen_prog) / 3)
                             
                             # Check what files exist
-                            json_file = item / f"{base_name}_{hash_id}_combined.json"
-                            if json_file.exists():
-                                file_info['has_json'] = True
-                                try:
-                                    with open(json_file, 'r', encoding='utf-8') as f:
-                                        data = json.load(f)
-                                        file_info['pages'] = len(data)
-                                except:
-                                    pass
-                            
-                            md_file = item / f"{base_name}_{hash_id}_combined.md"
-                            if md_file.exists():
-                                file_info['has_md'] = True
-                            
-                            docx_path = item / f"{base_name}_{hash_id}.docx"
-                            if docx_path.exists():
-                                file_info['has_docx'] = True
-                            
-                            zip_path = item / f"{base_name}_{hash_id}.zip"
-                            if zip_path.exists():
-                                file_info['has_zip'] = True
-                                file_info['status'] = 'complete'
-                            
-                            images_zip_path = item / f"{base_name}_{hash_id}_images.zip"
-                            if images_zip_path.exists():
-                                file_info['has_images_zip'] = True
+                            manifest = load_manifest(item, base_name, hash_id)
+                            if manifest is not None:
+                                # 页面结果已全部落盘，所有产物均可按需生成
+                                file_info['pages'] = manifest.get('total_pages', 0)
+                                for key in ('has_zip', 'has_docx', 'has_json', 'has_md', 'has_images_zip'):
+                                    file_info[key] = True
+                            else:
+                                json_file = item / f"{base_name}_{hash_id}_combined.json"
+                                if json_file.exists():
+                                    file_info['has_json'] = True
+                                    try:
+                                        with open(json_file, 'r', encoding='utf-8') as f:
+                                            data = json.load(f)
+                                            file_info['pages'] = len(data)
+                                    except:
+                                        pass
+                                
+                                file_info['has_md'] = (item / f"{base_name}_{hash_id}_combined.md").exists()
+                                file_info['has_docx'] = (item / f"{base_name}_{hash_id}.docx").exists()
+                                file_info['has_zip'] = (item / f"{base_name}_{hash_id}.zip").exists()
+                                file_info['has_images_zip'] = (item / f"{base_name}_{hash_id}_images.zip").exists()
                             
                             # Determine status based on files (if not processing)
                             if not file_info['is_processing']:
@@ -988,7 +2392,9 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                 
                 boundary = content_type.split('boundary=')[1].encode()
                 content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
+                with METRICS.time('pdf_converter_upload_receive_seconds'):
+                    post_data = self.rfile.read(content_length)
+                METRICS.inc('pdf_converter_upload_bytes_total', len(post_data))
                 
                 # 解析multipart数据
                 parts = post_data.split(b'--' + boundary)
@@ -1022,11 +2428,14 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                 
                 # 检查是否已存在
                 if work_dir.exists():
+                    manifest = load_manifest(work_dir, base_name, hash_id)
                     docx_path = work_dir / f"{base_name}_{hash_id}.docx"
-                    if docx_path.exists():
+                    if manifest is not None or docx_path.exists():
                         json_file = work_dir / f"{base_name}_{hash_id}_combined.json"
                         pages = 0
-                        if json_file.exists():
+                        if manifest is not None:
+                            pages = manifest.get('total_pages', 0)
+                        elif json_file.exists():
                             with open(json_file, 'r', encoding='utf-8') as f:
                                 pages = len(json.load(f))
                         
@@ -1066,14 +2475,11 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                     'log': 'Added to queue',
                     'status': 'Queued'
                 }
+                job_log(hash_id).append('important', processing_state[hash_id]['log'])
                 
                 # Add to queue instead of starting thread directly
                 logger.info(f"Queueing task for {filename} ({hash_id})")
-                task_queue.put((
-                    process_pdf_background,
-                    (pdf_path, work_dir, base_name, hash_id, process_mode, filename),
-                    hash_id
-                ))
+                enqueue_job(pdf_path, work_dir, base_name, hash_id, process_mode, filename)
                 
                 response = {'hash_id': hash_id, 'already_exists': False, 'status': 'queued'}
                 response_data = json.dumps(response).encode('utf-8')
@@ -1174,13 +2580,10 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                     'log': 'Reprocessing queued',
                     'status': 'Queued'
                 }
+                job_log(hash_id).append('important', processing_state[hash_id]['log'])
                 
                 # Add to queue
-                task_queue.put((
-                    process_pdf_background,
-                    (pdf_path, work_dir, base_name, hash_id, process_mode, pdf_path.name, True),
-                    hash_id
-                ))
+                enqueue_job(pdf_path, work_dir, base_name, hash_id, process_mode, pdf_path.name, True)
                 
                 response = {'hash_id': hash_id, 'status': 'queued'}
                 response_data = json.dumps(response).encode('utf-8')
@@ -1208,55 +2611,39 @@ class PDFConverterHandler(http.server.BaseHTTPRequestHandler):
                 batch_zip_path = DATA_DIR / batch_zip_name
                 
                 try:
-                    with zipfile.ZipFile(batch_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                        for hash_id in hash_ids:
-                            # Find the file directory
-                            found = False
-                            for item in DATA_DIR.iterdir():
-                                if item.is_dir() and hash_id in item.name:
-                                    base_name = item.name.replace(f"_{hash_id}", "")
-                                    
-                                    # Try to add the individual zip package first (contains all files)
-                                    zip_package = item / f"{base_name}_{hash_id}.zip"
-                                    if zip_package.exists():
-                                        # Add the entire zip package to the batch zip
-                                        zipf.write(zip_package, f"{base_name}/{base_name}_{hash_id}.zip")
-                                        found = True
-                                    else:
-                                        # If no zip package, add individual files
-                                        files_added = False
-                                        
-                                        # Add DOCX if exists
-                                        docx_path = item / f"{base_name}_{hash_id}.docx"
-                                        if docx_path.exists():
-                                            zipf.write(docx_path, f"{base_name}/{base_name}_{hash_id}.docx")
-                                            files_added = True
-                                        
-                                        # Add combined markdown if exists
-                                        md_path = item / f"{base_name}_{hash_id}_combined.md"
-                                        if md_path.exists():
-                                            zipf.write(md_path, f"{base_name}/{base_name}_{hash_id}.md")
-                                            files_added = True
-                                        
-                                        # Add combined txt if exists
-                                        txt_path = item / f"{base_name}_{hash_id}_combined.txt"
-                                        if txt_path.exists():
-                                            zipf.write(txt_path, f"{base_name}/{base_name}_{hash_id}.txt")
-                                            files_added = True
-                                        
-                                        # Add combined json if exists
-                                        json_path = item / f"{base_name}_{hash_id}_combined.json"
-                                        if json_path.exists():
-                                            zipf.write(json_path, f"{base_name}/{base_name}_{hash_id}.json")
-                                            files_added = True
-                                        
-                                        if files_added:
+                    entries = []
+                    for hash_id in hash_ids:
+                        # Find the file directory
+                        found = False
+                        for item in DATA_DIR.iterdir():
+                            if item.is_dir() and hash_id in item.name:
+                                base_name = item.name.replace(f"_{hash_id}", "")
+                                
+                                # Try to add the individual zip package first (contains all files)
+                                zip_package = ensure_artifact(item, base_name, hash_id, 'zip')
+                                if zip_package and zip_package.exists():
+                                    # Add the entire zip package to the batch zip
+                                    entries.append((zip_package, f"{base_name}/{base_name}_{hash_id}.zip"))
+                                    found = True
+                                else:
+                                    # If no zip package, add individual files
+                                    candidates = [
+                                        (item / f"{base_name}_{hash_id}.docx", f"{base_name}/{base_name}_{hash_id}.docx"),
+                                        (item / f"{base_name}_{hash_id}_combined.md", f"{base_name}/{base_name}_{hash_id}.md"),
+                                        (item / f"{base_name}_{hash_id}_combined.txt", f"{base_name}/{base_name}_{hash_id}.txt"),
+                                        (item / f"{base_name}_{hash_id}_combined.json", f"{base_name}/{base_name}_{hash_id}.json"),
+                                    ]
+                                    for src, arcname in candidates:
+                                        if src.exists():
+                                            entries.append((src, arcname))
                                             found = True
-                                    
-                                    break
-                            
-                            if not found:
-                                logger.warning(f"No files found for batch download: {hash_id}")
+                                
+                                break
+                        
+                        if not found:
+                            logger.warning(f"No files found for batch download: {hash_id}")
+                    
+                    write_zip(batch_zip_path, entries)
                     
                     # Check if zip file has any content
                     if batch_zip_path.stat().st_size > 100:  # More than just empty zip structure
@@ -1303,8 +2690,13 @@ def run(port=PORT):
         
     httpd = server_class(server_address, PDFConverterHandler)
     
-    # Start the worker thread
+    subscribe_parser_events(parser)
+    
+    # 重新加入上次未完成的任务，再启动工作线程
+    recover_jobs()
     threading.Thread(target=worker, daemon=True).start()
+    threading.Thread(target=prewarm_worker, daemon=True).start()
+    threading.Thread(target=dead_letter_worker, daemon=True).start()
     
     print("=" * 60)
     print(f"PDF to DOCX Converter Server")
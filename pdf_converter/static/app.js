@@ -20,29 +20,40 @@ const concurrencyInput = document.getElementById('concurrencyInput');
 const saveSettingsBtn = document.getElementById('saveSettingsBtn');
 
 // Logger (simplified for batch mode)
+const MAX_LOG_ENTRIES = 500; // Same bound as the server-side job log
+
 class Logger {
     constructor(containerId) {
         this.container = document.getElementById(containerId);
         this.entries = [];
     }
     
-    log(message, type = 'info') {
-        const timestamp = new Date().toLocaleTimeString();
+    log(message, type = 'info', time = null) {
+        const timestamp = time || new Date().toLocaleTimeString();
         const entry = { time: timestamp, message: message, type: type };
         this.entries.push(entry);
-        this.render();
+        if (!this.container) return;
+        // Append only the new entry instead of re-rendering the whole log
+        if (this.entries.length > MAX_LOG_ENTRIES) {
+            this.entries.shift();
+            if (this.container.firstElementChild) this.container.firstElementChild.remove();
+        }
+        this.container.insertAdjacentHTML('beforeend', this.renderEntry(entry));
+        this.container.scrollTop = this.container.scrollHeight;
     }
     
-    info(message) { this.log(message, 'info'); }
-    success(message) { this.log(message, 'success'); }
-    warning(message) { this.log(message, 'warning'); }
-    error(message) { this.log(message, 'error'); }
+    info(message, time = null) { this.log(message, 'info', time); }
+    success(message, time = null) { this.log(message, 'success', time); }
+    warning(message, time = null) { this.log(message, 'warning', time); }
+    error(message, time = null) { this.log(message, 'error', time); }
+    
+    renderEntry(entry) {
+        return `<div class="log-entry log-${entry.type}"><span class="log-time">[${entry.time}]</span> ${entry.message}</div>`;
+    }
     
     render() {
         if (!this.container) return;
-        this.container.innerHTML = this.entries.map(entry => 
-            `<div class="log-entry log-${entry.type}"><span class="log-time">[${entry.time}]</span> ${entry.message}</div>`
-        ).join('');
+        this.container.innerHTML = this.entries.map(entry => this.renderEntry(entry)).join('');
         this.container.scrollTop = this.container.scrollHeight;
     }
     
@@ -465,6 +476,10 @@ function showDetail(id) {
     const item = fileQueue.find(f => f.id === id);
     if (!item) return;
     
+    // The log panel shows this file's job log, fetched again from the start of the server's buffer
+    logger.clear();
+    item.logCursor = 0;
+    
     document.getElementById('progressSection').style.display = 'block';
     document.getElementById('detailTitle').textContent = `詳情: ${item.file.name}`;
     
@@ -562,7 +577,7 @@ function showDetail(id) {
     }
 }
 
-function updateDetailView(data) {
+function updateDetailView(data, item = null) {
     if (data.extract_progress !== undefined) {
         updateProgress('extract', data.extract_progress, data.extract_status);
     }
@@ -573,11 +588,15 @@ function updateDetailView(data) {
         updateProgress('generate', data.generate_progress, data.generate_status);
     }
     
-    if (data.log) {
-        const lastEntry = logger.entries[logger.entries.length - 1];
-        if (!lastEntry || lastEntry.message !== data.log) {
-            logger.info(data.log);
+    // Only requests made with a cursor carry log entries (the entries after the cursor)
+    if (data.logs && item) {
+        if (data.log_truncated) {
+            logger.warning('（較早的日誌已省略）');
         }
+        data.logs.filter(entry => entry.level === 'important').forEach(entry => {
+            logger.info(entry.message, new Date(entry.time * 1000).toLocaleTimeString());
+        });
+        item.logCursor = data.log_cursor;
     }
 }
 
@@ -730,7 +749,7 @@ async function pollDetailProgress() {
     }
     
     try {
-        const response = await fetch(`/progress/${item.hashId}`);
+        const response = await fetch(`/progress/${item.hashId}?cursor=${item.logCursor || 0}`);
         if (response.ok) {
             const data = await response.json();
             
@@ -741,8 +760,8 @@ async function pollDetailProgress() {
                 return;
             }
 
-            // Update progress bars
-            updateDetailView(data);
+            // Update progress bars and append new log entries
+            updateDetailView(data, item);
             
             // Update item in queue
             if (data.complete) {
@@ -0,0 +1,30 @@
+"""Blank pages skipped without an inference request are reported under route 'blank', in the page result and in the
+per-route page histogram, not as model pages"""
+
+import sys
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "pdf_converter"))
+
+import server
+from dots_ocr_lib import METRICS, DotsOCRParser
+
+
+def test_blank_page_route(tmp_path):
+    # Nothing listens on port 9: a page that is not detected as blank would fail its request instead
+    parser = DotsOCRParser(port=9, skip_blank=True, output_dir=str(tmp_path))
+    finished = []
+    parser.on('page_finished', lambda **event: finished.append(event['result']['route']))
+    server.subscribe_parser_events(parser)
+    before = METRICS.values.get(('pdf_converter_page_seconds', (('route', 'blank'),)), [0])[-1]
+
+    image = Image.new('RGB', (1000, 1400), 'white')
+    ImageDraw.Draw(image).point([(500, 700), (501, 700)], fill='black')  # scanner speck
+    result = parser._parse_single_image(image, 'prompt_layout_all_en', str(tmp_path), 'doc', 'pdf', 0)
+
+    assert result['skipped_blank'] and result['route'] == 'blank'
+    assert finished == ['blank']
+    assert METRICS.values[('pdf_converter_page_seconds', (('route', 'blank'),))][-1] == before + 1
+    assert server.page_telemetry(result)['route'] == 'blank'
@@ -0,0 +1,50 @@
+"""The combined JSON is identical whether it is merged incrementally during the job or built on demand, and keeps the
+json.dump(all_cells, indent=2) format of earlier versions"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "pdf_converter"))
+
+import server
+
+PAGES = [
+    [{'bbox': [10, 10, 200, 60], 'category': 'Title', 'text': '# 标题 "quoted"'},
+     {'bbox': [10, 70, 400, 200], 'category': 'Text', 'text': 'line one\nline two'}],
+    [],
+    [{'bbox': [10, 210, 300, 400], 'category': 'Picture'}],
+]
+
+
+@pytest.fixture
+def work_dir(tmp_path):
+    for page_idx, cells in enumerate(PAGES):
+        if page_idx == 1:
+            continue  # a page without results is merged as empty cells
+        (tmp_path / f"doc_page_{page_idx}.json").write_text(json.dumps(cells, ensure_ascii=False), encoding='utf-8')
+        (tmp_path / f"doc_page_{page_idx}.md").write_text(f"page {page_idx}", encoding='utf-8')
+    return tmp_path
+
+
+def _expected():
+    return json.dumps([{'page': idx, 'cells': cells} for idx, cells in enumerate(PAGES)], ensure_ascii=False, indent=2)
+
+
+def test_incremental_merge_matches_baseline_format(work_dir):
+    merger = server.IncrementalMerger(work_dir, 'doc', 'h', len(PAGES), pending_pages=range(len(PAGES)))
+    for page_idx in (2, 0):  # out of order: page 2 waits for page 1, written by finish()
+        merger.add(page_idx)
+    merger.finish()
+    assert server.artifact_path(work_dir, 'doc', 'h', 'json').read_text(encoding='utf-8') == _expected()
+
+
+def test_on_demand_build_matches_incremental_merge(work_dir):
+    server._build_artifact(work_dir, 'doc', 'h', 'json', {'total_pages': len(PAGES)})
+    assert server.artifact_path(work_dir, 'doc', 'h', 'json').read_text(encoding='utf-8') == _expected()
+
+
+def test_empty_document():
+    assert '[' + server.combined_json_end(0) == json.dumps([], indent=2)
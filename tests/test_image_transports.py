@@ -0,0 +1,135 @@
+"""Image transports against a local stub of the OpenAI-compatible endpoint: the image the server resolves from the request
+('file': file:// path in the shared media directory, 'stream': base64 data URL written chunk by chunk) must be the image sent"""
+
+import base64
+import http.server
+import io
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import pytest
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import dots_ocr_lib
+from dots_ocr_lib import encode_image, inference_with_vllm, post_chat_completion_streaming
+
+
+class StubServer:
+    """Answers chat completions and keeps the image decoded from each request (a body not matching Content-Length fails to parse)"""
+
+    def __init__(self):
+        self.requests = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                payload = json.loads(body)  # fails if the streamed body is shorter or longer than announced
+                url = payload['messages'][0]['content'][0]['image_url']['url']
+                if url.startswith('file://'):
+                    path = url2pathname(urlparse(url).path)
+                    with Image.open(path) as image:
+                        stub.requests.append({'url': url, 'path': path, 'image': image.convert('RGB')})
+                else:
+                    data = base64.b64decode(url.split(',', 1)[1], validate=True)
+                    with Image.open(io.BytesIO(data)) as image:
+                        stub.requests.append({'url': url[:32], 'image': image.convert('RGB')})
+                reply = json.dumps({'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': 'dots-ocr',
+                                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'ok'}, 'finish_reason': 'stop'}],
+                                    'usage': {'prompt_tokens': 10, 'completion_tokens': 1, 'total_tokens': 11}}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+def _sample_image(width=301, height=203):
+    # Odd sizes and noise so that any truncation or misaligned base64 chunk shows up in the pixels
+    image = Image.merge('RGB', [Image.effect_noise((width, height), 40 + 10 * i) for i in range(3)])
+    ImageDraw.Draw(image).text((10, 10), "transport test", fill=(0, 0, 0))
+    return image
+
+
+def test_file_transport_resolves_same_image_and_cleans_up(stub, tmp_path):
+    image = _sample_image()
+    media_dir = tmp_path / "media"
+    content = inference_with_vllm(image, "prompt", '127.0.0.1', stub.port, image_transport='file', media_dir=str(media_dir))
+    assert content == 'ok'
+    assert len(stub.requests) == 1
+    request = stub.requests[0]
+    assert Path(request['path']).parent == media_dir
+    assert request['image'].tobytes() == image.tobytes()
+    # The media file is removed once the request is answered
+    assert not os.path.exists(request['path'])
+    assert os.listdir(media_dir) == []
+
+
+def test_file_transport_media_url(stub, tmp_path):
+    # media_url: how the server sees the shared directory; here the same directory under its file:// URL
+    image = _sample_image()
+    media_dir = tmp_path / "media"
+    inference_with_vllm(image, "prompt", '127.0.0.1', stub.port, image_transport='file', media_dir=str(media_dir),
+                        media_url=media_dir.as_uri())
+    assert stub.requests[0]['url'].startswith(media_dir.as_uri() + '/')
+    assert stub.requests[0]['image'].tobytes() == image.tobytes()
+    assert os.listdir(media_dir) == []
+
+
+def test_file_transport_cleans_up_on_failure(tmp_path):
+    image = _sample_image()
+    media_dir = tmp_path / "media"
+    # Nothing listens on this port: every attempt fails with a connection error
+    content = inference_with_vllm(image, "prompt", '127.0.0.1', 9, image_transport='file', media_dir=str(media_dir),
+                                  max_retries=1)
+    assert content is None
+    assert os.listdir(media_dir) == []
+
+
+@pytest.mark.parametrize('size', [(301, 203), (2, 1), (640, 480)])
+def test_stream_transport_body_and_image(stub, monkeypatch, size):
+    # Small chunks so that the image spans many base64 chunks (STREAM_CHUNK_SIZE must stay a multiple of 3)
+    monkeypatch.setattr(dots_ocr_lib, 'STREAM_CHUNK_SIZE', 3 * 1024)
+    image = _sample_image(*size)
+    data = encode_image(image, format='PNG')
+    stats = {}
+    content = post_chat_completion_streaming(data, 'PNG', "prompt", '127.0.0.1', stub.port, 'dots-ocr', 100, 0.1, 1.0, 30, stats=stats)
+    assert content == 'ok'
+    assert stub.requests[0]['url'].startswith('data:image/png;base64,')
+    assert stub.requests[0]['image'].tobytes() == image.tobytes()
+    assert stats['usage']['prompt_tokens'] == 10
+    assert stats['payload_bytes'] > len(data) * 4 // 3
+
+
+def test_stream_transport_through_inference(stub):
+    image = _sample_image()
+    stats = {}
+    content = inference_with_vllm(image, "prompt", '127.0.0.1', stub.port, image_transport='stream', stats=stats)
+    assert content == 'ok'
+    assert stub.requests[0]['image'].tobytes() == image.tobytes()
+    assert stats['attempts'] == 1 and stats['retries'] == 0
@@ -0,0 +1,60 @@
+"""page_fingerprints: pages that render differently must never share a fingerprint (their results would be reused)"""
+
+import sys
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from dots_ocr_lib import page_fingerprints
+
+
+def _form_page(doc, value):
+    page = doc.new_page()
+    page.insert_text((72, 72), "Contract No. 2024-001\nName:", fontsize=12)
+    widget = fitz.Widget()
+    widget.field_name = "name"
+    widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+    widget.rect = fitz.Rect(72, 90, 300, 110)
+    widget.field_value = value
+    page.add_widget(widget)
+    return page
+
+
+def _note_page(doc, text):
+    page = doc.new_page()
+    page.insert_text((72, 72), "Quarterly report", fontsize=12)
+    page.add_freetext_annot(fitz.Rect(72, 100, 300, 140), text, fontsize=11)
+    return page
+
+
+def _fingerprint_pair(build, first, second):
+    doc = fitz.open()
+    build(doc, first)
+    build(doc, second)
+    return page_fingerprints(doc)
+
+
+def test_same_content_same_fingerprint():
+    a, b = _fingerprint_pair(_form_page, "Alice", "Alice")
+    assert a == b
+
+
+def test_widget_value_changes_fingerprint():
+    a, b = _fingerprint_pair(_form_page, "Alice", "Bob")
+    assert a != b
+
+
+def test_freetext_annotation_changes_fingerprint():
+    a, b = _fingerprint_pair(_note_page, "Approved", "Rejected")
+    assert a != b
+
+
+def test_annotation_added_changes_fingerprint():
+    doc = fitz.open()
+    for _ in range(2):
+        doc.new_page().insert_text((72, 72), "Quarterly report", fontsize=12)
+    doc[1].add_freetext_annot(fitz.Rect(72, 100, 300, 140), "Approved", fontsize=11)
+    a, b = page_fingerprints(doc)
+    assert a != b
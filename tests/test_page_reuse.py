@@ -0,0 +1,48 @@
+"""Reusing unchanged pages on resume: a page whose output exists in the job's own directory but whose bit is not set in
+the job store (interrupted while being written) must go back through OCR, not be matched to itself in the page index"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "pdf_converter"))
+
+import server
+
+FINGERPRINTS = ['fp-0', 'fp-1', 'fp-2']
+
+
+def _write_outputs(directory, base_name, page_idx, text):
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / f"{base_name}_page_{page_idx}.json").write_text(json.dumps([{'category': 'Text', 'text': text}]), encoding='utf-8')
+    (directory / f"{base_name}_page_{page_idx}.md").write_text(text, encoding='utf-8')
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'DATA_DIR', tmp_path)
+    monkeypatch.setattr(server, 'page_index', None)
+    monkeypatch.setattr(server, 'near_duplicate_index', None)
+    return tmp_path
+
+
+def test_resume_does_not_reuse_own_unfinished_page(data_dir):
+    work_dir = data_dir / "job"
+    # An earlier run of this job indexed pages 0 and 2; an older document has the same page 1
+    for idx in (0, 2):
+        _write_outputs(work_dir, 'doc', idx, f"page {idx}")
+    _write_outputs(data_dir / "older", 'other', 5, "older page")
+    server.record_page_index(work_dir, 'doc', [0, 2], FINGERPRINTS)
+    server.record_page_index(data_dir / "older", 'other', [5], {5: FINGERPRINTS[1]})
+    (work_dir / "doc_page_0.md").write_text("half writ", encoding='utf-8')  # interrupted rewrite of page 0
+
+    # Resume as process_pdf_background does: only pages in the bitmap count as done
+    bitmap = server.pages_to_bitmap([2], len(FINGERPRINTS))
+    cached = {idx for idx in range(3) if server.page_outputs_exist(work_dir, 'doc', idx)} & server.bitmap_to_pages(bitmap)
+    assert cached == {2}
+    reused = server.reuse_unchanged_pages(work_dir, 'doc', FINGERPRINTS, [idx for idx in range(3) if idx not in cached])
+
+    assert reused == {1: 'older#5'}
+    assert (work_dir / "doc_page_1.md").read_text(encoding='utf-8') == "older page"
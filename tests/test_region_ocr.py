@@ -0,0 +1,61 @@
+"""Region OCR: every non-picture layout cell gets its own request, except cells whose box cannot be cropped (zero area,
+inverted, outside the page or too elongated), which keep the layout pass's cell instead of failing the page"""
+
+import json
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from dots_ocr_lib import DotsOCRParser, region_box
+
+CELLS = [
+    {'bbox': [10, 10, 300, 60], 'category': 'Title'},
+    {'bbox': [10, 80, 10, 200], 'category': 'Text'},        # zero width
+    {'bbox': [50, 90, 400, 90], 'category': 'Text'},        # zero height
+    {'bbox': [400, 300, 100, 250], 'category': 'Table'},    # inverted
+    {'bbox': [700, 10, 900, 60], 'category': 'Text'},       # outside the page
+    {'bbox': [0, 500, 599, 501], 'category': 'Text'},       # aspect ratio beyond smart_resize's limit
+    {'bbox': [20, 400, 580, 900], 'category': 'Formula'},   # partly outside: clamped
+]
+
+
+def test_region_box():
+    size = (600, 800)
+    assert region_box([10, 10, 300, 60], size) == (10, 10, 300, 60)
+    assert region_box([20, 400, 580, 900], size) == (20, 400, 580, 800)
+    assert region_box([-5.4, 0.6, 100.2, 50], size) == (0, 1, 100, 50)
+    for bbox in ([10, 80, 10, 200], [400, 300, 100, 250], [700, 10, 900, 60], [0, 500, 599, 501], None, [1, 2, 3], ['a', 0, 1, 1]):
+        assert region_box(bbox, size) is None
+
+
+def test_zero_area_cells_do_not_fail_the_page(tmp_path):
+    parser = DotsOCRParser(region_ocr=True, output_dir=str(tmp_path))
+    image = Image.new('RGB', (600, 800), 'white')
+    crops = []
+
+    def layout_pass(origin_image, prompt_mode, save_dir, save_name, page_idx=0, page=None):
+        assert prompt_mode == 'prompt_layout_only_en'
+        result = {'page_no': page_idx, 'route': 'model', 'filtered': False, 'skipped_blank': False, 'retries': 0,
+                  'request_errors': {}, 'image_tokens': 0, 'payload_bytes': 0, 'prompt_tokens': None,
+                  'completion_tokens': None, 'timings': {},
+                  'layout_info_path': str(tmp_path / f"{save_name}.json"), 'md_content_path': str(tmp_path / f"{save_name}.md")}
+        with open(result['layout_info_path'], 'w', encoding='utf-8') as f:
+            json.dump(CELLS, f)
+        return result
+
+    def infer(crop, prompt, tokens, max_tokens, page=None):
+        crops.append(crop.size)
+        return f"text {len(crops)}", None, False, {'retries': 0, 'errors': {}}
+
+    parser._parse_page = layout_pass
+    parser._infer = infer
+    result = parser._parse_regions(image, str(tmp_path), 'doc_page_0', 0)
+
+    assert not result['filtered'] and result['skipped_regions'] == 5
+    assert len(crops) == 2
+    with open(result['layout_info_path'], encoding='utf-8') as f:
+        cells = json.load(f)
+    assert [cell.get('text') for cell in cells] == ['text 1', None, None, None, None, None, '$$text 2$$']
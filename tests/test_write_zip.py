@@ -0,0 +1,58 @@
+"""write_zip produces a valid archive both with the parallel deflate path and with the zipfile.write fallback used on
+Python versions whose zipfile internals have not been checked"""
+
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "pdf_converter"))
+
+import server
+
+CONTENTS = {
+    'doc.md': ('# 标题\n\n' + 'lorem ipsum dolor sit amet\n' * 2000).encode('utf-8'),
+    'doc.json': b'[]',
+    'empty.txt': b'',
+    'page.png': bytes(range(256)) * 64,
+}
+
+
+@pytest.fixture
+def entries(tmp_path):
+    result = []
+    for name, data in CONTENTS.items():
+        (tmp_path / name).write_bytes(data)
+        result.append((tmp_path / name, name))
+    result.append((tmp_path / "missing.txt", 'missing.txt'))  # skipped
+    return result
+
+
+def _check(zip_path):
+    with zipfile.ZipFile(zip_path) as zipf:
+        assert zipf.testzip() is None
+        assert zipf.namelist() == list(CONTENTS)
+        for name, data in CONTENTS.items():
+            assert zipf.read(name) == data
+        info = {item.filename: item for item in zipf.infolist()}
+        assert info['doc.md'].compress_type == zipfile.ZIP_DEFLATED
+        assert info['doc.md'].compress_size < len(CONTENTS['doc.md'])
+        assert info['page.png'].compress_type == zipfile.ZIP_STORED
+
+
+def test_parallel_deflate(entries, tmp_path, monkeypatch):
+    written = []
+    write_precompressed = server._write_precompressed
+    monkeypatch.setattr(server, '_write_precompressed', lambda zipf, src, arcname, *args: (
+        written.append(arcname), write_precompressed(zipf, src, arcname, *args)))
+    _check(server.write_zip(tmp_path / "out.zip", entries))
+    with zipfile.ZipFile(tmp_path / "probe.zip", 'w') as probe:
+        expected = ['doc.md', 'doc.json', 'empty.txt'] if server._supports_precompressed(probe) else []
+    assert written == expected
+
+
+def test_fallback_on_unchecked_python(entries, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'PRECOMPRESSED_ZIP_VERSIONS', ((2, 0), (2, 7)))
+    monkeypatch.setattr(server, '_write_precompressed', lambda *args: pytest.fail("private zipfile path used"))
+    _check(server.write_zip(tmp_path / "out.zip", entries))